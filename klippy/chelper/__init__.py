@@ -198,6 +198,8 @@ defs_serialqueue = """
     void serialqueue_set_clock_est(struct serialqueue *sq, double est_freq
         , double conv_time, uint64_t conv_clock, uint64_t last_clock);
     void serialqueue_get_stats(struct serialqueue *sq, char *buf, int len);
+    void serialqueue_get_rtt_histogram(struct serialqueue *sq, uint32_t *hist
+        , int count);
     int serialqueue_extract_old(struct serialqueue *sq, int sentq
         , struct pull_queue_message *q, int max);
 """
@@ -72,6 +72,8 @@ struct serialqueue {
     struct list_head old_sent, old_receive;
     // Stats
     uint32_t bytes_write, bytes_read, bytes_retransmit, bytes_invalid;
+    uint32_t can_frames_write, can_frames_read;
+    uint32_t rtt_histogram[SERIALQUEUE_RTT_BUCKETS];
 };
 
 #define SQPF_SERIAL 0
@@ -188,6 +190,13 @@ update_receive_seq(struct serialqueue *sq, double eventtime, uint64_t rseq)
         && sq->last_receive_sent_time) {
         // RFC6298 rtt calculations
         double delta = eventtime - sq->last_receive_sent_time;
+        int bucket = 0;
+        double bucket_max = 0.001;
+        while (delta >= bucket_max && bucket < SERIALQUEUE_RTT_BUCKETS - 1) {
+            bucket++;
+            bucket_max *= 2.0;
+        }
+        sq->rtt_histogram[bucket]++;
         if (!sq->srtt) {
             sq->rttvar = delta / 2.0;
             sq->srtt = delta * 10.0; // use a higher start default
@@ -311,6 +320,9 @@ input_event(struct serialqueue *sq, double eventtime)
             return;
         memcpy(&sq->input_buf[sq->input_pos], cf.data, cf.can_dlc);
         sq->input_pos += cf.can_dlc;
+        pthread_mutex_lock(&sq->lock);
+        sq->can_frames_read++;
+        pthread_mutex_unlock(&sq->lock);
     } else {
         int ret = read(sq->serial_fd, &sq->input_buf[sq->input_pos]
                        , sizeof(sq->input_buf) - sq->input_pos);
@@ -386,6 +398,7 @@ do_write(struct serialqueue *sq, void *buf, int buflen)
             return;
         }
         sq->last_write_fail_time = 0.0;
+        sq->can_frames_write++;
         buf += size;
         buflen -= size;
     }
@@ -940,6 +953,25 @@ serialqueue_get_stats(struct serialqueue *sq, char *buf, int len)
              , (int)stats.retransmit_seq
              , stats.srtt, stats.rttvar, stats.rto
              , stats.ready_bytes, stats.upcoming_bytes);
+    if (stats.serial_fd_type == SQT_CAN) {
+        int slen = strlen(buf);
+        snprintf(&buf[slen], len - slen
+                 , " can_frames_write=%u can_frames_read=%u"
+                 , stats.can_frames_write, stats.can_frames_read);
+    }
+}
+
+// Return a histogram of message block round-trip-times.  Bucket 0
+// counts times below 1ms and each following bucket doubles the limit.
+void __visible
+serialqueue_get_rtt_histogram(struct serialqueue *sq, uint32_t *hist
+                              , int count)
+{
+    if (count > SERIALQUEUE_RTT_BUCKETS)
+        count = SERIALQUEUE_RTT_BUCKETS;
+    pthread_mutex_lock(&sq->lock);
+    memcpy(hist, sq->rtt_histogram, count * sizeof(hist[0]));
+    pthread_mutex_unlock(&sq->lock);
 }
 
 // Extract old messages stored in the debug queues
@@ -7,6 +7,7 @@
 
 #define MAX_CLOCK 0x7fffffffffffffffLL
 #define BACKGROUND_PRIORITY_CLOCK 0x7fffffff00000000LL
+#define SERIALQUEUE_RTT_BUCKETS 8
 
 struct fastreader;
 typedef void (*fastreader_cb)(struct fastreader *fr, uint8_t *data, int len);
@@ -50,6 +51,8 @@ void serialqueue_set_clock_est(struct serialqueue *sq, double est_freq
 void serialqueue_get_clock_est(struct serialqueue *sq
                                , struct clock_estimate *ce);
 void serialqueue_get_stats(struct serialqueue *sq, char *buf, int len);
+void serialqueue_get_rtt_histogram(struct serialqueue *sq, uint32_t *hist
+                                   , int count);
 int serialqueue_extract_old(struct serialqueue *sq, int sentq
                             , struct pull_queue_message *q, int max);
 
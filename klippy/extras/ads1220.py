@@ -127,13 +127,11 @@ class ADS1220:
         self.batch_bulk.add_client(callback)
 
     # Measurement decoding
-    def _convert_samples(self, samples):
+    def _convert_samples(self, times, columns):
         adc_factor = 1. / (1 << 23)
-        count = 0
-        for ptime, val in samples:
-            samples[count] = (round(ptime, 6), val, round(val * adc_factor, 9))
-            count += 1
-        del samples[count:]
+        vals = columns[0]
+        return list(zip([round(t, 6) for t in times], vals,
+                        [round(v * adc_factor, 9) for v in vals]))
 
     # Start, stop, and process message batches
     def _start_measurements(self):
@@ -158,8 +156,8 @@ class ADS1220:
         logging.info("ADS1220 finished '%s' measurements", self.name)
 
     def _process_batch(self, eventtime):
-        samples = self.ffreader.pull_samples()
-        self._convert_samples(samples)
+        times, columns = self.ffreader.pull_columns()
+        samples = self._convert_samples(times, columns)
         return {'data': samples, 'errors': self.last_error_count,
                 'overflows': self.ffreader.get_last_overflows()}
 
@@ -3,7 +3,8 @@
 # Copyright (C) 2020-2023  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, time, collections, multiprocessing, os
+import logging, time, collections, multiprocessing, os, sys, struct, array
+import itertools, threading, queue, tempfile
 from . import bus, bulk_sensor
 
 # ADXL345 registers
@@ -30,60 +31,60 @@ SCALE_Z  = 0.003906 * FREEFALL_ACCEL # 1 / 256 (at 3.3V) mg/LSB
 Accel_Measurement = collections.namedtuple(
     'Accel_Measurement', ('time', 'accel_x', 'accel_y', 'accel_z'))
 
+# Limit on the number of samples held in memory by a query
+MAX_QUERY_SAMPLES = 8000000
+
 # Helper class to obtain measurements
 class AccelQueryHelper:
     def __init__(self, printer):
         self.printer = printer
-        self.is_finished = False
+        self.is_finished = self.is_finishing = False
         print_time = printer.lookup_object('toolhead').get_last_move_time()
         self.request_start_time = self.request_end_time = print_time
-        self.msgs = []
+        # Measurements are stored in columns (time, accel_x, ...)
+        self.columns = [array.array('d') for i in range(4)]
         self.samples = []
+        self.stream_writer = None
+    def stream_to_file(self, filename):
+        # Write measurements to a file instead of storing them in memory
+        self.stream_writer = AccelDataFileWriter(filename)
     def finish_measurements(self):
         toolhead = self.printer.lookup_object('toolhead')
         self.request_end_time = toolhead.get_last_move_time()
+        self.is_finishing = True
         toolhead.wait_moves()
         self.is_finished = True
+        if self.stream_writer is not None:
+            self.stream_writer.close()
     def handle_batch(self, msg):
         if self.is_finished:
             return False
-        if len(self.msgs) >= 10000:
+        data = msg['data']
+        if not data:
+            return True
+        # Discard samples outside of the requested time range
+        if data[0][0] < self.request_start_time:
+            data = [s for s in data if s[0] >= self.request_start_time]
+        if self.is_finishing and data and data[-1][0] > self.request_end_time:
+            data = [s for s in data if s[0] <= self.request_end_time]
+        if self.stream_writer is not None:
+            self.stream_writer.add_samples(data)
+            return True
+        if len(self.columns[0]) + len(data) > MAX_QUERY_SAMPLES:
             # Avoid filling up memory with too many samples
             return False
-        self.msgs.append(msg)
+        for col, values in zip(self.columns, zip(*data)):
+            col.extend(values)
         return True
     def has_valid_samples(self):
-        for msg in self.msgs:
-            data = msg['data']
-            first_sample_time = data[0][0]
-            last_sample_time = data[-1][0]
-            if (first_sample_time > self.request_end_time
-                    or last_sample_time < self.request_start_time):
-                continue
-            # The time intervals [first_sample_time, last_sample_time]
-            # and [request_start_time, request_end_time] have non-zero
-            # intersection. It is still theoretically possible that none
-            # of the samples from msgs fall into the time interval
-            # [request_start_time, request_end_time] if it is too narrow
-            # or on very heavy data losses. In practice, that interval
-            # is at least 1 second, so this possibility is negligible.
-            return True
-        return False
+        if self.stream_writer is not None:
+            return self.stream_writer.count > 0
+        return len(self.columns[0]) > 0
+    def get_sample_columns(self):
+        return self.columns
     def get_samples(self):
-        if not self.msgs:
-            return self.samples
-        total = sum([len(m['data']) for m in self.msgs])
-        count = 0
-        self.samples = samples = [None] * total
-        for msg in self.msgs:
-            for samp_time, x, y, z in msg['data']:
-                if samp_time < self.request_start_time:
-                    continue
-                if samp_time > self.request_end_time:
-                    break
-                samples[count] = Accel_Measurement(samp_time, x, y, z)
-                count += 1
-        del samples[count:]
+        if len(self.samples) != len(self.columns[0]):
+            self.samples = list(map(Accel_Measurement, *self.columns))
         return self.samples
     def write_to_file(self, filename):
         def write_impl():
@@ -92,23 +93,99 @@ class AccelQueryHelper:
                 os.nice(20)
             except:
                 pass
-            f = open(filename, "w")
-            f.write("#time,accel_x,accel_y,accel_z\n")
-            samples = self.samples or self.get_samples()
-            for t, accel_x, accel_y, accel_z in samples:
-                f.write("%.6f,%.6f,%.6f,%.6f\n" % (
-                    t, accel_x, accel_y, accel_z))
-            f.close()
+            if filename.endswith(".npy"):
+                write_npy_file(filename, self.columns)
+            else:
+                write_csv_file(filename, self.columns)
         write_proc = multiprocessing.Process(target=write_impl)
         write_proc.daemon = True
         write_proc.start()
 
+# Measurement files in the NumPy ".npy" format (rows of time, x, y, z)
+NPY_HEADER_SIZE = 128
+NPY_READ_ROWS = 65536
+
+def _build_npy_header(count):
+    hdr = "{'descr': '<f8', 'fortran_order': False, 'shape': (%d, 4), }" % (
+        count,)
+    hdr = hdr.ljust(NPY_HEADER_SIZE - 11) + "\n"
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H", len(hdr)) + hdr.encode()
+
+def _pack_rows(rows):
+    data = array.array('d', itertools.chain.from_iterable(rows))
+    if sys.byteorder != 'little':
+        data.byteswap()
+    return data.tobytes()
+
+def write_npy_file(filename, columns):
+    f = open(filename, "wb")
+    f.write(_build_npy_header(len(columns[0])))
+    for i in range(0, len(columns[0]), NPY_READ_ROWS):
+        f.write(_pack_rows(zip(*[c[i:i+NPY_READ_ROWS] for c in columns])))
+    f.close()
+
+def write_csv_file(filename, columns):
+    f = open(filename, "w")
+    f.write("#time,accel_x,accel_y,accel_z\n")
+    for t, accel_x, accel_y, accel_z in zip(*columns):
+        f.write("%.6f,%.6f,%.6f,%.6f\n" % (t, accel_x, accel_y, accel_z))
+    f.close()
+
+# Convert a measurement file written by AccelDataFileWriter to csv
+def convert_npy_to_csv(npy_filename, csv_filename):
+    f = open(npy_filename, "rb")
+    f.seek(NPY_HEADER_SIZE)
+    out = open(csv_filename, "w")
+    out.write("#time,accel_x,accel_y,accel_z\n")
+    while 1:
+        data = array.array('d', f.read(NPY_READ_ROWS * 4 * 8))
+        if not data:
+            break
+        if sys.byteorder != 'little':
+            data.byteswap()
+        for i in range(0, len(data), 4):
+            out.write("%.6f,%.6f,%.6f,%.6f\n" % tuple(data[i:i+4]))
+    out.close()
+    f.close()
+
+# Helper to stream measurements to a ".npy" file from a background thread
+class AccelDataFileWriter:
+    def __init__(self, filename):
+        self.filename = filename
+        self.count = 0
+        self.file = open(filename, "wb")
+        self.file.write(_build_npy_header(0))
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._write_thread)
+        self.thread.daemon = True
+        self.thread.start()
+    def _write_thread(self):
+        while 1:
+            data = self.queue.get()
+            if data is None:
+                break
+            self.file.write(data)
+    def add_samples(self, samples):
+        self.count += len(samples)
+        self.queue.put(_pack_rows(samples))
+    def close(self):
+        if self.file is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        # Update the header with the final number of samples
+        self.file.seek(0)
+        self.file.write(_build_npy_header(self.count))
+        self.file.close()
+        self.file = None
+
 # Helper class for G-Code commands
 class AccelCommandHelper:
     def __init__(self, config, chip):
         self.printer = config.get_printer()
         self.chip = chip
         self.bg_client = None
+        self.bg_filename = None
         name_parts = config.get_name().split()
         self.base_name = name_parts[0]
         self.name = name_parts[-1]
@@ -134,23 +211,48 @@ class AccelCommandHelper:
     cmd_ACCELEROMETER_MEASURE_help = "Start/stop accelerometer"
     def cmd_ACCELEROMETER_MEASURE(self, gcmd):
         if self.bg_client is None:
-            # Start measurements
+            # Start measurements (streamed to a temporary file)
             self.bg_client = self.chip.start_internal_client()
+            # Use a unique file so that a new measurement can not clash
+            # with a csv conversion still running from the last one
+            fd, self.bg_filename = tempfile.mkstemp(
+                prefix="%s-%s-" % (self.base_name, self.name),
+                suffix=".npy.tmp", dir="/tmp")
+            os.close(fd)
+            self.bg_client.stream_to_file(self.bg_filename)
             gcmd.respond_info("accelerometer measurements started")
             return
         # End measurements
         name = gcmd.get("NAME", time.strftime("%Y%m%d_%H%M%S"))
         if not name.replace('-', '').replace('_', '').isalnum():
             raise gcmd.error("Invalid NAME parameter")
+        fmt = gcmd.get("FORMAT", "csv").lower()
+        if fmt not in ["csv", "npy"]:
+            raise gcmd.error("Invalid FORMAT parameter")
         bg_client = self.bg_client
         self.bg_client = None
         bg_client.finish_measurements()
         # Write data to file
         if self.base_name == self.name:
-            filename = "/tmp/%s-%s.csv" % (self.base_name, name)
+            filename = "/tmp/%s-%s.%s" % (self.base_name, name, fmt)
+        else:
+            filename = "/tmp/%s-%s-%s.%s" % (self.base_name, self.name,
+                                             name, fmt)
+        if fmt == "npy":
+            os.rename(self.bg_filename, filename)
         else:
-            filename = "/tmp/%s-%s-%s.csv" % (self.base_name, self.name, name)
-        bg_client.write_to_file(filename)
+            tmpname = self.bg_filename
+            def write_impl():
+                try:
+                    # Try to re-nice writing process
+                    os.nice(20)
+                except:
+                    pass
+                convert_npy_to_csv(tmpname, filename)
+                os.unlink(tmpname)
+            write_proc = multiprocessing.Process(target=write_impl)
+            write_proc.daemon = True
+            write_proc.start()
         gcmd.respond_info("Writing raw accelerometer data to %s file"
                           % (filename,))
     cmd_ACCELEROMETER_QUERY_help = "Query accelerometer for the current values"
@@ -184,6 +286,15 @@ def read_axes_map(config, scale_x, scale_y, scale_z):
         raise config.error("Invalid axes_map parameter")
     return [am[a.strip()] for a in axes_map]
 
+# Helper to convert columns of raw axis measurements to (time, x, y, z)
+class AxesConverter:
+    def __init__(self, axes_map):
+        self.axes = [(pos, bulk_sensor.ScaledValueCache(scale, 6))
+                     for pos, scale in axes_map]
+    def convert(self, times, raw_xyz):
+        xyz = [[cache[v] for v in raw_xyz[pos]] for pos, cache in self.axes]
+        return list(zip([round(t, 6) for t in times], *xyz))
+
 BATCH_UPDATES = 0.100
 
 # Printer class that controls ADXL345 chip
@@ -192,6 +303,7 @@ class ADXL345:
         self.printer = config.get_printer()
         AccelCommandHelper(config, self)
         self.axes_map = read_axes_map(config, SCALE_XY, SCALE_XY, SCALE_Z)
+        self.axes_converter = AxesConverter(self.axes_map)
         self.data_rate = config.getint('rate', 3200)
         if self.data_rate not in QUERY_RATES:
             raise config.error("Invalid rate parameter: %d" % (self.data_rate,))
@@ -240,25 +352,27 @@ class ADXL345:
         aqh = AccelQueryHelper(self.printer)
         self.batch_bulk.add_client(aqh.handle_batch)
         return aqh
+    # add_client interface, direct pass through to bulk_sensor API
+    def add_client(self, client_cb):
+        self.batch_bulk.add_client(client_cb)
     # Measurement decoding
-    def _convert_samples(self, samples):
-        (x_pos, x_scale), (y_pos, y_scale), (z_pos, z_scale) = self.axes_map
-        count = 0
-        for ptime, xlow, ylow, zlow, xzhigh, yzhigh in samples:
-            if yzhigh & 0x80:
-                self.last_error_count += 1
-                continue
-            rx = (xlow | ((xzhigh & 0x1f) << 8)) - ((xzhigh & 0x10) << 9)
-            ry = (ylow | ((yzhigh & 0x1f) << 8)) - ((yzhigh & 0x10) << 9)
-            rz = ((zlow | ((xzhigh & 0xe0) << 3) | ((yzhigh & 0xe0) << 6))
-                  - ((yzhigh & 0x40) << 7))
-            raw_xyz = (rx, ry, rz)
-            x = round(raw_xyz[x_pos] * x_scale, 6)
-            y = round(raw_xyz[y_pos] * y_scale, 6)
-            z = round(raw_xyz[z_pos] * z_scale, 6)
-            samples[count] = (round(ptime, 6), x, y, z)
-            count += 1
-        del samples[count:]
+    def _convert_samples(self, times, columns):
+        xlow, ylow, zlow, xzhigh, yzhigh = columns
+        if yzhigh and max(yzhigh) & 0x80:
+            # Discard samples with the error flag set
+            valid = [i for i, v in enumerate(yzhigh) if not v & 0x80]
+            self.last_error_count += len(yzhigh) - len(valid)
+            times = [times[i] for i in valid]
+            xlow, ylow, zlow, xzhigh, yzhigh = [[c[i] for i in valid]
+                                                for c in columns]
+        rx = [(xl | ((xzh & 0x1f) << 8)) - ((xzh & 0x10) << 9)
+              for xl, xzh in zip(xlow, xzhigh)]
+        ry = [(yl | ((yzh & 0x1f) << 8)) - ((yzh & 0x10) << 9)
+              for yl, yzh in zip(ylow, yzhigh)]
+        rz = [(zl | ((xzh & 0xe0) << 3) | ((yzh & 0xe0) << 6))
+              - ((yzh & 0x40) << 7)
+              for zl, xzh, yzh in zip(zlow, xzhigh, yzhigh)]
+        return self.axes_converter.convert(times, (rx, ry, rz))
     # Start, stop, and process message batches
     def _start_measurements(self):
         # In case of miswiring, testing ADXL345 device ID prevents treating
@@ -291,8 +405,8 @@ class ADXL345:
         self.ffreader.note_end()
         logging.info("ADXL345 finished '%s' measurements", self.name)
     def _process_batch(self, eventtime):
-        samples = self.ffreader.pull_samples()
-        self._convert_samples(samples)
+        times, columns = self.ffreader.pull_columns()
+        samples = self._convert_samples(times, columns)
         if not samples:
             return {}
         return {'data': samples, 'errors': self.last_error_count,
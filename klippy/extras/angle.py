@@ -20,6 +20,7 @@ class AngleCalibration:
         self.printer = config.get_printer()
         self.name = config.get_name()
         self.stepper_name = config.get('stepper', None)
+        self.calibration = []
         if self.stepper_name is None:
             # No calibration
             return
@@ -27,6 +28,7 @@ class AngleCalibration:
             import numpy
         except:
             raise config.error("Angle calibration requires numpy module")
+        self.numpy = numpy
         sconfig = config.getsection(self.stepper_name)
         sconfig.getint('microsteps', note_valid=False)
         self.tmc_module = self.mcu_stepper = None
@@ -71,34 +73,38 @@ class AngleCalibration:
             phase_diff -= phases
         # Store final offset
         self.mcu_pos_offset = mcu_pos - (angle_mpos - phase_diff)
-    def apply_calibration(self, samples):
+    def apply_calibration(self, times, angles):
+        # Correct a batch of angles and return (angles, position_offset)
         calibration = self.calibration
         if not calibration:
-            return None
-        calibration_reversed = self.calibration_reversed
+            return angles, None
+        np = self.numpy
         interp_bits = ANGLE_BITS - CALIBRATION_BITS
         interp_mask = (1 << interp_bits) - 1
         interp_round = 1 << (interp_bits - 1)
-        for i, (samp_time, angle) in enumerate(samples):
-            bucket = (angle & 0xffff) >> interp_bits
-            cal1 = calibration[bucket]
-            cal2 = calibration[bucket + 1]
-            adj = (angle & interp_mask) * (cal2 - cal1)
-            adj = cal1 + ((adj + interp_round) >> interp_bits)
-            angle_diff = (adj - angle) & 0xffff
-            angle_diff -= (angle_diff & 0x8000) << 1
-            new_angle = angle + angle_diff
-            if calibration_reversed:
-                new_angle = -new_angle
-            samples[i] = (samp_time, new_angle)
+        angles = np.array(angles, dtype=np.int64)
+        bucket = (angles & 0xffff) >> interp_bits
+        cal1 = self.calibration_array[bucket]
+        cal2 = self.calibration_array[bucket + 1]
+        adj = (angles & interp_mask) * (cal2 - cal1)
+        adj = cal1 + ((adj + interp_round) >> interp_bits)
+        angle_diff = (adj - angles) & 0xffff
+        angle_diff -= (angle_diff & 0x8000) << 1
+        new_angles = angles + angle_diff
+        if self.calibration_reversed:
+            new_angles = -new_angles
+        new_angles = new_angles.tolist()
         if self.mcu_pos_offset is None:
-            self.calc_mcu_pos_offset(samples[0])
+            self.calc_mcu_pos_offset((times[0], new_angles[0]))
             if self.mcu_pos_offset is None:
-                return None
-        return self.mcu_stepper.mcu_to_commanded_position(self.mcu_pos_offset)
+                return new_angles, None
+        offset = self.mcu_stepper.mcu_to_commanded_position(
+            self.mcu_pos_offset)
+        return new_angles, offset
     def load_calibration(self, angles):
         # Calculate linear intepolation calibration buckets by solving
         # linear equations
+        np = self.numpy
         angle_max = 1 << ANGLE_BITS
         calibration_count = 1 << CALIBRATION_BITS
         bucket_size = angle_max // calibration_count
@@ -109,25 +115,22 @@ class AngleCalibration:
         if self.calibration_reversed:
             angles = list(reversed(angles))
         first_step = angles.index(min(angles))
-        angles = angles[first_step:] + angles[:first_step]
-        import numpy
-        eqs = numpy.zeros((full_steps, calibration_count))
-        ans = numpy.zeros((full_steps,))
-        for step, angle in enumerate(angles):
-            int_angle = int(angle + .5) % angle_max
-            bucket = int(int_angle / bucket_size)
-            bucket_start = bucket * bucket_size
-            ang_diff = angle - bucket_start
-            ang_diff_per = ang_diff / bucket_size
-            eq = eqs[step]
-            eq[bucket] = 1. - ang_diff_per
-            eq[(bucket + 1) % calibration_count] = ang_diff_per
-            ans[step] = float(step * nominal_step)
-            if bucket + 1 >= calibration_count:
-                ans[step] -= ang_diff_per * angle_max
-        sol = numpy.linalg.lstsq(eqs, ans, rcond=None)[0]
+        angles = np.array(angles[first_step:] + angles[:first_step])
+        # Each measured step is a linear interpolation between two buckets
+        steps = np.arange(full_steps)
+        int_angles = (angles + .5).astype(np.int64) % angle_max
+        buckets = int_angles // bucket_size
+        ang_diff_per = (angles - buckets * bucket_size) / bucket_size
+        eqs = np.zeros((full_steps, calibration_count))
+        eqs[steps, buckets] = 1. - ang_diff_per
+        eqs[steps, (buckets + 1) % calibration_count] = ang_diff_per
+        ans = steps * nominal_step
+        wraps = buckets + 1 >= calibration_count
+        ans[wraps] -= ang_diff_per[wraps] * angle_max
+        sol = np.linalg.lstsq(eqs, ans, rcond=None)[0]
         isol = [int(s + .5) for s in sol]
         self.calibration = isol + [isol[0] + angle_max]
+        self.calibration_array = np.array(self.calibration, dtype=np.int64)
     def lookup_tmc(self):
         for driver in TRINAMIC_DRIVERS:
             driver_name = "%s %s" % (driver, self.stepper_name)
@@ -198,15 +201,16 @@ class AngleCalibration:
         # Finish data collection
         is_finished = True
         # Correlate query responses
-        cal = {}
-        step = 0
-        for msg in msgs:
-            for query_time, pos in msg['data']:
-                # Add to step tracking
-                while step < len(times) and query_time > times[step][1]:
-                    step += 1
-                if step < len(times) and query_time >= times[step][0]:
-                    cal.setdefault(step, []).append(pos)
+        np = self.numpy
+        data = [d for msg in msgs for d in msg['data']]
+        query_times = np.array([d[0] for d in data])
+        positions = np.array([d[1] for d in data], dtype=np.int64)
+        qtimes = np.array(times).reshape(-1, 2)
+        starts = np.searchsorted(query_times, qtimes[:,0], side='left')
+        ends = np.searchsorted(query_times, qtimes[:,1], side='right')
+        cal = {step: positions[start:end]
+               for step, (start, end) in enumerate(zip(starts, ends))
+               if end > start}
         if len(cal) != len(times):
             raise self.printer.command_error(
                 "Failed calibration - incomplete sensor data")
@@ -218,10 +222,10 @@ class AngleCalibration:
         angles = {}
         for step, data in meas.items():
             count = len(data)
-            angle_avg = float(sum(data)) / count
+            angle_avg = float(data.sum()) / count
             angles[step] = angle_avg
             total_count += count
-            total_variance += sum([(d - angle_avg)**2 for d in data])
+            total_variance += float(((data - angle_avg)**2).sum())
         return angles, math.sqrt(total_variance / total_count), total_count
     cmd_ANGLE_CALIBRATE_help = "Calibrate angle sensor to stepper motor"
     def cmd_ANGLE_CALIBRATE(self, gcmd):
@@ -240,7 +244,8 @@ class AngleCalibration:
             or len({a: i for i, a in rangles.items()}) != len(rangles)):
             raise self.printer.command_error(
                 "Failed calibration - sensor not updating for each step")
-        merged = { i: fcal[i] + rcal[i] for i in range(full_steps) }
+        merged = { i: self.numpy.concatenate((fcal[i], rcal[i]))
+                   for i in range(full_steps) }
         angles, std, total = self.calc_angles(merged)
         gcmd.respond_info("angle: stddev=%.3f (%.3f forward / %.3f reverse)"
                           " in %d queries" % (std, fstd, rstd, total))
@@ -679,8 +684,9 @@ class Angle:
             time_shift = self.time_shift
             static_delay = self.sensor_helper.get_static_delay()
         # Process every message in raw_samples
-        count = error_count = 0
-        samples = [None] * (len(raw_samples) * SAMPLES_PER_BLOCK)
+        error_count = 0
+        times = []
+        angles = []
         for params in raw_samples:
             seq_diff = (params['sequence'] - last_sequence) & 0xffff
             last_sequence += seq_diff
@@ -708,13 +714,12 @@ class Angle:
                 else:
                     # tcode is mcu clock offset shifted by time_shift
                     sclock = mclock + (tcode<<time_shift)
-                ptime = round(clock_to_print_time(sclock) - static_delay, 6)
-                samples[count] = (ptime, last_angle)
-                count += 1
+                times.append(
+                    round(clock_to_print_time(sclock) - static_delay, 6))
+                angles.append(last_angle)
         self.last_sequence = last_sequence
         self.last_angle = last_angle
-        del samples[count:]
-        return samples, error_count
+        return times, angles, error_count
     # Start, stop, and process message batches
     def _is_measuring(self):
         return self.start_clock != 0
@@ -743,10 +748,11 @@ class Angle:
         raw_samples = self.bulk_queue.pull_queue()
         if not raw_samples:
             return {}
-        samples, error_count = self._extract_samples(raw_samples)
-        if not samples:
+        times, angles, error_count = self._extract_samples(raw_samples)
+        if not times:
             return {}
-        offset = self.calibration.apply_calibration(samples)
+        angles, offset = self.calibration.apply_calibration(times, angles)
+        samples = list(zip(times, angles))
         return {'data': samples, 'errors': error_count,
                 'position_offset': offset}
 
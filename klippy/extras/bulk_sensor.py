@@ -3,7 +3,7 @@
 # Copyright (C) 2020-2023  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, threading, struct
+import sys, logging, struct, array, collections
 
 # This "bulk sensor" module facilitates the processing of sensor chip
 # measurements that do not require the host to respond with low
@@ -92,7 +92,15 @@ class BatchBulkHelper:
     # Webhooks registration
     def _add_api_client(self, web_request):
         whbatch = BatchWebhooksClient(web_request)
-        self.add_client(whbatch.handle_batch)
+        client_cb = whbatch.handle_batch
+        decimation = web_request.get_int('decimation', 1)
+        filter_type = web_request.get_str('filter', 'fir')
+        if decimation < 1 or filter_type not in DECIMATION_FILTERS:
+            raise web_request.error("Invalid decimation or filter")
+        if decimation > 1:
+            client_cb = BatchDecimationFilter(client_cb, decimation,
+                                              filter_type).handle_batch
+        self.add_client(client_cb)
         web_request.send(self.webhooks_start_resp)
     def add_mux_endpoint(self, path, key, value, webhooks_start_resp):
         self.webhooks_start_resp = webhooks_start_resp
@@ -112,22 +120,85 @@ class BatchWebhooksClient:
         self.cconn.send(tmp)
         return True
 
+# Wrapper that reduces the sample rate of the batches sent to a client.
+# Each group of 'decimation' input samples produces one output sample.
+# The "fir" filter reports the average of each group (a moving average
+# low-pass filter), the "iir" filter reports the output of a first
+# order low-pass filter at the last sample of each group, and "none"
+# reports the last sample of each group.  The first field of every
+# sample must be its time and all other fields must be numbers.
+DECIMATION_FILTERS = ['fir', 'iir', 'none']
+class BatchDecimationFilter:
+    def __init__(self, client_cb, decimation, filter_type='fir'):
+        self.client_cb = client_cb
+        self.decimation = decimation
+        self.filter_type = filter_type
+        self.pending = []
+        self.iir_alpha = 2. / (decimation + 1.)
+        self.iir_state = None
+    def _filter_fir(self, columns):
+        dec = self.decimation
+        count = len(columns[0])
+        inv_dec = 1. / dec
+        out = [[round(sum(columns[0][i:i+dec]) * inv_dec, 6)
+                for i in range(0, count, dec)]]
+        for col in columns[1:]:
+            out.append([sum(col[i:i+dec]) * inv_dec
+                        for i in range(0, count, dec)])
+        return out
+    def _filter_iir(self, columns):
+        dec = self.decimation
+        alpha = self.iir_alpha
+        state = self.iir_state
+        if state is None:
+            state = [float(col[0]) for col in columns[1:]]
+        out = [columns[0][dec-1::dec]]
+        for i, col in enumerate(columns[1:]):
+            filtered = []
+            value = state[i]
+            for v in col:
+                value += alpha * (v - value)
+                filtered.append(value)
+            state[i] = value
+            out.append(filtered[dec-1::dec])
+        self.iir_state = state
+        return out
+    def handle_batch(self, msg):
+        data = self.pending + list(msg.get('data', ()))
+        count = len(data) - len(data) % self.decimation
+        self.pending = data[count:]
+        if not count:
+            return True
+        columns = list(zip(*data[:count]))
+        if self.filter_type == 'fir':
+            out = self._filter_fir(columns)
+        elif self.filter_type == 'iir':
+            out = self._filter_iir(columns)
+        else:
+            dec = self.decimation
+            out = [col[dec-1::dec] for col in columns]
+        msg = dict(msg)
+        msg['data'] = list(zip(*out))
+        return self.client_cb(msg)
+
 # Helper class to store incoming messages in a queue
 class BulkDataQueue:
     def __init__(self, mcu, msg_name="sensor_bulk_data", oid=None):
-        # Measurement storage (accessed from background thread)
-        self.lock = threading.Lock()
-        self.raw_samples = []
+        # Measurement storage.  Messages are added by the serial
+        # background thread (the single producer) and removed by the
+        # reactor thread (the single consumer).  A deque supports an
+        # append() and popleft() from different threads without a lock,
+        # so the background thread never waits on the reactor.
+        self.raw_samples = collections.deque()
         # Register callback with mcu
         mcu.register_response(self._handle_data, msg_name, oid)
     def _handle_data(self, params):
-        with self.lock:
-            self.raw_samples.append(params)
+        self.raw_samples.append(params)
     def pull_queue(self):
-        with self.lock:
-            raw_samples = self.raw_samples
-            self.raw_samples = []
-        return raw_samples
+        # Only remove the messages present at the start of the pull -
+        # messages appended concurrently remain for the next pull
+        popleft = self.raw_samples.popleft
+        return [popleft() for i in range(len(self.raw_samples))]
     def clear_queue(self):
         self.pull_queue()
 
@@ -198,17 +269,134 @@ class ClockSyncRegression:
         inv_freq = clock_to_print_time(base_mcu + inv_cfreq) - base_time
         return base_time, base_chip, inv_freq
 
+# Helper to share sensor_bulk_status queries between all the sensors
+# on an mcu.  A sensor requests a status update before processing each
+# batch.  The queries of every sensor waiting for an update are sent
+# together (so that they share a single round trip to the mcu) and a
+# sensor that already received an update skips its own query.
+class SensorClockService:
+    def __init__(self, mcu):
+        self.mcu = mcu
+        self.printer = mcu.get_printer()
+        self.name = mcu.get_name()
+        self.readers = []
+        self.round_completion = None
+        # Timing statistics
+        self.rounds = self.queries = self.skipped = 0
+        self.last_rtt = self.max_rtt = self.interval_max_rtt = 0.
+    @staticmethod
+    def lookup(mcu):
+        printer = mcu.get_printer()
+        name = "sensor_clock_service " + mcu.get_name()
+        service = printer.lookup_object(name, None)
+        if service is None:
+            service = SensorClockService(mcu)
+            printer.add_object(name, service)
+        return service
+    def start_reader(self, reader):
+        if reader not in self.readers:
+            self.readers.append(reader)
+        reader.need_status = True
+    def stop_reader(self, reader):
+        if reader in self.readers:
+            self.readers.remove(reader)
+    # Make sure the reader received a status update since its last call
+    def update_status(self, reader):
+        while reader.need_status:
+            if self.round_completion is not None:
+                # Wait for the round already in progress
+                self.round_completion.wait()
+                continue
+            readers = [r for r in self.readers if r.need_status]
+            if reader not in readers:
+                readers.append(reader)
+            errors = self._query_round(readers)
+            if reader in errors:
+                raise errors[reader]
+        reader.need_status = True
+    def _query_round(self, readers):
+        reactor = self.printer.get_reactor()
+        self.round_completion = reactor.completion()
+        def query_status(eventtime, reader):
+            try:
+                return reader.query_status_cmd.send([reader.oid]), None
+            except self.printer.command_error as e:
+                return None, e
+        errors = {}
+        try:
+            # Issue all queries before waiting on any of the responses
+            completions = [(reader, reactor.register_callback(
+                (lambda e, r=reader: query_status(e, r))))
+                           for reader in readers]
+            for reader, completion in completions:
+                params, err = completion.wait()
+                if err is not None:
+                    errors[reader] = err
+                    continue
+                self.queries += 1
+                self._note_rtt(params)
+                if not reader.handle_status(params):
+                    self.skipped += 1
+                reader.need_status = False
+            self.rounds += 1
+        finally:
+            completion = self.round_completion
+            self.round_completion = None
+            completion.complete(None)
+        return errors
+    def _note_rtt(self, params):
+        rtt = params['#receive_time'] - params['#sent_time']
+        if rtt > 0.:
+            self.last_rtt = rtt
+            self.max_rtt = max(self.max_rtt, rtt)
+            self.interval_max_rtt = max(self.interval_max_rtt, rtt)
+    def get_status(self, eventtime):
+        return {'sensors': len(self.readers), 'rounds': self.rounds,
+                'queries': self.queries, 'skipped': self.skipped,
+                'last_rtt': self.last_rtt, 'max_rtt': self.max_rtt}
+    def stats(self, eventtime):
+        max_rtt = self.interval_max_rtt
+        self.interval_max_rtt = 0.
+        return (False, "sensor_clock_%s: rounds=%d queries=%d skipped=%d"
+                " max_rtt=%.6f" % (self.name, self.rounds, self.queries,
+                                   self.skipped, max_rtt))
+
 MAX_BULK_MSG_SIZE = 51
 
+# Find an array.array typecode able to decode a struct format made of a
+# single repeated integer type (eg, ">hhh").  Returns (typecode, swap).
+def _lookup_array_decode(unpack_fmt):
+    byteorder = sys.byteorder
+    fmt = unpack_fmt
+    if fmt[:1] in '<>!=@':
+        byteorder = {'<': 'little', '>': 'big', '!': 'big'}.get(fmt[:1],
+                                                                 byteorder)
+        fmt = fmt[1:]
+    if not fmt or fmt.strip(fmt[0]) or fmt[0] not in 'bBhHiIlLqQ':
+        return None, False
+    size = struct.calcsize(unpack_fmt) // len(fmt)
+    for typecode in 'bhilq':
+        if fmt[0].isupper():
+            typecode = typecode.upper()
+        if array.array(typecode).itemsize == size:
+            return typecode, byteorder != sys.byteorder
+    return None, False
+
 # Read sensor_bulk_data and calculate timestamps for devices that take
 # samples at a fixed frequency (and produce fixed data size samples).
 class FixedFreqReader:
     def __init__(self, mcu, chip_clock_smooth, unpack_fmt):
         self.mcu = mcu
         self.clock_sync = ClockSyncRegression(mcu, chip_clock_smooth)
+        self.clock_service = SensorClockService.lookup(mcu)
+        self.need_status = True
+        self.need_reset = False
         unpack = struct.Struct(unpack_fmt)
-        self.unpack_from = unpack.unpack_from
+        self.iter_unpack = unpack.iter_unpack
         self.bytes_per_sample = unpack.size
+        self.fields_per_sample = len(unpack.unpack(bytes(unpack.size)))
+        self.array_typecode, self.array_swap = _lookup_array_decode(
+            unpack_fmt)
         self.samples_per_block = MAX_BULK_MSG_SIZE // self.bytes_per_sample
         self.last_sequence = self.max_query_duration = 0
         self.last_overflows = 0
@@ -233,13 +421,16 @@ class FixedFreqReader:
         self.bulk_queue.clear_queue()
         # Set initial clock
         self._clear_duration_filter()
-        self._update_clock(is_reset=True)
+        self.need_reset = True
+        self.clock_service.start_reader(self)
+        self.clock_service.update_status(self)
         self._clear_duration_filter()
     def note_end(self):
+        self.clock_service.stop_reader(self)
         # Clear local queue (free no longer needed memory)
         self.bulk_queue.clear_queue()
-    def _update_clock(self, is_reset=False):
-        params = self.query_status_cmd.send([self.oid])
+    # Process a sensor_bulk_status response (from SensorClockService)
+    def handle_status(self, params):
         mcu_clock = self.mcu.clock32_to_clock64(params['clock'])
         seq_diff = (params['next_sequence'] - self.last_sequence) & 0xffff
         self.last_sequence += seq_diff
@@ -251,7 +442,7 @@ class FixedFreqReader:
             # Skip measurement as a high query time could skew clock tracking
             self.max_query_duration = max(2 * self.max_query_duration,
                                           self.mcu.seconds_to_clock(.000005))
-            return
+            return False
         self.max_query_duration = 2 * duration
         msg_count = (self.last_sequence * self.samples_per_block
                      + buffered // self.bytes_per_sample)
@@ -260,38 +451,68 @@ class FixedFreqReader:
         # of hardware processing time.
         chip_clock = msg_count + 1
         avg_mcu_clock = mcu_clock + duration // 2
-        if is_reset:
+        if self.need_reset:
             self.clock_sync.reset(avg_mcu_clock, chip_clock)
+            self.need_reset = False
         else:
             self.clock_sync.update(avg_mcu_clock, chip_clock)
-    # Convert sensor_bulk_data responses into list of samples
-    def pull_samples(self):
+        return True
+    # Convert a block of sample data to one sequence per sample field
+    def _decode_columns(self, data):
+        fields = self.fields_per_sample
+        if self.array_typecode is None:
+            udata = list(self.iter_unpack(data))
+            return [[u[i] for u in udata] for i in range(fields)]
+        adata = array.array(self.array_typecode, data)
+        if self.array_swap:
+            adata.byteswap()
+        return [adata[i::fields] for i in range(fields)]
+    # Convert sensor_bulk_data responses into sample times and columns
+    def pull_columns(self):
         # Query MCU for sample timing and update clock synchronization
-        self._update_clock()
+        self.clock_service.update_status(self)
         # Pull sensor_bulk_data messages from local queue
         raw_samples = self.bulk_queue.pull_queue()
         if not raw_samples:
-            return []
+            return [], [[] for i in range(self.fields_per_sample)]
         # Load variables to optimize inner loop below
         last_sequence = self.last_sequence
         time_base, chip_base, inv_freq = self.clock_sync.get_time_translation()
-        unpack_from = self.unpack_from
         bytes_per_sample = self.bytes_per_sample
         samples_per_block = self.samples_per_block
-        # Process every message in raw_samples
-        count = seq = 0
-        samples = [None] * (len(raw_samples) * samples_per_block)
+        # Calculate sample times and gather data of every message
+        times = []
+        blocks = []
+        seq = last_index = 0
         for params in raw_samples:
             seq_diff = (params['sequence'] - last_sequence) & 0xffff
             seq_diff -= (seq_diff & 0x8000) << 1
             seq = last_sequence + seq_diff
             msg_cdiff = seq * samples_per_block - chip_base
             data = params['data']
-            for i in range(len(data) // bytes_per_sample):
-                ptime = time_base + (msg_cdiff + i) * inv_freq
-                udata = unpack_from(data, i * bytes_per_sample)
-                samples[count] = (ptime,) + udata
-                count += 1
-        self.clock_sync.set_last_chip_clock(seq * samples_per_block + i)
-        del samples[count:]
-        return samples
+            count = len(data) // bytes_per_sample
+            if not count:
+                continue
+            times.extend([time_base + (msg_cdiff + i) * inv_freq
+                          for i in range(count)])
+            blocks.append(data[:count * bytes_per_sample])
+            last_index = count - 1
+        self.clock_sync.set_last_chip_clock(seq * samples_per_block
+                                            + last_index)
+        # Decode all sample data at once
+        return times, self._decode_columns(b"".join(blocks))
+    # Convert sensor_bulk_data responses into list of samples
+    def pull_samples(self):
+        times, columns = self.pull_columns()
+        return list(zip(times, *columns))
+
+# Lookup of rounded and scaled values for sensors that report a limited
+# range of integer measurements (avoids a round() call per sample)
+class ScaledValueCache(dict):
+    def __init__(self, scale, ndigits):
+        dict.__init__(self)
+        self.scale = scale
+        self.ndigits = ndigits
+    def __missing__(self, raw):
+        val = self[raw] = round(raw * self.scale, self.ndigits)
+        return val
@@ -5,6 +5,9 @@
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging
 
+# Minimum number of bits in a canbus frame (excluding data)
+CANBUS_FRAME_BITS = (1 + 11 + 3 + 4) + (16 + 2 + 7 + 3)
+
 class PrinterCANBusStats:
     def __init__(self, config):
         self.printer = config.get_printer()
@@ -14,6 +17,9 @@ class PrinterCANBusStats:
         self.get_canbus_status_cmd = None
         self.status = {'rx_error': None, 'tx_error': None, 'tx_retries': None,
                        'bus_state': None}
+        self.canbus_frequency = None
+        self.last_host_stats = None
+        self.host_status = {}
         self.printer.register_event_handler("klippy:connect",
                                             self.handle_connect)
         self.printer.register_event_handler("klippy:shutdown",
@@ -30,8 +36,12 @@ class PrinterCANBusStats:
         if mcu_name != 'mcu':
             mcu_name = 'mcu ' + mcu_name
         self.mcu = self.printer.lookup_object(mcu_name)
+        self.canbus_frequency = self.mcu.get_constants().get(
+            'CANBUS_FREQUENCY')
         # Lookup status query command
         if self.mcu.try_lookup_command("get_canbus_status") is None:
+            self.reactor.register_timer(self.host_query_event,
+                                        self.reactor.NOW)
             return
         self.get_canbus_status_cmd = self.mcu.lookup_query_command(
             "get_canbus_status",
@@ -50,7 +60,39 @@ class PrinterCANBusStats:
         else:
             logging.warning("USB CANBUS bridge '%s' is no longer discarding."
                             % (self.name,))
+    def _update_host_stats(self, eventtime):
+        # Summarize the host side canbus transport statistics
+        last_stats = self.mcu.get_status(eventtime).get('last_stats', {})
+        if 'can_frames_write' not in last_stats:
+            return
+        keys = ['can_frames_write', 'can_frames_read', 'bytes_write',
+                'bytes_read', 'bytes_retransmit']
+        host_stats = [eventtime] + [last_stats.get(k, 0) for k in keys]
+        prev_stats = self.last_host_stats
+        self.last_host_stats = host_stats
+        tx_frames, rx_frames, tx_bytes, rx_bytes, retransmit = host_stats[1:]
+        status = {'host_tx_frames': tx_frames, 'host_rx_frames': rx_frames,
+                  'host_bytes_retransmit': retransmit,
+                  'host_tx_frame_fill': 0., 'host_bus_utilization': 0.,
+                  'host_rtt_histogram': self.mcu.get_rtt_histogram()}
+        if tx_frames:
+            status['host_tx_frame_fill'] = round(
+                (tx_bytes + retransmit) / (tx_frames * 8.), 3)
+        if prev_stats is not None and self.canbus_frequency:
+            deltas = [(cur - prev) & 0xffffffff
+                      for cur, prev in zip(host_stats[1:], prev_stats[1:])]
+            frames = deltas[0] + deltas[1]
+            bits = frames * CANBUS_FRAME_BITS + sum(deltas[2:]) * 8
+            duration = eventtime - prev_stats[0]
+            if duration > 0.:
+                util = bits / (duration * float(self.canbus_frequency))
+                status['host_bus_utilization'] = round(util, 4)
+        self.host_status = status
+    def host_query_event(self, eventtime):
+        self._update_host_stats(eventtime)
+        return eventtime + 1.
     def query_event(self, eventtime):
+        self._update_host_stats(eventtime)
         prev_rx = self.status['rx_error']
         prev_tx = self.status['tx_error']
         prev_retries = self.status['tx_retries']
@@ -74,7 +116,11 @@ class PrinterCANBusStats:
                 % (self.name, status['bus_state'], status['rx_error'],
                    status['tx_error'], status['tx_retries']))
     def get_status(self, eventtime):
-        return self.status
+        if not self.host_status:
+            return self.status
+        status = dict(self.status)
+        status.update(self.host_status)
+        return status
 
 def load_config_prefix(config):
     return PrinterCANBusStats(config)
@@ -5,22 +5,162 @@
 # Copyright (C) 2018  Eric Callahan <arksine.code@gmail.com>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, os, ast
-from . import aip31068_spi, hd44780, hd44780_spi, st7920, uc1701, menu
+import logging, os, ast, importlib, copy
+from .. import gcode_macro
 
 # Normal time between each screen redraw
 REDRAW_TIME = 0.500
 # Minimum time between screen redraws
 REDRAW_MIN_TIME = 0.100
 
+# Low-level lcd drivers (module, class) - imported only when used
 LCD_chips = {
-    'st7920': st7920.ST7920, 'emulated_st7920': st7920.EmulatedST7920,
-    'hd44780': hd44780.HD44780, 'uc1701': uc1701.UC1701,
-    'ssd1306': uc1701.SSD1306, 'sh1106': uc1701.SH1106,
-    'hd44780_spi': hd44780_spi.hd44780_spi,
-    'aip31068_spi':aip31068_spi.aip31068_spi
+    'st7920': ('st7920', 'ST7920'),
+    'emulated_st7920': ('st7920', 'EmulatedST7920'),
+    'hd44780': ('hd44780', 'HD44780'), 'uc1701': ('uc1701', 'UC1701'),
+    'ssd1306': ('uc1701', 'SSD1306'), 'sh1106': ('uc1701', 'SH1106'),
+    'hd44780_spi': ('hd44780_spi', 'hd44780_spi'),
+    'aip31068_spi': ('aip31068_spi', 'aip31068_spi')
 }
 
+def load_display_module(module_name):
+    return importlib.import_module('.' + module_name, 'extras.display')
+
+# Marker for status objects and fields that are not present
+MISSING = object()
+
+def get_status_field(status, key):
+    if key is None:
+        return status
+    if not isinstance(status, dict):
+        return MISSING
+    return status.get(key, MISSING)
+
+def snapshot_field(value):
+    if value is MISSING:
+        return value
+    return copy.deepcopy(value)
+
+# Status view that records which fields a display template reads
+class TrackedStatusDict(gcode_macro.StatusDict):
+    def __init__(self, status, obj_name, wrapper):
+        gcode_macro.StatusDict.__init__(self, status)
+        self._obj_name = obj_name
+        self._wrapper = wrapper
+    def _note(self, key):
+        self._wrapper.note_field(self._obj_name, key)
+    def __getitem__(self, key):
+        self._note(key)
+        return gcode_macro.StatusDict.__getitem__(self, key)
+    def __contains__(self, key):
+        self._note(key)
+        return dict.__contains__(self, key)
+    # Operations on the full set of keys depend on the whole status
+    def __iter__(self):
+        self._note(None)
+        return dict.__iter__(self)
+    def __len__(self):
+        self._note(None)
+        return dict.__len__(self)
+    def keys(self):
+        self._note(None)
+        return dict.keys(self)
+    def items(self):
+        self._note(None)
+        return gcode_macro.StatusDict.items(self)
+    def values(self):
+        self._note(None)
+        return gcode_macro.StatusDict.values(self)
+    def copy(self):
+        self._note(None)
+        return gcode_macro.StatusDict.copy(self)
+    def popitem(self):
+        self._note(None)
+        return gcode_macro.StatusDict.popitem(self)
+    # Printing or comparing the object reads every field (at C level)
+    def __repr__(self):
+        self._note(None)
+        return dict.__repr__(self)
+    def __str__(self):
+        self._note(None)
+        return dict.__repr__(self)
+    def __eq__(self, other):
+        self._note(None)
+        return dict.__eq__(self, other)
+    def __ne__(self, other):
+        self._note(None)
+        return dict.__ne__(self, other)
+
+# Template "printer" wrapper that tracks the status fields read while
+# rendering each display_data item
+class TrackedStatusWrapper(gcode_macro.GetStatusWrapper):
+    def __init__(self, printer, eventtime):
+        gcode_macro.GetStatusWrapper.__init__(self, printer, eventtime)
+        self.raw_status = {}
+        self.fields = None
+        self.untracked = False
+    def get_raw_status(self, name):
+        if name in self.raw_status:
+            return self.raw_status[name]
+        po = self.printer.lookup_object(name, None)
+        if po is None or not hasattr(po, 'get_status'):
+            status = MISSING
+        else:
+            status = po.get_status(self.eventtime)
+        self.raw_status[name] = status
+        return status
+    def note_field(self, name, key):
+        if self.fields is not None:
+            self.fields.setdefault(name, set()).add(key)
+    def __getitem__(self, val):
+        sval = str(val).strip()
+        if self.fields is not None:
+            self.fields.setdefault(sval, set())
+        res = self.cache.get(sval)
+        if res is None:
+            status = self.get_raw_status(sval)
+            if status is MISSING:
+                raise KeyError(val)
+            if isinstance(status, dict):
+                res = TrackedStatusDict(status, sval, self)
+            else:
+                res = gcode_macro.wrap_status(status)
+            self.cache[sval] = res
+        if not isinstance(res, TrackedStatusDict):
+            self.note_field(sval, None)
+        return res
+    def __iter__(self):
+        self.untracked = True
+        return gcode_macro.GetStatusWrapper.__iter__(self)
+    # Dependency tracking of a single render
+    def start_tracking(self):
+        self.fields = {}
+        self.untracked = False
+    def finish_tracking(self):
+        fields, self.fields = self.fields, None
+        if self.untracked:
+            return None
+        deps = []
+        for name, keys in fields.items():
+            if not keys:
+                # The object was used without reading any tracked
+                # field - assume it depends on the whole status
+                keys = [None]
+            status = self.get_raw_status(name)
+            deps.append((name, status is MISSING, [
+                (key, snapshot_field(get_status_field(status, key)))
+                for key in keys]))
+        return deps
+    def check_unchanged(self, deps):
+        for name, is_missing, fields in deps:
+            status = self.get_raw_status(name)
+            if (status is MISSING) != is_missing:
+                return False
+            for key, value in fields:
+                if get_status_field(status, key) != value:
+                    return False
+        return True
+
 # Storage of [display_template my_template] config sections
 class DisplayTemplate:
     def __init__(self, config):
@@ -75,15 +215,38 @@ class DisplayGroup:
             if c.get('text'):
                 template = gcode_macro.load_template(c, 'text')
                 self.data_items.append((row, col, template))
+        self.printer = printer
+        # Last render of each data item: (status deps, text, progress bars)
+        self.render_cache = {}
     def show(self, display, templates, eventtime):
+        status = TrackedStatusWrapper(self.printer, eventtime)
         context = self.data_items[0][2].create_template_context(eventtime)
-        context['draw_progress_bar'] = display.draw_progress_bar
+        context['printer'] = status
+        progress_bars = []
+        def draw_progress_bar(row, col, width, value):
+            progress_bars.append((row, col, width, value))
+            return display.draw_progress_bar(row, col, width, value)
+        context['draw_progress_bar'] = draw_progress_bar
         def render(name, **kwargs):
             return templates[name].render(context, **kwargs)
         context['render'] = render
-        for row, col, template in self.data_items:
-            text = template.render(context)
-            display.draw_text(row, col, text.replace('\n', ''), eventtime)
+        for i, (row, col, template) in enumerate(self.data_items):
+            # Only re-render items whose referenced status has changed
+            cache = self.render_cache.get(i)
+            if cache is not None and status.check_unchanged(cache[0]):
+                deps, text, bars = cache
+                for bar in bars:
+                    display.draw_progress_bar(*bar)
+                template.note_cached_render(text)
+            else:
+                self.render_cache.pop(i, None)
+                del progress_bars[:]
+                status.start_tracking()
+                text = template.render(context).replace('\n', '')
+                deps = status.finish_tracking()
+                if deps is not None:
+                    self.render_cache[i] = (deps, text, list(progress_bars))
+            display.draw_text(row, col, text, eventtime)
         context.clear() # Remove circular references for better gc
 
 # Global cache of DisplayTemplate, DisplayGroup, and glyphs
@@ -178,12 +341,15 @@ class PrinterLCD:
         self.printer = config.get_printer()
         self.reactor = self.printer.get_reactor()
         # Load low-level lcd handler
-        self.lcd_chip = config.getchoice('lcd_type', LCD_chips)(config)
+        module_name, class_name = config.getchoice('lcd_type', LCD_chips)
+        lcd_class = getattr(load_display_module(module_name), class_name)
+        self.lcd_chip = lcd_class(config)
         # Load menu and display_status
         self.menu = None
         name = config.get_name()
         if name == 'display':
             # only load menu for primary display
+            menu = load_display_module('menu')
             self.menu = menu.MenuManager(config, self)
         self.printer.load_object(config, "display_status")
         # Configurable display
@@ -3,14 +3,110 @@
 # Copyright (C) 2018-2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import traceback, logging, ast, copy, json
-import jinja2
+import traceback, logging, ast, json
+import jinja2, jinja2.meta
 
 
 ######################################################################
 # Template handling
 ######################################################################
 
+# Lazily copied views of get_status() results.  Each dict or list is
+# copied only when a template first accesses it, so templates can not
+# alter printer state and unused parts of large results (such as
+# configfile settings) are never copied.  Every path that returns the
+# contained values (including C level copies such as dict(x) and list
+# concatenation) must go through the wrapping __getitem__ methods.
+def wrap_status(value):
+    if isinstance(value, (StatusDict, StatusList)):
+        return value
+    if isinstance(value, dict):
+        return StatusDict(value)
+    if isinstance(value, list):
+        return StatusList(value)
+    if isinstance(value, tuple):
+        if not any([isinstance(v, (dict, list, tuple, set)) for v in value]):
+            return value
+        items = [wrap_status(v) for v in value]
+        if hasattr(value, '_make'):
+            return value._make(items)
+        return tuple(items)
+    if isinstance(value, set):
+        return set(value)
+    return value
+
+class StatusDict(dict):
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        wvalue = wrap_status(value)
+        if wvalue is not value:
+            dict.__setitem__(self, key, wvalue)
+        return wvalue
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        return self[key]
+    def items(self):
+        return [(k, self[k]) for k in dict.keys(self)]
+    def values(self):
+        return [self[k] for k in dict.keys(self)]
+    def copy(self):
+        return StatusDict(self.items())
+    def pop(self, key, *args):
+        if key not in self:
+            return dict.pop(self, key, *args)
+        value = self[key]
+        dict.__delitem__(self, key)
+        return value
+    def popitem(self):
+        key, value = dict.popitem(self)
+        return key, wrap_status(value)
+    def setdefault(self, key, default=None):
+        if key not in self:
+            dict.__setitem__(self, key, default)
+        return self[key]
+    def __iter__(self):
+        # Overriding the dict iterator makes dict(x), {**x}, and
+        # update(x) fetch each value with __getitem__
+        return iter(list(dict.keys(self)))
+    def __or__(self, other):
+        res = dict(self)
+        res.update(other)
+        return res
+    def __ror__(self, other):
+        res = dict(other)
+        res.update(self)
+        return res
+
+class StatusList(list):
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        value = list.__getitem__(self, index)
+        wvalue = wrap_status(value)
+        if wvalue is not value:
+            list.__setitem__(self, index, wvalue)
+        return wvalue
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+    def __reversed__(self):
+        for i in range(len(self)-1, -1, -1):
+            yield self[i]
+    def copy(self):
+        return StatusList(self)
+    def __add__(self, other):
+        return list(self) + other
+    def __radd__(self, other):
+        return other + list(self)
+    def __mul__(self, count):
+        return list(self) * count
+    __rmul__ = __mul__
+    def pop(self, index=-1):
+        value = self[index]
+        list.pop(self, index)
+        return value
+
 # Wrapper for access to printer object get_status() methods
 class GetStatusWrapper:
     def __init__(self, printer, eventtime=None):
@@ -26,7 +122,7 @@ class GetStatusWrapper:
             raise KeyError(val)
         if self.eventtime is None:
             self.eventtime = self.printer.get_reactor().monotonic()
-        self.cache[sval] = res = copy.deepcopy(po.get_status(self.eventtime))
+        self.cache[sval] = res = wrap_status(po.get_status(self.eventtime))
         return res
     def __contains__(self, val):
         try:
@@ -43,7 +139,13 @@ class GetStatusWrapper:
 class TemplateWrapper:
     def __init__(self, printer, env, name, script):
         self.printer = printer
+        self.reactor = printer.get_reactor()
+        self.env = env
         self.name = name
+        self.script = script
+        self.render_count = self.cached_count = 0
+        self.render_time = self.max_render_time = 0.
+        self.output_size = self.last_output_size = 0
         self.gcode = self.printer.lookup_object('gcode')
         gcode_macro = self.printer.lookup_object('gcode_macro')
         self.create_template_context = gcode_macro.create_template_context
@@ -60,16 +162,39 @@ class TemplateWrapper:
                  name, traceback.format_exception_only(type(e), e)[-1])
             logging.exception(msg)
             raise printer.config_error(msg)
+    def get_referenced_names(self):
+        return jinja2.meta.find_undeclared_variables(
+            self.env.parse(self.script))
     def render(self, context=None):
         if context is None:
             context = self.create_template_context()
+        start_time = self.reactor.monotonic()
         try:
-            return str(self.template.render(context))
+            res = str(self.template.render(context))
         except Exception as e:
             msg = "Error evaluating '%s': %s" % (
                 self.name, traceback.format_exception_only(type(e), e)[-1])
             logging.exception(msg)
             raise self.gcode.error(msg)
+        render_time = self.reactor.monotonic() - start_time
+        self.render_count += 1
+        self.render_time += render_time
+        self.max_render_time = max(self.max_render_time, render_time)
+        self.note_output(res)
+        return res
+    def note_output(self, res):
+        self.output_size += len(res)
+        self.last_output_size = len(res)
+    def note_cached_render(self, res):
+        self.cached_count += 1
+        self.note_output(res)
+    def get_render_stats(self):
+        return {'render_count': self.render_count,
+                'cached_count': self.cached_count,
+                'render_time': round(self.render_time, 6),
+                'max_render_time': round(self.max_render_time, 6),
+                'output_size': self.output_size,
+                'last_output_size': self.last_output_size}
     def run_gcode_from_command(self, context=None):
         self.gcode.run_script_from_command(self.render(context))
 
@@ -78,13 +203,19 @@ class PrinterGCodeMacro:
     def __init__(self, config):
         self.printer = config.get_printer()
         self.env = jinja2.Environment('{%', '%}', '{', '}')
+        self.templates = []
     def load_template(self, config, option, default=None):
         name = "%s:%s" % (config.get_name(), option)
         if default is None:
             script = config.get(option)
         else:
             script = config.get(option, default)
-        return TemplateWrapper(self.printer, self.env, name, script)
+        template = TemplateWrapper(self.printer, self.env, name, script)
+        self.templates.append(template)
+        return template
+    def get_status(self, eventtime):
+        return {'render_stats': {t.name: t.get_render_stats()
+                                 for t in self.templates}}
     def _action_emergency_stop(self, msg="action_emergency_stop"):
         self.printer.invoke_shutdown("Shutdown due to %s" % (msg,))
         return ""
@@ -117,6 +248,9 @@ def load_config(config):
 # GCode macro
 ######################################################################
 
+# Maximum number of cached renders kept for each cache_render macro
+RENDER_CACHE_SIZE = 32
+
 class GCodeMacro:
     def __init__(self, config):
         if len(config.get_name().split()) > 2:
@@ -157,6 +291,18 @@ class GCodeMacro:
                 raise config.error(
                     "Option '%s' in section '%s' is not a valid literal: %s" % (
                         option, config.get_name(), e))
+        # Optional caching of rendered output for templates that only
+        # depend on their parameters and variables
+        self.render_cache = None
+        if config.getboolean('cache_render', False):
+            pure_names = set(['params', 'rawparams']) | set(self.variables)
+            extra = self.template.get_referenced_names() - pure_names
+            if extra:
+                raise config.error(
+                    "Option 'cache_render' in section '%s' not valid as"
+                    " template references: %s"
+                    % (config.get_name(), ", ".join(sorted(extra))))
+            self.render_cache = {}
     def handle_connect(self):
         prev_cmd = self.gcode.register_command(self.alias, None)
         if prev_cmd is None:
@@ -192,9 +338,26 @@ class GCodeMacro:
         kwparams['rawparams'] = gcmd.get_raw_command_parameters()
         self.in_script = True
         try:
-            self.template.run_gcode_from_command(kwparams)
+            if self.render_cache is None:
+                self.template.run_gcode_from_command(kwparams)
+            else:
+                self._run_cached(kwparams)
         finally:
             self.in_script = False
+    def _run_cached(self, kwparams):
+        # Variables may hold any python literal (such as sets or dicts
+        # with mixed key types), so the key is built with repr()
+        key = repr((sorted(kwparams['params'].items()), kwparams['rawparams'],
+                    sorted(self.variables.items())))
+        script = self.render_cache.get(key)
+        if script is None:
+            script = self.template.render(kwparams)
+            if len(self.render_cache) >= RENDER_CACHE_SIZE:
+                self.render_cache.clear()
+            self.render_cache[key] = script
+        else:
+            self.template.note_cached_render(script)
+        self.gcode.run_script_from_command(script)
 
 def load_config_prefix(config):
     return GCodeMacro(config)
@@ -46,7 +46,8 @@ class Heater:
         self.next_pwm_time = 0.
         self.last_pwm_value = 0.
         # Setup control algorithm sub-class
-        algos = {'watermark': ControlBangBang, 'pid': ControlPID}
+        algos = {'watermark': ControlBangBang, 'pid': ControlPID,
+                 'model': ControlModel}
         algo = config.getchoice('control', algos)
         self.control = algo(self, config)
         # Setup output heater pin
@@ -57,6 +58,12 @@ class Heater:
                                          maxval=self.pwm_delay)
         self.mcu_pwm.setup_cycle_time(pwm_cycle_time)
         self.mcu_pwm.setup_max_duration(MAX_HEAT_TIME)
+        # Optional limit on the combined power of several heaters
+        self.power_budget = None
+        self.heater_power = config.getfloat('heater_power', None, above=0.)
+        if self.heater_power is not None:
+            pheaters = self.printer.lookup_object('heaters')
+            self.power_budget = pheaters.get_power_budget()
         # Load additional modules
         self.printer.load_object(config, "verify_heater %s" % (short_name,))
         self.printer.load_object(config, "pid_calibrate")
@@ -69,6 +76,8 @@ class Heater:
     def set_pwm(self, read_time, value):
         if self.target_temp <= 0. or read_time > self.verify_mainthread_time:
             value = 0.
+        if self.power_budget is not None:
+            value = self.power_budget.limit_pwm(self, value)
         if ((read_time < self.next_pwm_time or not self.last_pwm_value)
             and abs(value - self.last_pwm_value) < 0.05):
             # No significant change in value - can suppress update
@@ -77,6 +86,8 @@ class Heater:
         self.next_pwm_time = pwm_time + 0.75 * MAX_HEAT_TIME
         self.last_pwm_value = value
         self.mcu_pwm.set_pwm(pwm_time, value)
+        if self.power_budget is not None:
+            self.power_budget.note_pwm(self, value)
         #logging.debug("%s: pwm=%.3f@%.3f (from %.3f@%.3f [%.3f])",
         #              self.name, value, pwm_time,
         #              self.last_temp, self.last_temp_time, self.target_temp)
@@ -102,6 +113,8 @@ class Heater:
         return self.max_power
     def get_smooth_time(self):
         return self.smooth_time
+    def get_heater_power(self):
+        return self.heater_power
     def set_temp(self, degrees):
         if degrees and (degrees < self.min_temp or degrees > self.max_temp):
             raise self.printer.command_error(
@@ -192,14 +205,14 @@ class ControlPID:
         self.Ki = config.getfloat('pid_Ki') / PID_PARAM_BASE
         self.Kd = config.getfloat('pid_Kd') / PID_PARAM_BASE
         self.min_deriv_time = heater.get_smooth_time()
-        self.temp_integ_max = 0.
+        self.temp_integ_min = self.temp_integ_max = 0.
         if self.Ki:
             self.temp_integ_max = self.heater_max_power / self.Ki
         self.prev_temp = AMBIENT_TEMP
         self.prev_temp_time = 0.
         self.prev_temp_deriv = 0.
         self.prev_temp_integ = 0.
-    def temperature_update(self, read_time, temp, target_temp):
+    def calc_output(self, read_time, temp, target_temp):
         time_diff = read_time - self.prev_temp_time
         # Calculate change of temperature
         temp_diff = temp - self.prev_temp
@@ -211,11 +224,18 @@ class ControlPID:
         # Calculate accumulated temperature "error"
         temp_err = target_temp - temp
         temp_integ = self.prev_temp_integ + temp_err * time_diff
-        temp_integ = max(0., min(self.temp_integ_max, temp_integ))
+        temp_integ = max(self.temp_integ_min,
+                         min(self.temp_integ_max, temp_integ))
         # Calculate output
         co = self.Kp*temp_err + self.Ki*temp_integ - self.Kd*temp_deriv
         #logging.debug("pid: %f@%.3f -> diff=%f deriv=%f err=%f integ=%f co=%d",
         #    temp, read_time, temp_diff, temp_deriv, temp_err, temp_integ, co)
+        return co, temp_deriv, temp_integ
+    def temperature_update(self, read_time, temp, target_temp):
+        co, temp_deriv, temp_integ = self.calc_output(
+            read_time, temp, target_temp)
+        self.apply_output(read_time, temp, co, temp_deriv, temp_integ)
+    def apply_output(self, read_time, temp, co, temp_deriv, temp_integ):
         bounded_co = max(0., min(self.heater_max_power, co))
         self.heater.set_pwm(read_time, bounded_co)
         # Store state for next measurement
@@ -230,6 +250,129 @@ class ControlPID:
                 or abs(self.prev_temp_deriv) > PID_SETTLE_SLOPE)
 
 
+######################################################################
+# Model based (feed-forward) control algo
+######################################################################
+
+MODEL_SAMPLE_TIME = 0.500
+
+# Thermal model of the heater:
+#   dT/dt = gain*pwm - (loss + fan_loss*fan_speed)*(T - ambient_temp)
+#           - flow_loss*flow_rate
+# The power needed to hold the target is applied directly and a PID
+# loop corrects for any remaining model error.
+class ControlModel(ControlPID):
+    def __init__(self, heater, config):
+        ControlPID.__init__(self, heater, config)
+        self.printer = config.get_printer()
+        self.gain = config.getfloat('model_gain', above=0.)
+        self.loss = config.getfloat('model_loss', minval=0.)
+        self.ambient_temp = config.getfloat('model_ambient_temp',
+                                            AMBIENT_TEMP)
+        self.fan_loss = config.getfloat('model_fan_loss', 0., minval=0.)
+        self.fan_name = config.get('model_fan', 'fan')
+        self.flow_loss = config.getfloat('model_flow_loss', 0., minval=0.)
+        # Integral term may correct the model in either direction
+        self.temp_integ_min = -self.temp_integ_max
+        # Disturbance tracking (sampled from the main thread)
+        self.fan = self.extruder = self.mcu = None
+        self.fan_speed = self.flow_rate = 0.
+        self.last_e_pos = self.last_e_time = 0.
+        self.sample_timer = None
+        self.printer.register_event_handler("klippy:connect",
+                                            self._handle_connect)
+        self.printer.register_event_handler("klippy:ready",
+                                            self._handle_ready)
+    def _handle_connect(self):
+        if self.fan_loss:
+            self.fan = self.printer.lookup_object(self.fan_name, None)
+            if self.fan is None or not hasattr(self.fan, 'get_status'):
+                raise self.printer.config_error(
+                    "Unknown model_fan '%s' in '%s'"
+                    % (self.fan_name, self.heater.get_name()))
+        if self.flow_loss:
+            extruder = self.printer.lookup_object(self.heater.get_name(),
+                                                  None)
+            if (not hasattr(extruder, 'find_past_position')
+                or extruder.get_heater() is not self.heater):
+                raise self.printer.config_error(
+                    "Option model_flow_loss in '%s' requires an extruder"
+                    % (self.heater.get_name(),))
+            self.extruder = extruder
+            self.mcu = self.printer.lookup_object('mcu')
+    def _handle_ready(self):
+        if self.fan is None and self.extruder is None:
+            return
+        reactor = self.printer.get_reactor()
+        self.sample_timer = reactor.register_timer(self._sample_event,
+                                                   reactor.NOW)
+    def _sample_event(self, eventtime):
+        if self.fan is not None:
+            self.fan_speed = self.fan.get_status(eventtime).get('speed', 0.)
+        if self.extruder is not None:
+            print_time = self.mcu.estimated_print_time(eventtime)
+            e_pos = self.extruder.find_past_position(print_time)
+            time_diff = print_time - self.last_e_time
+            if time_diff > 0.:
+                flow = ((e_pos - self.last_e_pos) / time_diff
+                        * self.extruder.filament_area)
+                self.flow_rate = max(0., flow)
+            self.last_e_pos = e_pos
+            self.last_e_time = print_time
+        return eventtime + MODEL_SAMPLE_TIME
+    def calc_feedforward(self, target_temp):
+        if target_temp <= 0.:
+            return 0.
+        temp_rise = target_temp - self.ambient_temp
+        loss = (self.loss + self.fan_loss * self.fan_speed) * temp_rise
+        return (loss + self.flow_loss * self.flow_rate) / self.gain
+    def temperature_update(self, read_time, temp, target_temp):
+        co, temp_deriv, temp_integ = self.calc_output(
+            read_time, temp, target_temp)
+        co += self.calc_feedforward(target_temp)
+        self.apply_output(read_time, temp, co, temp_deriv, temp_integ)
+
+
+######################################################################
+# Heater power budget
+######################################################################
+
+# Limit the total power of heaters sharing a power supply.  When the
+# requested power exceeds the budget each heater is given a share in
+# proportion to its request, and never more than what the other
+# heaters currently leave available.  Note that verify_heater does
+# not know about the budget, so a heater that is limited for too long
+# may fail its heating rate check.
+class HeaterPowerBudget:
+    def __init__(self, max_power):
+        self.max_power = max_power
+        self.lock = threading.Lock()
+        self.requested = {}
+        self.applied = {}
+    def limit_pwm(self, heater, value):
+        heater_power = heater.get_heater_power()
+        with self.lock:
+            self.requested[heater] = request = value * heater_power
+            total_request = sum(self.requested.values())
+            if total_request <= self.max_power:
+                # Only limit by what other heaters are still using
+                share = request
+            else:
+                share = request * self.max_power / total_request
+            others = sum([p for h, p in self.applied.items()
+                          if h is not heater])
+            power = max(0., min(share, self.max_power - others))
+        return power / heater_power
+    def note_pwm(self, heater, value):
+        with self.lock:
+            self.applied[heater] = value * heater.get_heater_power()
+    def get_status(self):
+        with self.lock:
+            return {'max_power': self.max_power,
+                    'requested_power': round(sum(self.requested.values()), 1),
+                    'applied_power': round(sum(self.applied.values()), 1)}
+
+
 ######################################################################
 # Sensor and heater lookup
 ######################################################################
@@ -244,6 +387,10 @@ class PrinterHeaters:
         self.available_sensors = []
         self.available_monitors = []
         self.has_started = self.have_load_sensors = False
+        self.power_budget = None
+        max_power = config.getfloat('max_heater_power', None, above=0.)
+        if max_power is not None:
+            self.power_budget = HeaterPowerBudget(max_power)
         self.printer.register_event_handler("klippy:ready", self._handle_ready)
         self.printer.register_event_handler("gcode:request_restart",
                                             self.turn_off_all_heaters)
@@ -254,6 +401,8 @@ class PrinterHeaters:
         gcode.register_command("M105", self.cmd_M105, when_not_ready=True)
         gcode.register_command("TEMPERATURE_WAIT", self.cmd_TEMPERATURE_WAIT,
                                desc=self.cmd_TEMPERATURE_WAIT_help)
+        gcode.register_command("WAIT_HEATERS", self.cmd_WAIT_HEATERS,
+                               desc=self.cmd_WAIT_HEATERS_help)
     def load_config(self, config):
         self.have_load_sensors = True
         # Load default temperature sensors
@@ -280,6 +429,8 @@ class PrinterHeaters:
         self.register_sensor(config, heater, gcode_id)
         self.available_heaters.append(config.get_name())
         return heater
+    def get_power_budget(self):
+        return self.power_budget
     def get_all_heaters(self):
         return self.available_heaters
     def lookup_heater(self, heater_name):
@@ -308,9 +459,12 @@ class PrinterHeaters:
     def register_monitor(self, config):
         self.available_monitors.append(config.get_name())
     def get_status(self, eventtime):
-        return {'available_heaters': self.available_heaters,
-                'available_sensors': self.available_sensors,
-                'available_monitors': self.available_monitors}
+        status = {'available_heaters': self.available_heaters,
+                  'available_sensors': self.available_sensors,
+                  'available_monitors': self.available_monitors}
+        if self.power_budget is not None:
+            status['power_budget'] = self.power_budget.get_status()
+        return status
     def turn_off_all_heaters(self, print_time=0.):
         for heater in self.heaters.values():
             heater.set_temp(0.)
@@ -349,6 +503,44 @@ class PrinterHeaters:
             print_time = toolhead.get_last_move_time()
             gcode.respond_raw(self._get_temp(eventtime))
             eventtime = reactor.pause(eventtime + 1.)
+    def wait_for_heaters(self, heaters, tolerances=None, stable_times=None):
+        # Wait until all heaters are at their targets.  A heater is done
+        # once it has been within its tolerance (or no longer
+        # check_busy() if tolerance is None) for its stable time.
+        if self.printer.get_start_args().get('debugoutput') is not None:
+            return
+        if tolerances is None:
+            tolerances = [None] * len(heaters)
+        if stable_times is None:
+            stable_times = [0.] * len(heaters)
+        toolhead = self.printer.lookup_object("toolhead")
+        gcode = self.printer.lookup_object("gcode")
+        reactor = self.printer.get_reactor()
+        stable_start = [None] * len(heaters)
+        eventtime = reactor.monotonic()
+        while not self.printer.is_shutdown():
+            is_done = True
+            for i, heater in enumerate(heaters):
+                temp, target = heater.get_temp(eventtime)
+                if not target:
+                    continue
+                if tolerances[i] is None:
+                    in_range = not heater.check_busy(eventtime)
+                else:
+                    in_range = abs(target - temp) <= tolerances[i]
+                if not in_range:
+                    stable_start[i] = None
+                    is_done = False
+                    continue
+                if stable_start[i] is None:
+                    stable_start[i] = eventtime
+                if eventtime - stable_start[i] < stable_times[i]:
+                    is_done = False
+            if is_done:
+                return
+            print_time = toolhead.get_last_move_time()
+            gcode.respond_raw(self._get_temp(eventtime))
+            eventtime = reactor.pause(eventtime + 1.)
     def set_temperature(self, heater, temp, wait=False):
         toolhead = self.printer.lookup_object('toolhead')
         toolhead.register_lookahead_callback((lambda pt: None))
@@ -382,5 +574,43 @@ class PrinterHeaters:
             gcmd.respond_raw(self._get_temp(eventtime))
             eventtime = reactor.pause(eventtime + 1.)
 
+    def _get_float_list(self, gcmd, name, count, default, minval=None):
+        value = gcmd.get(name, None)
+        if value is None:
+            return [default] * count
+        try:
+            values = [float(v.strip()) for v in value.split(',')]
+        except ValueError:
+            raise gcmd.error("Unable to parse '%s' in %s" % (value, name))
+        if len(values) == 1:
+            values = values * count
+        if len(values) != count:
+            raise gcmd.error("%s must have one value or one per heater"
+                             % (name,))
+        if minval is not None and min(values) < minval:
+            raise gcmd.error("%s must be at least %s" % (name, minval))
+        return values
+    cmd_WAIT_HEATERS_help = "Wait for several heaters to reach their targets"
+    def cmd_WAIT_HEATERS(self, gcmd):
+        names = [n.strip() for n in gcmd.get('HEATERS').split(',')
+                 if n.strip()]
+        heaters = []
+        for name in names:
+            if name not in self.heaters:
+                raise gcmd.error("Unknown heater '%s'" % (name,))
+            heaters.append(self.heaters[name])
+        if not heaters:
+            raise gcmd.error("No heaters specified")
+        targets = self._get_float_list(gcmd, 'TARGETS', len(heaters), None)
+        tolerances = self._get_float_list(gcmd, 'TOLERANCE', len(heaters),
+                                          None, minval=0.)
+        stable_times = self._get_float_list(gcmd, 'STABLE_TIME',
+                                            len(heaters), 0., minval=0.)
+        # Start all heaters before waiting on any of them
+        for heater, target in zip(heaters, targets):
+            if target is not None:
+                self.set_temperature(heater, target)
+        self.wait_for_heaters(heaters, tolerances, stable_times)
+
 def load_config(config):
     return PrinterHeaters(config)
@@ -84,16 +84,19 @@ class HX71xBase:
         self.batch_bulk.add_client(callback)
 
     # Measurement decoding
-    def _convert_samples(self, samples):
+    def _convert_samples(self, times, columns):
         adc_factor = 1. / (1 << 23)
-        count = 0
-        for ptime, val in samples:
-            if val == SAMPLE_ERROR_DESYNC or val == SAMPLE_ERROR_LONG_READ:
-                self.last_error_count += 1
-                break  # additional errors are duplicates
-            samples[count] = (round(ptime, 6), val, round(val * adc_factor, 9))
-            count += 1
-        del samples[count:]
+        vals = columns[0]
+        count = len(vals)
+        for error in [SAMPLE_ERROR_DESYNC, SAMPLE_ERROR_LONG_READ]:
+            if error in vals:
+                count = min(count, vals.index(error))
+        if count < len(vals):
+            self.last_error_count += 1  # additional errors are duplicates
+            times = times[:count]
+            vals = vals[:count]
+        return list(zip([round(t, 6) for t in times], vals,
+                        [round(v * adc_factor, 9) for v in vals]))
 
     # Start, stop, and process message batches
     def _start_measurements(self):
@@ -120,8 +123,8 @@ class HX71xBase:
     def _process_batch(self, eventtime):
         prev_overflows = self.ffreader.get_last_overflows()
         prev_error_count = self.last_error_count
-        samples = self.ffreader.pull_samples()
-        self._convert_samples(samples)
+        times, columns = self.ffreader.pull_columns()
+        samples = self._convert_samples(times, columns)
         overflows = self.ffreader.get_last_overflows() - prev_overflows
         errors = self.last_error_count - prev_error_count
         if errors > 0:
@@ -61,6 +61,7 @@ class ICM20948:
         self.printer = config.get_printer()
         adxl345.AccelCommandHelper(config, self)
         self.axes_map = adxl345.read_axes_map(config, SCALE, SCALE, SCALE)
+        self.axes_converter = adxl345.AxesConverter(self.axes_map)
         self.data_rate = config.getint('rate', 4500)
         if self.data_rate not in SAMPLE_RATE_DIVS:
             raise config.error("Invalid rate parameter: %d" % (self.data_rate,))
@@ -103,17 +104,12 @@ class ICM20948:
         aqh = adxl345.AccelQueryHelper(self.printer)
         self.batch_bulk.add_client(aqh.handle_batch)
         return aqh
+    # add_client interface, direct pass through to bulk_sensor API
+    def add_client(self, client_cb):
+        self.batch_bulk.add_client(client_cb)
     # Measurement decoding
-    def _convert_samples(self, samples):
-        (x_pos, x_scale), (y_pos, y_scale), (z_pos, z_scale) = self.axes_map
-        count = 0
-        for ptime, rx, ry, rz in samples:
-            raw_xyz = (rx, ry, rz)
-            x = round(raw_xyz[x_pos] * x_scale, 6)
-            y = round(raw_xyz[y_pos] * y_scale, 6)
-            z = round(raw_xyz[z_pos] * z_scale, 6)
-            samples[count] = (round(ptime, 6), x, y, z)
-            count += 1
+    def _convert_samples(self, times, columns):
+        return self.axes_converter.convert(times, columns)
     # Start, stop, and process message batches
     def _start_measurements(self):
         # In case of miswiring, testing ICM20948 device ID prevents treating
@@ -159,8 +155,8 @@ class ICM20948:
         self.set_reg(REG_PWR_MGMT_1, SET_PWR_MGMT_1_SLEEP)
         self.set_reg(REG_PWR_MGMT_2, SET_PWR_MGMT_2_OFF)
     def _process_batch(self, eventtime):
-        samples = self.ffreader.pull_samples()
-        self._convert_samples(samples)
+        times, columns = self.ffreader.pull_columns()
+        samples = self._convert_samples(times, columns)
         if not samples:
             return {}
         return {'data': samples, 'errors': self.last_error_count,
@@ -154,15 +154,19 @@ class LDC1612:
         tclock = self.mcu.clock32_to_clock64(params['trigger_clock'])
         return self.mcu.clock_to_print_time(tclock)
     # Measurement decoding
-    def _convert_samples(self, samples):
+    def _convert_samples(self, times, columns):
         freq_conv = float(self.frequency) / (1<<28)
-        count = 0
-        for ptime, val in samples:
-            mv = val & 0x0fffffff
-            if mv != val:
-                self.last_error_count += 1
-            samples[count] = (round(ptime, 6), round(freq_conv * mv, 3), 999.9)
-            count += 1
+        vals = columns[0]
+        if vals and max(vals) > 0x0fffffff:
+            # Error flags are reported in the upper bits
+            self.last_error_count += len([v for v in vals if v > 0x0fffffff])
+            vals = [v & 0x0fffffff for v in vals]
+        freqs = [round(freq_conv * v, 3) for v in vals]
+        if self.calibration is not None:
+            heights = self.calibration.calc_heights(freqs)
+        else:
+            heights = [999.9] * len(freqs)
+        return list(zip([round(t, 6) for t in times], freqs, heights))
     # Start, stop, and process message batches
     def _start_measurements(self):
         # In case of miswiring, testing LDC1612 device ID prevents treating
@@ -198,11 +202,9 @@ class LDC1612:
         self.ffreader.note_end()
         logging.info("LDC1612 finished '%s' measurements", self.name)
     def _process_batch(self, eventtime):
-        samples = self.ffreader.pull_samples()
-        self._convert_samples(samples)
+        times, columns = self.ffreader.pull_columns()
+        samples = self._convert_samples(times, columns)
         if not samples:
             return {}
-        if self.calibration is not None:
-            self.calibration.apply_calibration(samples)
         return {'data': samples, 'errors': self.last_error_count,
                 'overflows': self.ffreader.get_last_overflows()}
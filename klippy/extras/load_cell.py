@@ -7,7 +7,7 @@
 from . import hx71x
 from . import ads1220
 from .bulk_sensor import BatchWebhooksClient
-import collections, itertools
+import collections, itertools, array
 # We want either Python 3's zip() or Python 2's izip() but NOT 2's zip():
 zip_impl = zip
 try:
@@ -292,12 +292,16 @@ class LoadCellSampleCollector:
         self._errors += msg['errors']
         self._overflows += msg['overflows']
         samples = msg['data']
-        for sample in samples:
-            time = sample[0]
-            if self.min_time <= time <= self.max_time:
-                self._samples.append(sample)
-            if time > self.max_time:
+        if not samples:
+            return self.is_started
+        # Batches are in time order - only filter the batches that
+        # overlap the start or end of the collection window
+        if samples[0][0] < self.min_time or samples[-1][0] > self.max_time:
+            if samples[-1][0] > self.max_time:
                 self.is_started = False
+            samples = [s for s in samples
+                       if self.min_time <= s[0] <= self.max_time]
+        self._samples.extend(samples)
         if len(self._samples) >= self.min_count:
             self.is_started = False
         return self.is_started
@@ -357,16 +361,133 @@ class LoadCellSampleCollector:
             return self._finish_collecting()
         return self._collect_until(self.max_time + 1.)
 
+# Fixed capacity ring buffer of the most recent load cell samples.
+# Samples are stored in array columns and selected by their position
+# in the stream of all samples received (the sample "index").  Running
+# statistics of the raw counts are kept over the last 'stats_window'
+# samples.
+class LoadCellSampleBuffer:
+    def __init__(self, capacity, stats_window):
+        self.capacity = capacity
+        self.times = array.array('d', [0.]) * capacity
+        self.forces = array.array('d', [0.]) * capacity
+        self.counts = array.array('d', [0.]) * capacity
+        self.next_index = 0
+        self.errors = self.overflows = 0
+        # Running statistics (counts are integers, so sums are exact)
+        self.stats_window = min(stats_window, capacity)
+        self.stats_sum = self.stats_sumsq = 0
+        self.min_queue = collections.deque()
+        self.max_queue = collections.deque()
+    def _add_count(self, index, counts):
+        self.stats_sum += counts
+        self.stats_sumsq += counts * counts
+        drop_index = index - self.stats_window
+        if drop_index >= 0:
+            old = int(self.counts[drop_index % self.capacity])
+            self.stats_sum -= old
+            self.stats_sumsq -= old * old
+        # Monotonic queues of (index, counts) for windowed min/max
+        min_queue = self.min_queue
+        while min_queue and min_queue[-1][1] >= counts:
+            min_queue.pop()
+        min_queue.append((index, counts))
+        if min_queue[0][0] <= drop_index:
+            min_queue.popleft()
+        max_queue = self.max_queue
+        while max_queue and max_queue[-1][1] <= counts:
+            max_queue.pop()
+        max_queue.append((index, counts))
+        if max_queue[0][0] <= drop_index:
+            max_queue.popleft()
+    # Add a batch of [time, force, counts, tare_counts] samples
+    def add_samples(self, samples, errors=0, overflows=0):
+        self.errors += errors
+        self.overflows += overflows
+        times, forces, counts = self.times, self.forces, self.counts
+        index = self.next_index
+        capacity = self.capacity
+        for sample in samples:
+            sample_counts = int(sample[2])
+            self._add_count(index, sample_counts)
+            pos = index % capacity
+            times[pos] = sample[0]
+            force = sample[1]
+            forces[pos] = force if force is not None else float("nan")
+            counts[pos] = sample_counts
+            index += 1
+        self.next_index = index
+    # Range of sample indexes still available in the buffer
+    def get_index_range(self):
+        return max(0, self.next_index - self.capacity), self.next_index
+    # Index of the first available sample at (or after) the given time
+    def find_index(self, print_time, include_equal=True):
+        low, high = self.get_index_range()
+        times, capacity = self.times, self.capacity
+        while low < high:
+            mid = (low + high) // 2
+            sample_time = times[mid % capacity]
+            if sample_time < print_time or (sample_time == print_time
+                                             and not include_equal):
+                low = mid + 1
+            else:
+                high = mid
+        return low
+    # Index range of the available samples between two times (inclusive)
+    def find_window(self, start_time, end_time):
+        return (self.find_index(start_time),
+                self.find_index(end_time, include_equal=False))
+    # Views (without copying) of a column between two sample indexes.
+    # Returns one or two segments as the ring buffer may wrap around.
+    def get_column(self, column, start, end):
+        low, high = self.get_index_range()
+        if start < low or end > high:
+            raise ValueError("Load cell samples no longer available")
+        data = memoryview({'time': self.times, 'force': self.forces,
+                           'counts': self.counts}[column])
+        if start >= end:
+            return [data[0:0]]
+        capacity = self.capacity
+        start_pos, end_pos = start % capacity, (end - 1) % capacity + 1
+        if start_pos < end_pos:
+            return [data[start_pos:end_pos]]
+        return [data[start_pos:], data[:end_pos]]
+    # Returns (count, mean, variance, min, max) of a column
+    def get_stats(self, column, start, end):
+        segments = self.get_column(column, start, end)
+        count = end - start
+        if count <= 0:
+            return 0, 0., 0., 0., 0.
+        mean = sum([sum(seg) for seg in segments]) / count
+        variance = sum([sum([(v - mean)**2 for v in seg])
+                        for seg in segments]) / count
+        min_val = min([min(seg) for seg in segments if len(seg)])
+        max_val = max([max(seg) for seg in segments if len(seg)])
+        return count, mean, variance, min_val, max_val
+    # Running (count, mean, variance, min, max) of the counts over the
+    # most recent samples
+    def get_running_stats(self):
+        count = min(self.next_index, self.stats_window)
+        if not count:
+            return 0, 0., 0., 0., 0.
+        mean = float(self.stats_sum) / count
+        variance = (float(self.stats_sumsq * count - self.stats_sum**2)
+                    / (count * count))
+        return (count, mean, variance,
+                self.min_queue[0][1], self.max_queue[0][1])
+
 # Printer class that controls the load cell
 MIN_COUNTS_PER_GRAM = 1.
+SAMPLE_BUFFER_TIME = 2.
 class LoadCell:
     def __init__(self, config, sensor):
         self.printer = printer = config.get_printer()
         self.config_name = config.get_name()
         self.name = config.get_name().split()[-1]
         self.sensor = sensor   # must implement BulkSensorAdc
-        buffer_size = sensor.get_samples_per_second() // 2
-        self._force_buffer = collections.deque(maxlen=buffer_size)
+        sps = sensor.get_samples_per_second()
+        self._sample_buffer = LoadCellSampleBuffer(
+            int(sps * SAMPLE_BUFFER_TIME), sps // 2)
         self.reference_tare_counts = config.getint('reference_tare_counts',
                                                    default=None)
         self.tare_counts = self.reference_tare_counts
@@ -385,7 +506,6 @@ class LoadCell:
 
     def _handle_ready(self):
         self.sensor.add_client(self._sensor_data_event)
-        self.add_client(self._track_force)
         # announce calibration status on ready
         if self.is_calibrated():
             self.printer.send_event("load_cell:calibrate", self)
@@ -399,11 +519,15 @@ class LoadCell:
         overflows = msg.get("overflows")
         if data is None:
             return None
-        samples = []
-        for row in data:
-            # [time, grams, counts, tare_counts]
-            samples.append([row[0], self.counts_to_grams(row[1]), row[1],
-                            self.tare_counts])
+        # [time, grams, counts, tare_counts]
+        tare_counts = self.tare_counts
+        if self.is_calibrated() and self.is_tared():
+            invert, cpg = self.invert, self.counts_per_gram
+            samples = [[row[0], invert * (float(row[1] - tare_counts) / cpg),
+                        row[1], tare_counts] for row in data]
+        else:
+            samples = [[row[0], None, row[1], tare_counts] for row in data]
+        self._sample_buffer.add_samples(samples, errors or 0, overflows or 0)
         msg = {'data': samples, 'errors': errors, 'overflows': overflows}
         self.clients.send(msg)
         return True
@@ -451,35 +575,47 @@ class LoadCell:
     def avg_counts(self, num_samples=None):
         if num_samples is None:
             num_samples = self.sensor.get_samples_per_second()
-        samples, errors = self.get_collector().collect_min(num_samples)
+        buf = self._sample_buffer
+        if num_samples > buf.capacity:
+            raise self.printer.command_error(
+                "Unable to average %i load cell samples" % (num_samples,))
+        # Wait for new samples to arrive in the sample buffer
+        start = buf.next_index
+        errors = buf.errors + buf.overflows
+        reactor = self.printer.get_reactor()
+        mcu = self.sensor.get_mcu()
+        print_time = mcu.estimated_print_time(reactor.monotonic())
+        sps = self.sensor.get_samples_per_second()
+        timeout = print_time + 1. + (num_samples / sps)
+        while buf.next_index < start + num_samples:
+            now = reactor.monotonic()
+            if mcu.estimated_print_time(now) > timeout:
+                raise self.printer.command_error(
+                    "Timed out waiting for load cell samples")
+            reactor.pause(now + RETRY_DELAY)
+        errors = buf.errors + buf.overflows - errors
         if errors:
             raise self.printer.command_error(
-                "Sensor reported %i errors while sampling"
-                    % (errors[0] + errors[1]))
+                "Sensor reported %i errors while sampling" % (errors,))
         # check samples for saturated readings
+        count, mean, variance, min_counts, max_counts = buf.get_stats(
+            'counts', start, start + num_samples)
         range_min, range_max = self.saturation_range()
-        for sample in samples:
-            if sample[2] >= range_max or sample[2] <= range_min:
-                raise self.printer.command_error(
-                    "Some samples are saturated (+/-100%)")
-        return avg(select_column(samples, 2))
+        if max_counts >= range_max or min_counts <= range_min:
+            raise self.printer.command_error(
+                "Some samples are saturated (+/-100%)")
+        return mean
 
     # Provide ongoing force tracking/averaging for status updates
-    def _track_force(self, msg):
-        if not (self.is_calibrated() and self.is_tared()):
-            return True
-        samples = msg['data']
-        # selectColumn unusable here because Python 2 lacks deque.extend
-        for sample in samples:
-            self._force_buffer.append(sample[1])
-        return True
-
     def _force_g(self):
-        if (self.is_calibrated() and self.is_tared()
-                and len(self._force_buffer) > 0):
-            return {"force_g": round(avg(self._force_buffer), 1),
-                    "min_force_g": round(min(self._force_buffer), 1),
-                    "max_force_g": round(max(self._force_buffer), 1)}
+        count, mean, variance, min_counts, max_counts = (
+            self._sample_buffer.get_running_stats())
+        if self.is_calibrated() and self.is_tared() and count:
+            low, high = sorted([self.counts_to_grams(min_counts),
+                                self.counts_to_grams(max_counts)])
+            return {"force_g": round(self.counts_to_grams(mean), 1),
+                    "min_force_g": round(low, 1),
+                    "max_force_g": round(high, 1)}
         return {}
 
     def is_tared(self):
@@ -504,6 +640,9 @@ class LoadCell:
     def get_collector(self):
         return LoadCellSampleCollector(self.printer, self)
 
+    def get_sample_buffer(self):
+        return self._sample_buffer
+
     def get_status(self, eventtime):
         status = self._force_g()
         status.update({'is_calibrated': self.is_calibrated(),
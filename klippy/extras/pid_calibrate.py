@@ -38,6 +38,15 @@ class PIDCalibrate:
         # Log and report results
         Kp, Ki, Kd = calibrate.calc_final_pid()
         logging.info("Autotune: final: Kp=%f Ki=%f Kd=%f", Kp, Ki, Kd)
+        if isinstance(old_control, heaters.ControlModel):
+            # Do not replace the model setup of the heater with pid
+            gcmd.respond_info(
+                "PID parameters: pid_Kp=%.3f pid_Ki=%.3f pid_Kd=%.3f\n"
+                "Heater %s uses 'control: model' so the printer config file"
+                " will not be updated. Use WRITE_FILE=1 and"
+                " scripts/calibrate_heater_model.py to obtain the model"
+                " parameters." % (Kp, Ki, Kd, heater_name))
+            return
         gcmd.respond_info(
             "PID parameters: pid_Kp=%.3f pid_Ki=%.3f pid_Kd=%.3f\n"
             "The SAVE_CONFIG command will update the printer config file\n"
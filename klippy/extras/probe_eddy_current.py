@@ -37,43 +37,57 @@ class EddyCalibration:
         cal = sorted([(c[1], c[0]) for c in cal])
         self.cal_freqs = [c[0] for c in cal]
         self.cal_zpos = [c[1] for c in cal]
-    def apply_calibration(self, samples):
+        # Precompute the gain and offset of each segment of the table.
+        # Segment 'pos' is between cal_freqs[pos-1] and cal_freqs[pos];
+        # the first and last entries report out of range heights.
+        self.cal_gains = [0.]
+        self.cal_offsets = [OUT_OF_RANGE]
+        for pos in range(1, len(cal)):
+            gain, offset = self._calc_segment(
+                self.cal_freqs, self.cal_zpos, pos)
+            self.cal_gains.append(gain)
+            self.cal_offsets.append(offset)
+        self.cal_gains.append(0.)
+        self.cal_offsets.append(-OUT_OF_RANGE)
+        # Reverse table for height to frequency lookups
+        self.rev_zpos = list(reversed(self.cal_zpos))
+        self.rev_freqs = list(reversed(self.cal_freqs))
+        self.rev_segments = [None] + [
+            self._calc_segment(self.rev_zpos, self.rev_freqs, pos)
+            for pos in range(1, len(cal))]
+    def _calc_segment(self, xvals, yvals, pos):
+        prev_x, this_x = xvals[pos - 1], xvals[pos]
+        prev_y, this_y = yvals[pos - 1], yvals[pos]
+        if this_x == prev_x:
+            # Duplicate entry - segment can not be selected by bisect
+            return 0., prev_y
+        gain = (this_y - prev_y) / (this_x - prev_x)
+        offset = prev_y - prev_x * gain
+        return gain, offset
+    def calc_heights(self, freqs):
+        # Convert a batch of frequencies to heights
         cur_temp = self.drift_comp.get_temperature()
-        for i, (samp_time, freq, dummy_z) in enumerate(samples):
-            adj_freq = self.drift_comp.adjust_freq(freq, cur_temp)
-            pos = bisect.bisect(self.cal_freqs, adj_freq)
-            if pos >= len(self.cal_zpos):
-                zpos = -OUT_OF_RANGE
-            elif pos == 0:
-                zpos = OUT_OF_RANGE
-            else:
-                # XXX - could further optimize and avoid div by zero
-                this_freq = self.cal_freqs[pos]
-                prev_freq = self.cal_freqs[pos - 1]
-                this_zpos = self.cal_zpos[pos]
-                prev_zpos = self.cal_zpos[pos - 1]
-                gain = (this_zpos - prev_zpos) / (this_freq - prev_freq)
-                offset = prev_zpos - prev_freq * gain
-                zpos = adj_freq * gain + offset
-            samples[i] = (samp_time, freq, round(zpos, 6))
+        adj_freqs = self.drift_comp.adjust_freqs(freqs, cur_temp)
+        cal_freqs = self.cal_freqs
+        gains = self.cal_gains
+        offsets = self.cal_offsets
+        lookup = bisect.bisect
+        positions = [lookup(cal_freqs, f) for f in adj_freqs]
+        return [round(f * gains[pos] + offsets[pos], 6)
+                for f, pos in zip(adj_freqs, positions)]
+    def apply_calibration(self, samples):
+        heights = self.calc_heights([freq for t, freq, z in samples])
+        samples[:] = [(samp_time, freq, zpos)
+                      for (samp_time, freq, dummy_z), zpos
+                      in zip(samples, heights)]
     def freq_to_height(self, freq):
-        dummy_sample = [(0., freq, 0.)]
-        self.apply_calibration(dummy_sample)
-        return dummy_sample[0][2]
+        return self.calc_heights([freq])[0]
     def height_to_freq(self, height):
-        # XXX - could optimize lookup
-        rev_zpos = list(reversed(self.cal_zpos))
-        rev_freqs = list(reversed(self.cal_freqs))
-        pos = bisect.bisect(rev_zpos, height)
-        if pos == 0 or pos >= len(rev_zpos):
+        pos = bisect.bisect(self.rev_zpos, height)
+        if pos == 0 or pos >= len(self.rev_zpos):
             raise self.printer.command_error(
                 "Invalid probe_eddy_current height")
-        this_freq = rev_freqs[pos]
-        prev_freq = rev_freqs[pos - 1]
-        this_zpos = rev_zpos[pos]
-        prev_zpos = rev_zpos[pos - 1]
-        gain = (this_freq - prev_freq) / (this_zpos - prev_zpos)
-        offset = prev_freq - prev_zpos * gain
+        gain, offset = self.rev_segments[pos]
         freq = height * gain + offset
         return self.drift_comp.unadjust_freq(freq)
     def do_calibration_moves(self, move_speed):
@@ -491,6 +505,8 @@ class DummyDriftCompensation:
         pass
     def adjust_freq(self, freq, temp=None):
         return freq
+    def adjust_freqs(self, freqs, temp=None):
+        return freqs
     def unadjust_freq(self, freq, temp=None):
         return freq
 
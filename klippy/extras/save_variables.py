@@ -4,13 +4,21 @@
 # Copyright (C) 2016-2020  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, logging, ast, configparser
+import os, re, logging, ast, configparser
+
+# Number of appended updates allowed before the file is rewritten
+COMPACT_ENTRIES = 100
+
+# Variable names that can be stored as a configparser option
+VALID_NAME = re.compile(r'^[a-z0-9_.\-]+\Z')
 
 class SaveVariables:
     def __init__(self, config):
         self.printer = config.get_printer()
         self.filename = os.path.expanduser(config.get('filename'))
         self.allVariables = {}
+        self.journal_entries = 0
+        self.need_rewrite = True
         try:
             if not os.path.exists(self.filename):
                 open(self.filename, "w").close()
@@ -20,45 +28,114 @@ class SaveVariables:
         gcode = self.printer.lookup_object('gcode')
         gcode.register_command('SAVE_VARIABLE', self.cmd_SAVE_VARIABLE,
                                desc=self.cmd_SAVE_VARIABLE_help)
-    def loadVariables(self):
+        gcode.register_command('SAVE_VARIABLES', self.cmd_SAVE_VARIABLES,
+                               desc=self.cmd_SAVE_VARIABLES_help)
+    def _parse_variables(self, data):
+        # Later entries of a variable (appended updates) override earlier
+        varfile = configparser.ConfigParser(strict=False)
+        varfile.read_string(data)
         allvars = {}
-        varfile = configparser.ConfigParser()
+        if not varfile.has_section('Variables'):
+            return allvars, False
+        for name, val in varfile.items('Variables'):
+            allvars[name] = ast.literal_eval(val)
+        return allvars, True
+    def loadVariables(self):
+        need_rewrite = False
         try:
-            varfile.read(self.filename)
-            if varfile.has_section('Variables'):
-                for name, val in varfile.items('Variables'):
-                    allvars[name] = ast.literal_eval(val)
+            f = open(self.filename, "r")
+            data = f.read()
+            f.close()
+            if '\n' in data and not data.endswith('\n'):
+                # Discard a partially written update at end of file (it
+                # may still parse, for example with a truncated number)
+                logging.warning("Discarding incomplete update in %s: %s",
+                                self.filename,
+                                repr(data[data.rindex('\n')+1:]))
+                data = data[:data.rindex('\n')+1]
+                need_rewrite = True
+            allvars, has_section = self._parse_variables(data)
         except:
             msg = "Unable to parse existing variable file"
             logging.exception(msg)
             raise self.printer.command_error(msg)
         self.allVariables = allvars
-    cmd_SAVE_VARIABLE_help = "Save arbitrary variables to disk"
-    def cmd_SAVE_VARIABLE(self, gcmd):
-        varname = gcmd.get('VARIABLE')
-        if (varname.lower() != varname):
-            raise gcmd.error("VARIABLE must not contain upper case")
-        value = gcmd.get('VALUE')
-        try:
-            value = ast.literal_eval(value)
-        except ValueError as e:
-            raise gcmd.error("Unable to parse '%s' as a literal" % (value,))
-        newvars = dict(self.allVariables)
-        newvars[varname] = value
-        # Write file
+        # Appending requires a section header and a trailing newline
+        self.need_rewrite = (need_rewrite or not has_section
+                             or not data.endswith('\n'))
+        entries = [l for l in data.splitlines()
+                   if '=' in l and not l[:1].isspace()]
+        self.journal_entries = max(0, len(entries) - len(allvars))
+    def _write_file(self, newvars):
+        # Atomically replace the variable file with a compacted version
         varfile = configparser.ConfigParser()
         varfile.add_section('Variables')
         for name, val in sorted(newvars.items()):
             varfile.set('Variables', name, repr(val))
+        tmpname = self.filename + ".tmp"
+        f = open(tmpname, "w")
+        varfile.write(f)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.rename(tmpname, self.filename)
+        self.journal_entries = 0
+        self.need_rewrite = False
+    def _append_file(self, updates):
+        # Append updated values (later entries override earlier ones)
+        data = "".join(["%s = %s\n" % (name, repr(val))
+                        for name, val in sorted(updates.items())])
+        f = open(self.filename, "a")
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        self.journal_entries += len(updates)
+    def save_variables(self, updates):
+        newvars = dict(self.allVariables)
+        newvars.update(updates)
+        # Check that the new values are valid in the file format
+        varfile = configparser.ConfigParser()
+        varfile.add_section('Variables')
+        for name, val in updates.items():
+            varfile.set('Variables', name, repr(val))
+        if (self.need_rewrite or self.journal_entries + len(updates)
+            > max(COMPACT_ENTRIES, len(newvars))):
+            self._write_file(newvars)
+        else:
+            self._append_file(updates)
+        self.allVariables = newvars
+    def _parse_value(self, gcmd, value):
         try:
-            f = open(self.filename, "w")
-            varfile.write(f)
-            f.close()
+            return ast.literal_eval(value)
+        except ValueError as e:
+            raise gcmd.error("Unable to parse '%s' as a literal" % (value,))
+    def _save(self, gcmd, updates):
+        for varname in updates:
+            if (varname.lower() != varname):
+                raise gcmd.error("VARIABLE must not contain upper case")
+            if not VALID_NAME.match(varname):
+                raise gcmd.error(
+                    "VARIABLE '%s' may only contain the characters a-z, 0-9,"
+                    " '_', '-', and '.'" % (varname,))
+        try:
+            self.save_variables(updates)
         except:
             msg = "Unable to save variable"
             logging.exception(msg)
             raise gcmd.error(msg)
-        self.loadVariables()
+    cmd_SAVE_VARIABLE_help = "Save arbitrary variables to disk"
+    def cmd_SAVE_VARIABLE(self, gcmd):
+        varname = gcmd.get('VARIABLE')
+        value = self._parse_value(gcmd, gcmd.get('VALUE'))
+        self._save(gcmd, {varname: value})
+    cmd_SAVE_VARIABLES_help = "Save several variables to disk in one update"
+    def cmd_SAVE_VARIABLES(self, gcmd):
+        updates = self._parse_value(gcmd, gcmd.get('VARIABLES'))
+        if (not isinstance(updates, dict)
+            or not all([isinstance(k, str) for k in updates])):
+            raise gcmd.error("VARIABLES must be a dictionary of names")
+        self._save(gcmd, updates)
     def get_status(self, eventtime):
         return {'variables': self.allVariables}
 
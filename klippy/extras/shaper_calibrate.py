@@ -3,8 +3,13 @@
 # Copyright (C) 2020-2024  Dmitry Butyugin <dmbutyugin@google.com>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import collections, importlib, logging, math, multiprocessing, traceback
+import collections, importlib, io, logging, math, multiprocessing, pickle
+import traceback
 shaper_defs = importlib.import_module('.shaper_defs', 'extras')
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
 
 MIN_FREQ = 5.
 MAX_FREQ = 200.
@@ -43,6 +48,11 @@ class CalibrationData:
         self.data_sets = joined_data_sets
     def set_numpy(self, numpy):
         self.numpy = numpy
+    def __getstate__(self):
+        # The numpy module is not sent to the background process
+        state = dict(self.__dict__)
+        state.pop('numpy', None)
+        return state
     def normalize_to_frequencies(self):
         for psd in self._psd_list:
             # Avoid division by zero errors
@@ -71,40 +81,15 @@ class ShaperCalibrate:
                     "installed via `~/klippy-env/bin/pip install` (refer to "
                     "docs/Measuring_Resonances.md for more details).")
 
-    def background_process_exec(self, method, args):
+    # Run the named ShaperCalibrate method (in the background worker
+    # process when running in klippy)
+    def background_process_exec(self, method_name, args):
         if self.printer is None:
-            return method(*args)
-        import queuelogger
-        parent_conn, child_conn = multiprocessing.Pipe()
-        def wrapper():
-            queuelogger.clear_bg_logging()
-            try:
-                res = method(*args)
-            except:
-                child_conn.send((True, traceback.format_exc()))
-                child_conn.close()
-                return
-            child_conn.send((False, res))
-            child_conn.close()
-        # Start a process to perform the calculation
-        calc_proc = multiprocessing.Process(target=wrapper)
-        calc_proc.daemon = True
-        calc_proc.start()
-        # Wait for the process to finish
-        reactor = self.printer.get_reactor()
-        gcode = self.printer.lookup_object("gcode")
-        eventtime = last_report_time = reactor.monotonic()
-        while calc_proc.is_alive():
-            if eventtime > last_report_time + 5.:
-                last_report_time = eventtime
-                gcode.respond_info("Wait for calculations..", log=False)
-            eventtime = reactor.pause(eventtime + .1)
-        # Return results
-        is_err, res = parent_conn.recv()
+            return getattr(self, method_name)(*args)
+        worker = BackgroundWorker.lookup(self.printer)
+        is_err, res = worker.run(method_name, args)
         if is_err:
             raise self.error("Error in remote calculation: %s" % (res,))
-        calc_proc.join()
-        parent_conn.close()
         return res
 
     def _split_into_windows(self, x, window_size, overlap):
@@ -152,12 +137,14 @@ class ShaperCalibrate:
         if raw_values is None:
             return None
         if isinstance(raw_values, np.ndarray):
+            if not len(raw_values):
+                return None
             data = raw_values
         else:
-            samples = raw_values.get_samples()
-            if not samples:
+            columns = raw_values.get_sample_columns()
+            if not len(columns[0]):
                 return None
-            data = np.array(samples)
+            data = np.column_stack([np.frombuffer(c) for c in columns])
 
         N = data.shape[0]
         T = data[-1,0] - data[0,0]
@@ -176,7 +163,7 @@ class ShaperCalibrate:
 
     def process_accelerometer_data(self, data):
         calibration_data = self.background_process_exec(
-                self.calc_freq_response, (data,))
+                'calc_freq_response', (data,))
         if calibration_data is None:
             raise self.error(
                     "Internal error processing accelerometer data %s" % (data,))
@@ -329,7 +316,7 @@ class ShaperCalibrate:
         for shaper_cfg in shaper_defs.INPUT_SHAPERS:
             if shaper_cfg.name not in shapers:
                 continue
-            shaper = self.background_process_exec(self.fit_shaper, (
+            shaper = self.background_process_exec('fit_shaper', (
                 shaper_cfg, calibration_data, shaper_freqs, damping_ratio,
                 scv, max_smoothing, test_damping_ratios, max_freq))
             if logger is not None:
@@ -396,3 +383,223 @@ class ShaperCalibrate:
                     csvfile.write("\n")
         except IOError as e:
             raise self.error("Error writing to file '%s': %s", output, str(e))
+
+
+######################################################################
+# Background calculation process
+######################################################################
+
+# Arrays at least this large (in bytes) are sent in shared memory
+MIN_SHARED_SIZE = 4096
+
+# Pickle large numpy arrays (and accelerometer measurements) by copying
+# them into shared memory blocks. The receiver unlinks each block after
+# attaching to it, so the sender only needs to close its blocks once
+# the message is delivered.
+class SharedArrayPickler(pickle.Pickler):
+    def __init__(self, file, numpy):
+        pickle.Pickler.__init__(self, file, pickle.HIGHEST_PROTOCOL)
+        self.numpy = numpy
+        self.blocks = []
+        self.shared_ids = {}
+    def _share(self, shape, dtype, fill):
+        np = self.numpy
+        dtype = np.dtype(dtype)
+        size = dtype.itemsize
+        for dim in shape:
+            size *= dim
+        if shared_memory is None or size < MIN_SHARED_SIZE:
+            data = np.empty(shape, dtype=dtype)
+            fill(data)
+            return ('local', data)
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        self.blocks.append(shm)
+        data = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        fill(data)
+        del data
+        return ('shared', shm.name, dtype.str, shape)
+    def persistent_id(self, obj):
+        np = self.numpy
+        if hasattr(obj, 'get_sample_columns'):
+            # Send accelerometer measurements as an (N, 4) array
+            columns = obj.get_sample_columns()
+            def fill(data):
+                for i, column in enumerate(columns):
+                    data[:,i] = column
+            return self._share((len(columns[0]), len(columns)), 'f8', fill)
+        if (not isinstance(obj, np.ndarray) or obj.dtype.hasobject
+            or obj.nbytes < MIN_SHARED_SIZE or shared_memory is None):
+            return None
+        pid = self.shared_ids.get(id(obj))
+        if pid is None:
+            def fill(data):
+                data[...] = obj
+            pid = self._share(obj.shape, obj.dtype, fill)
+            self.shared_ids[id(obj)] = pid
+        return pid
+    def release(self, unlink=False):
+        for shm in self.blocks:
+            shm.close()
+            if unlink:
+                try:
+                    shm.unlink()
+                except FileNotFoundError:
+                    # Already unlinked by the receiver
+                    pass
+        self.blocks = []
+
+class SharedArrayUnpickler(pickle.Unpickler):
+    def __init__(self, file, numpy, copy):
+        pickle.Unpickler.__init__(self, file)
+        self.numpy = numpy
+        self.copy = copy
+        self.blocks = []
+        self.arrays = {}
+    def persistent_load(self, pid):
+        if pid[0] == 'local':
+            return pid[1]
+        ptype, name, dtype, shape = pid
+        data = self.arrays.get(name)
+        if data is not None:
+            return data
+        shm = shared_memory.SharedMemory(name)
+        shm.unlink()
+        data = self.numpy.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        if self.copy:
+            data = data.copy()
+            shm.close()
+        else:
+            self.blocks.append(shm)
+        self.arrays[name] = data
+        return data
+    def release(self):
+        # All references to the loaded arrays must be dropped first
+        self.memo.clear()
+        self.arrays.clear()
+        for shm in self.blocks:
+            try:
+                shm.close()
+            except BufferError:
+                logging.exception("Unable to release shared memory")
+        self.blocks = []
+
+def _dumps(numpy, obj):
+    f = io.BytesIO()
+    pickler = SharedArrayPickler(f, numpy)
+    try:
+        pickler.dump(obj)
+    except:
+        pickler.release(unlink=True)
+        raise
+    return f.getvalue(), pickler
+
+def _run_request(helper, conn, msg):
+    unpickler = SharedArrayUnpickler(io.BytesIO(msg), helper.numpy, False)
+    try:
+        method, args = unpickler.load()
+        res = (False, getattr(helper, method)(*args))
+    except:
+        res = (True, traceback.format_exc())
+    method = args = None
+    try:
+        data, pickler = _dumps(helper.numpy, res)
+    except:
+        data, pickler = _dumps(helper.numpy, (True, traceback.format_exc()))
+    res = None
+    unpickler.release()
+    try:
+        conn.send_bytes(data)
+    except:
+        pickler.release(unlink=True)
+        raise
+    pickler.release()
+
+def _background_worker(conn):
+    helper = ShaperCalibrate(None)
+    while 1:
+        try:
+            msg = conn.recv_bytes()
+        except EOFError:
+            break
+        _run_request(helper, conn, msg)
+    conn.close()
+
+# Persistent process that runs ShaperCalibrate calculations. The
+# process is started from a fresh interpreter (instead of a fork of
+# the klippy process) so that it does not hold a copy of the klippy
+# memory for as long as it runs.
+class BackgroundWorker:
+    def __init__(self, printer):
+        self.printer = printer
+        self.reactor = printer.get_reactor()
+        self.numpy = importlib.import_module('numpy')
+        self.mutex = self.reactor.mutex()
+        self.conn = self.fd_handle = None
+        self.completion = None
+        printer.register_event_handler("klippy:disconnect",
+                                       self._handle_disconnect)
+    @staticmethod
+    def lookup(printer):
+        worker = printer.lookup_object('shaper_calibrate_worker', None)
+        if worker is None:
+            worker = BackgroundWorker(printer)
+            printer.add_object('shaper_calibrate_worker', worker)
+        return worker
+    def _start(self):
+        ctx = multiprocessing.get_context('spawn')
+        parent_conn, child_conn = ctx.Pipe()
+        proc = ctx.Process(target=_background_worker, args=(child_conn,))
+        proc.daemon = True
+        proc.start()
+        child_conn.close()
+        self.conn = parent_conn
+        self.fd_handle = self.reactor.register_fd(parent_conn.fileno(),
+                                                  self._handle_response)
+    def _stop(self):
+        if self.conn is None:
+            return
+        self.reactor.unregister_fd(self.fd_handle)
+        self.conn.close()
+        self.conn = self.fd_handle = None
+    def _handle_disconnect(self):
+        self._stop()
+    def _handle_response(self, eventtime):
+        try:
+            msg = self.conn.recv_bytes()
+        except (EOFError, IOError, OSError):
+            logging.error("Background calculation process exited")
+            msg = None
+            self._stop()
+        completion = self.completion
+        self.completion = None
+        if completion is not None:
+            completion.complete(msg)
+    def run(self, method, args):
+        with self.mutex:
+            if self.conn is None:
+                self._start()
+            data, pickler = _dumps(self.numpy, (method, args))
+            self.completion = completion = self.reactor.completion()
+            try:
+                self.conn.send_bytes(data)
+            except (IOError, OSError) as e:
+                pickler.release(unlink=True)
+                self.completion = None
+                self._stop()
+                raise self.printer.command_error(
+                    "Unable to send to calculation process: %s" % (str(e),))
+            # Wait for the result
+            gcode = self.printer.lookup_object("gcode")
+            while 1:
+                eventtime = self.reactor.monotonic()
+                completion.wait(eventtime + 5.)
+                if completion.test():
+                    break
+                gcode.respond_info("Wait for calculations..", log=False)
+            msg = completion.wait()
+            pickler.release(unlink=msg is None)
+            if msg is None:
+                raise self.printer.command_error(
+                    "Background calculation process exited")
+            unpickler = SharedArrayUnpickler(io.BytesIO(msg), self.numpy, True)
+            return unpickler.load()
@@ -3,7 +3,7 @@
 # Copyright (C) 2018-2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, time, logging
+import os, time, logging, struct
 
 class PrinterSysStats:
     def __init__(self, config):
@@ -49,12 +49,64 @@ class PrinterSysStats:
                 'cputime': self.total_process_time,
                 'memavail': self.last_mem_avail}
 
+# Compact binary copy of the periodic statistics (see scripts/statsfile.py)
+STATS_FILE_MAGIC = b"KLSTATS1\n"
+
+def parse_stats_msg(msg, out):
+    prefix = ""
+    for part in msg.split():
+        if '=' not in part:
+            prefix = part
+            continue
+        name, val = part.split('=', 1)
+        try:
+            out[prefix + name] = float(val)
+        except ValueError:
+            pass
+
+class StatsFile:
+    def __init__(self, filename):
+        self.file = open(filename, 'ab')
+        if not self.file.tell():
+            self.file.write(STATS_FILE_MAGIC)
+        self.columns = None
+    def write(self, eventtime, stats):
+        values = {}
+        for is_active, msg in stats:
+            parse_stats_msg(msg, values)
+        columns = sorted(values)
+        data = []
+        if columns != self.columns:
+            # Column layout record: 'L' count [len name]...
+            self.columns = columns
+            data.append(struct.pack('<cH', b'L', len(columns)))
+            for name in columns:
+                bname = name.encode()
+                data.append(struct.pack('<H', len(bname)) + bname)
+        # Sample record: 'R' eventtime value...
+        data.append(struct.pack('<cd%dd' % (len(columns),), b'R', eventtime,
+                                *[values[name] for name in columns]))
+        self.file.write(b''.join(data))
+        self.file.flush()
+    def close(self):
+        self.file.close()
+
 class PrinterStats:
     def __init__(self, config):
         self.printer = config.get_printer()
         reactor = self.printer.get_reactor()
         self.stats_timer = reactor.register_timer(self.generate_stats)
         self.stats_cb = []
+        self.stats_file = None
+        stats_filename = self.printer.get_start_args().get('stats_file')
+        if stats_filename is not None:
+            try:
+                self.stats_file = StatsFile(stats_filename)
+            except (IOError, OSError) as e:
+                raise config.error("Unable to open stats file '%s': %s"
+                                   % (stats_filename, str(e)))
+            self.printer.register_event_handler("klippy:disconnect",
+                                                self.stats_file.close)
         self.printer.register_event_handler("klippy:ready", self.handle_ready)
     def handle_ready(self):
         self.stats_cb = [o.stats for n, o in self.printer.lookup_objects()
@@ -67,6 +119,12 @@ class PrinterStats:
         if max([s[0] for s in stats]):
             logging.info("Stats %.1f: %s", eventtime,
                          ' '.join([s[1] for s in stats]))
+            if self.stats_file is not None:
+                try:
+                    self.stats_file.write(eventtime, stats)
+                except (IOError, OSError, ValueError):
+                    logging.exception("Unable to write stats file")
+                    self.stats_file = None
         return eventtime + 1.
 
 def load_config(config):
@@ -3,7 +3,7 @@
 # Copyright (C) 2024 Eric Callahan <arksine.code@gmail.com>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging
+import logging, bisect
 from . import manual_probe
 
 KELVIN_TO_CELSIUS = -273.15
@@ -481,6 +481,7 @@ class TemperatureProbe:
 #####################################################################
 
 DRIFT_SAMPLE_COUNT = 9
+FREQ_TABLE_CACHE_SIZE = 64
 
 class EddyDriftCompensation:
     def __init__(self, config, sensor):
@@ -489,6 +490,7 @@ class EddyDriftCompensation:
         self.name = config.get_name()
         self.cal_temp = config.getfloat("calibration_temp", 0.)
         self.drift_calibration = None
+        self.freq_tables = {}
         self.calibration_samples = None
         self.max_valid_temp = config.getfloat("max_validation_temp", 60.)
         self.dc_min_temp = config.getfloat("drift_calibration_min_temp", 0.)
@@ -686,6 +688,18 @@ class EddyDriftCompensation:
             origin_temp = self.get_temperature()
         return self._calc_freq(freq, origin_temp, self.cal_temp)
 
+    def adjust_freqs(self, freqs, origin_temp=None):
+        # Adjust a batch of frequencies sampled at the same temperature
+        if not self.enabled:
+            return freqs
+        if origin_temp is None:
+            origin_temp = self.get_temperature()
+        table = self._lookup_freq_table(origin_temp, self.cal_temp)
+        min_freq = self.min_freq
+        calc_freq = self._calc_table_freq
+        return [freq if freq < min_freq else calc_freq(freq, table)
+                for freq in freqs]
+
     def unadjust_freq(self, freq, dest_temp=None):
         # Given a frequency and its orignal sampled temp, find the
         # offset frequency based on the current temp
@@ -695,23 +709,53 @@ class EddyDriftCompensation:
             dest_temp = self.get_temperature()
         return self._calc_freq(freq, self.cal_temp, dest_temp)
 
+    def _lookup_freq_table(self, origin_temp, dest_temp):
+        # Cache the frequency of each drift curve at a pair of
+        # temperatures so that the polynomials are not evaluated for
+        # every sample
+        key = (origin_temp, dest_temp)
+        table = self.freq_tables.get(key)
+        if table is None:
+            if len(self.freq_tables) >= FREQ_TABLE_CACHE_SIZE:
+                self.freq_tables.clear()
+            dc = self.drift_calibration
+            low_freqs = [poly(origin_temp) for poly in dc]
+            tgt_freqs = [poly(dest_temp) for poly in dc]
+            # Curves are normally in descending frequency order, which
+            # allows a bisect search of the negated frequencies
+            neg_freqs = [-f for f in low_freqs]
+            if neg_freqs != sorted(neg_freqs):
+                neg_freqs = None
+            table = (low_freqs, tgt_freqs, neg_freqs)
+            self.freq_tables[key] = table
+        return table
+
     def _calc_freq(self, freq, origin_temp, dest_temp):
-        high_freq = low_freq = None
-        dc = self.drift_calibration
-        for pos, poly in enumerate(dc):
-            high_freq = low_freq
-            low_freq = poly(origin_temp)
-            if freq >= low_freq:
-                if high_freq is None:
-                    # Freqency above max calibration value
-                    err = poly(dest_temp) - low_freq
-                    return freq + err
-                t = min(1., max(0., (freq - low_freq) / (high_freq - low_freq)))
-                low_tgt_freq = poly(dest_temp)
-                high_tgt_freq = dc[pos-1](dest_temp)
-                return (1 - t) * low_tgt_freq + t * high_tgt_freq
-        # Frequency below minimum, no correction
-        return freq
+        table = self._lookup_freq_table(origin_temp, dest_temp)
+        return self._calc_table_freq(freq, table)
+
+    def _calc_table_freq(self, freq, table):
+        low_freqs, tgt_freqs, neg_freqs = table
+        # Find the first curve at or below the frequency
+        if neg_freqs is not None:
+            pos = bisect.bisect_left(neg_freqs, -freq)
+        else:
+            pos = 0
+            while pos < len(low_freqs) and freq < low_freqs[pos]:
+                pos += 1
+        if pos >= len(low_freqs):
+            # Frequency below minimum, no correction
+            return freq
+        low_freq = low_freqs[pos]
+        if not pos:
+            # Freqency above max calibration value
+            err = tgt_freqs[pos] - low_freq
+            return freq + err
+        high_freq = low_freqs[pos-1]
+        t = min(1., max(0., (freq - low_freq) / (high_freq - low_freq)))
+        low_tgt_freq = tgt_freqs[pos]
+        high_tgt_freq = tgt_freqs[pos-1]
+        return (1 - t) * low_tgt_freq + t * high_tgt_freq
 
     def get_temperature(self):
         return self.temp_sensor.get_temp()[0]
@@ -0,0 +1,281 @@
+# Background monitoring of printer vibrations with an accelerometer
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import logging, multiprocessing, os, traceback, array, itertools
+from . import shaper_calibrate
+
+# Number of analyses averaged into the reference spectrum before
+# changes are reported
+BASELINE_COUNT = 10
+# Spacing (in Hz) of the frequency bins that spectra are compared on
+FREQ_STEP = 1.
+# Time (beyond sample_time) to wait for accelerometer data
+CAPTURE_TIMEOUT = 5.
+
+# Spectrum analysis (runs in the background process)
+class VibrationAnalyzer:
+    def __init__(self, min_freq, max_freq, baseline_decay):
+        self.helper = shaper_calibrate.ShaperCalibrate(None)
+        self.numpy = self.helper.numpy
+        self.min_freq = min_freq
+        self.max_freq = max_freq
+        self.baseline_decay = baseline_decay
+        # The measured sample rate varies between captures, so each
+        # spectrum is resampled onto a fixed set of frequencies
+        self.freqs = self.numpy.arange(min_freq, max_freq + .5 * FREQ_STEP,
+                                       FREQ_STEP)
+        self.baseline = None
+        self.baseline_count = 0
+    def reset(self):
+        self.baseline = None
+        self.baseline_count = 0
+    def analyze(self, raw_data):
+        np = self.numpy
+        data = np.frombuffer(raw_data, dtype=np.float64).reshape(-1, 4)
+        N = data.shape[0]
+        if N < 2 or data[-1,0] <= data[0,0]:
+            return None
+        fs = N / (data[-1,0] - data[0,0])
+        nfft = 1 << int(fs * shaper_calibrate.WINDOW_T_SEC - 1).bit_length()
+        if N <= nfft:
+            return None
+        psd = 0.
+        for axis in range(1, 4):
+            freqs_psd, axis_psd = self.helper._psd(data[:,axis], fs, nfft)
+            psd = psd + axis_psd
+        freqs = self.freqs
+        psd = np.interp(freqs, freqs_psd, psd, left=0., right=0.)
+        if psd.sum() <= 0.:
+            return None
+        peak = np.argmax(psd)
+        # RMS of the vibrations (the mean of each axis, including
+        # gravity, is removed)
+        rms = np.sqrt(data[:,1:].var(axis=0).sum())
+        # Compare the shape of the spectrum to the reference spectrum
+        norm_psd = psd / psd.sum()
+        if self.baseline is None or self.baseline.shape != norm_psd.shape:
+            change = 0.
+            self.baseline = norm_psd
+        else:
+            change = .5 * np.abs(norm_psd - self.baseline).sum()
+            decay = max(self.baseline_decay, 1. / (self.baseline_count + 1))
+            self.baseline = self.baseline + decay * (norm_psd - self.baseline)
+        self.baseline_count += 1
+        return {'dominant_freq': float(freqs[peak]),
+                'peak_psd': float(psd[peak]), 'rms': float(rms),
+                'change': float(change),
+                'baseline_count': self.baseline_count}
+
+def _analyzer_process(conn, args):
+    try:
+        # Only use otherwise idle cpu time
+        os.nice(10)
+    except:
+        pass
+    analyzer = VibrationAnalyzer(*args)
+    while 1:
+        try:
+            req = conn.recv()
+        except EOFError:
+            break
+        if req is None:
+            break
+        method, params = req
+        try:
+            res = (False, getattr(analyzer, method)(*params))
+        except:
+            res = (True, traceback.format_exc())
+        conn.send(res)
+    conn.close()
+
+# Main "printer object"
+class VibrationMonitor:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.chip_name = config.get('accel_chip').strip()
+        self.interval = config.getfloat('interval', 10., minval=1.)
+        self.sample_time = config.getfloat('sample_time', 2., minval=1.,
+                                           maxval=self.interval)
+        self.min_freq = config.getfloat('min_freq', shaper_calibrate.MIN_FREQ,
+                                        minval=1.)
+        self.max_freq = config.getfloat('max_freq', shaper_calibrate.MAX_FREQ,
+                                        above=self.min_freq)
+        self.change_threshold = config.getfloat('change_threshold', .5,
+                                                above=0., maxval=1.)
+        self.baseline_decay = config.getfloat('baseline_decay', .02,
+                                              above=0., maxval=1.)
+        self.max_rms = config.getfloat('max_rms', None, above=0.)
+        self.print_only = config.getboolean('print_only', True)
+        self.enabled = config.getboolean('enable', True)
+        # Verify numpy is available
+        shaper_calibrate.ShaperCalibrate(self.printer)
+        self.chip = None
+        # Background analysis process
+        self.conn = self.proc = self.conn_handler = None
+        self.pending_requests = []
+        self.is_capturing = self.is_analyzing = False
+        self.capture = []
+        self.capture_start = self.capture_timeout = 0.
+        self.capture_id = 0
+        # Results
+        self.status = {'dominant_freq': 0., 'peak_psd': 0., 'rms': 0.,
+                       'change': 0., 'alert': False, 'analyses': 0,
+                       'last_analysis_time': 0.}
+        self.monitor_timer = None
+        self.printer.register_event_handler("klippy:ready", self._handle_ready)
+        self.printer.register_event_handler("klippy:disconnect",
+                                            self._handle_disconnect)
+        gcode = self.printer.lookup_object('gcode')
+        gcode.register_command("VIBRATION_MONITOR", self.cmd_VIBRATION_MONITOR,
+                               desc=self.cmd_VIBRATION_MONITOR_help)
+    def _handle_ready(self):
+        self.chip = self.printer.lookup_object(self.chip_name)
+        self._start_process()
+        reactor = self.printer.get_reactor()
+        self.monitor_timer = reactor.register_timer(
+            self._monitor_event, reactor.monotonic() + self.interval)
+    def _handle_disconnect(self):
+        if self.conn is None:
+            return
+        self.printer.get_reactor().unregister_fd(self.conn_handler)
+        try:
+            self.conn.send(None)
+        except (IOError, OSError):
+            pass
+        self.conn.close()
+        self.conn = self.proc = self.conn_handler = None
+        self.pending_requests = []
+        self.is_analyzing = False
+    def _start_process(self):
+        # Start from a fresh interpreter instead of a fork of klippy
+        ctx = multiprocessing.get_context('spawn')
+        parent_conn, child_conn = ctx.Pipe()
+        args = (self.min_freq, self.max_freq, self.baseline_decay)
+        self.proc = ctx.Process(target=_analyzer_process,
+                                args=(child_conn, args))
+        self.proc.daemon = True
+        self.proc.start()
+        child_conn.close()
+        self.conn = parent_conn
+        reactor = self.printer.get_reactor()
+        self.conn_handler = reactor.register_fd(parent_conn.fileno(),
+                                                self._handle_result)
+    def _send_request(self, method, params):
+        # The process replies to each request in order
+        self.pending_requests.append(method)
+        self.conn.send((method, params))
+    # Periodic capture of accelerometer data
+    def _is_active(self, eventtime):
+        if not self.enabled or self.conn is None:
+            return False
+        if not self.print_only:
+            return True
+        idle_timeout = self.printer.lookup_object('idle_timeout')
+        return idle_timeout.get_status(eventtime)['state'] == "Printing"
+    def _monitor_event(self, eventtime):
+        if self.is_capturing and eventtime > self.capture_timeout:
+            # The accelerometer stopped delivering data (for example,
+            # because its clients were dropped after an error)
+            logging.warning("vibration_monitor: timeout capturing from %s",
+                            self.chip_name)
+            self.is_capturing = False
+            self.capture = []
+        if (not self.is_capturing and not self.is_analyzing
+            and self._is_active(eventtime)):
+            self.is_capturing = True
+            self.capture = []
+            self.capture_timeout = (eventtime + self.sample_time
+                                    + CAPTURE_TIMEOUT)
+            self.capture_id += 1
+            capture_id = self.capture_id
+            try:
+                self.chip.add_client(
+                    lambda msg: self._handle_batch(capture_id, msg))
+            except self.printer.command_error:
+                logging.exception("vibration_monitor: unable to start %s",
+                                  self.chip_name)
+                self.is_capturing = False
+        return eventtime + self.interval
+    def _handle_batch(self, capture_id, msg):
+        if not self.is_capturing or capture_id != self.capture_id:
+            return False
+        if self.conn is None:
+            # Analysis process is gone (klippy is disconnecting)
+            self.is_capturing = False
+            self.capture = []
+            return False
+        data = msg['data']
+        if not data:
+            return True
+        if not self.capture:
+            self.capture_start = data[0][0]
+        self.capture.append(data)
+        if data[-1][0] - self.capture_start < self.sample_time:
+            return True
+        # Send the captured samples to the background process
+        self.is_capturing = False
+        samples = itertools.chain.from_iterable(self.capture)
+        raw_data = array.array('d', itertools.chain.from_iterable(samples))
+        self.capture = []
+        self.is_analyzing = True
+        self._send_request('analyze', (raw_data.tobytes(),))
+        return False
+    def _handle_result(self, eventtime):
+        try:
+            is_err, res = self.conn.recv()
+        except (EOFError, IOError, OSError):
+            logging.error("vibration_monitor: analysis process exited")
+            self._handle_disconnect()
+            return
+        method = self.pending_requests.pop(0)
+        if is_err:
+            logging.error("vibration_monitor: %s error: %s", method, res)
+        if method != 'analyze':
+            return
+        self.is_analyzing = False
+        if not is_err and res is not None:
+            self._update_status(eventtime, res)
+    def _update_status(self, eventtime, res):
+        status = self.status
+        status.update({'dominant_freq': res['dominant_freq'],
+                       'peak_psd': res['peak_psd'], 'rms': res['rms'],
+                       'change': res['change'],
+                       'analyses': status['analyses'] + 1,
+                       'last_analysis_time': eventtime})
+        reasons = []
+        if (res['baseline_count'] > BASELINE_COUNT
+            and res['change'] > self.change_threshold):
+            reasons.append("spectrum change %.2f" % (res['change'],))
+        if self.max_rms is not None and res['rms'] > self.max_rms:
+            reasons.append("rms %.1f mm/s^2" % (res['rms'],))
+        was_alert = status['alert']
+        status['alert'] = bool(reasons)
+        if reasons and not was_alert:
+            msg = ("vibration_monitor: vibrations changed (%s, dominant"
+                   " frequency %.1f Hz)" % (", ".join(reasons),
+                                            res['dominant_freq']))
+            logging.warning(msg)
+            self.printer.lookup_object('gcode').respond_info(msg)
+    cmd_VIBRATION_MONITOR_help = "Control the background vibration monitor"
+    def cmd_VIBRATION_MONITOR(self, gcmd):
+        self.enabled = gcmd.get_int('ENABLE', self.enabled, minval=0,
+                                    maxval=1)
+        if gcmd.get_int('RESET', 0, minval=0, maxval=1):
+            if self.conn is not None:
+                self._send_request('reset', ())
+            self.status['alert'] = False
+        s = self.status
+        gcmd.respond_info(
+            "vibration_monitor: %s, %d analyses\n"
+            "dominant_freq=%.1f Hz rms=%.1f mm/s^2 change=%.3f alert=%s"
+            % (["disabled", "enabled"][self.enabled], s['analyses'],
+               s['dominant_freq'], s['rms'], s['change'], s['alert']))
+    def get_status(self, eventtime):
+        status = dict(self.status)
+        status['enabled'] = bool(self.enabled)
+        return status
+
+def load_config(config):
+    return VibrationMonitor(config)
@@ -22,6 +22,24 @@ command to reload the config and restart the host software.
 Printer is halted
 """
 
+# Helper to collect and report time spent during printer startup
+class StartupProfile:
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.entries = []
+    def note(self, category, name, duration):
+        self.entries.append((category, name, duration))
+    def log_report(self):
+        totals = {}
+        for category, name, duration in self.entries:
+            totals[category] = totals.get(category, 0.) + duration
+        out = ["Startup profile (%s)" % (" ".join(
+            ["%s=%.3f" % (c, t) for c, t in sorted(totals.items())]),)]
+        for category, name, duration in sorted(self.entries,
+                                               key=lambda e: -e[2]):
+            out.append("  %.3f %s %s" % (duration, category, name))
+        logging.info("\n".join(out))
+
 class Printer:
     config_error = configfile.error
     command_error = gcode.CommandError
@@ -35,6 +53,9 @@ class Printer:
         self.run_result = None
         self.event_handlers = {}
         self.objects = collections.OrderedDict()
+        self.startup_profile = None
+        if start_args.get('startup_profile'):
+            self.startup_profile = StartupProfile(main_reactor)
         # Init printer components that must be setup prior to config
         for m in [gcode, webhooks]:
             m.add_early_printer_objects(self)
@@ -42,6 +63,8 @@ class Printer:
         return self.start_args
     def get_reactor(self):
         return self.reactor
+    def get_startup_profile(self):
+        return self.startup_profile
     def get_state_message(self):
         if self.state_message == message_ready:
             category = "ready"
@@ -100,7 +123,13 @@ class Printer:
             if default is not configfile.sentinel:
                 return default
             raise self.config_error("Unable to load module '%s'" % (section,))
+        profile = self.startup_profile
+        start_time = self.reactor.monotonic()
         mod = importlib.import_module('extras.' + module_name)
+        if profile is not None:
+            end_time = self.reactor.monotonic()
+            profile.note("import", module_name, end_time - start_time)
+            start_time = end_time
         init_func = 'load_config'
         if len(module_parts) > 1:
             init_func = 'load_config_prefix'
@@ -110,10 +139,17 @@ class Printer:
                 return default
             raise self.config_error("Unable to load module '%s'" % (section,))
         self.objects[section] = init_func(config.getsection(section))
+        if profile is not None:
+            profile.note("config", section,
+                         self.reactor.monotonic() - start_time)
         return self.objects[section]
     def _read_config(self):
         self.objects['configfile'] = pconfig = configfile.PrinterConfig(self)
+        start_time = self.reactor.monotonic()
         config = pconfig.read_main_config()
+        if self.startup_profile is not None:
+            self.startup_profile.note("parse", "config file",
+                                      self.reactor.monotonic() - start_time)
         if self.bglogger is not None:
             pconfig.log_config(config)
         # Create printer components
@@ -156,6 +192,8 @@ class Printer:
             self._set_state("Internal error during connect: %s\n%s"
                             % (str(e), message_restart,))
             return
+        if self.startup_profile is not None:
+            self.startup_profile.log_report()
         try:
             self._set_state(message_ready)
             for cb in self.event_handlers.get("klippy:ready", []):
@@ -274,6 +312,12 @@ def main():
     opts.add_option("-d", "--dictionary", dest="dictionary", type="string",
                     action="callback", callback=arg_dictionary,
                     help="file to read for mcu protocol dictionary")
+    opts.add_option("--dictionary-cache", dest="dictionary_cache",
+                    help="directory to cache mcu protocol dictionaries")
+    opts.add_option("--stats-file", dest="stats_file",
+                    help="also write periodic statistics to a binary file")
+    opts.add_option("--startup-profile", action="store_true",
+                    help="log the time spent loading each module at startup")
     opts.add_option("--import-test", action="store_true",
                     help="perform an import module test")
     options, args = opts.parse_args()
@@ -293,6 +337,12 @@ def main():
         start_args['gcode_fd'] = debuginput.fileno()
     else:
         start_args['gcode_fd'] = util.create_pty(options.inputtty)
+    if options.startup_profile:
+        start_args['startup_profile'] = True
+    if options.dictionary_cache:
+        start_args['dictionary_cache'] = options.dictionary_cache
+    if options.stats_file:
+        start_args['stats_file'] = options.stats_file
     if options.debugoutput:
         start_args['debugoutput'] = options.debugoutput
         start_args.update(options.dictionary)
@@ -561,7 +561,9 @@ class MCU:
             self._name = self._name[4:]
         # Serial port
         wp = "mcu '%s': " % (self._name)
-        self._serial = serialhdl.SerialReader(self._reactor, warn_prefix=wp)
+        dict_cache_dir = printer.get_start_args().get('dictionary_cache')
+        self._serial = serialhdl.SerialReader(self._reactor, warn_prefix=wp,
+                                              dict_cache_dir=dict_cache_dir)
         self._baud = 0
         self._canbus_iface = None
         canbus_uuid = config.get('canbus_uuid', None)
@@ -614,9 +616,6 @@ class MCU:
         printer.load_object(config, "error_mcu")
         printer.register_event_handler("klippy:firmware_restart",
                                        self._firmware_restart)
-        printer.register_event_handler("klippy:mcu_identify",
-                                       self._mcu_identify)
-        printer.register_event_handler("klippy:connect", self._connect)
         printer.register_event_handler("klippy:shutdown", self._shutdown)
         printer.register_event_handler("klippy:disconnect", self._disconnect)
         printer.register_event_handler("klippy:ready", self._ready)
@@ -778,30 +777,37 @@ class MCU:
         logging.info(move_msg)
         log_info = self._log_info() + "\n" + move_msg
         self._printer.set_rollover_info(self._name, log_info, log=False)
-    def _mcu_identify(self):
+    def _mcu_identify_serial(self):
         if self.is_fileoutput():
             self._connect_file()
-        else:
-            resmeth = self._restart_method
-            if resmeth == 'rpi_usb' and not os.path.exists(self._serialport):
-                # Try toggling usb power
-                self._check_restart("enable power")
-            try:
-                if self._canbus_iface is not None:
-                    cbid = self._printer.lookup_object('canbus_ids')
-                    nodeid = cbid.get_nodeid(self._serialport)
-                    self._serial.connect_canbus(self._serialport, nodeid,
-                                                self._canbus_iface)
-                elif self._baud:
-                    # Cheetah boards require RTS to be deasserted
-                    # else a reset will trigger the built-in bootloader.
-                    rts = (resmeth != "cheetah")
-                    self._serial.connect_uart(self._serialport, self._baud, rts)
-                else:
-                    self._serial.connect_pipe(self._serialport)
-                self._clocksync.connect(self._serial)
-            except serialhdl.error as e:
-                raise error(str(e))
+            return
+        resmeth = self._restart_method
+        if resmeth == 'rpi_usb' and not os.path.exists(self._serialport):
+            # Try toggling usb power
+            self._check_restart("enable power")
+        try:
+            if self._canbus_iface is not None:
+                cbid = self._printer.lookup_object('canbus_ids')
+                nodeid = cbid.get_nodeid(self._serialport)
+                self._serial.connect_canbus(self._serialport, nodeid,
+                                            self._canbus_iface)
+            elif self._baud:
+                # Cheetah boards require RTS to be deasserted
+                # else a reset will trigger the built-in bootloader.
+                rts = (resmeth != "cheetah")
+                self._serial.connect_uart(self._serialport, self._baud, rts)
+            else:
+                self._serial.connect_pipe(self._serialport)
+        except serialhdl.error as e:
+            raise error(str(e))
+    def _mcu_identify_clock(self):
+        if self.is_fileoutput():
+            return
+        try:
+            self._clocksync.connect(self._serial)
+        except serialhdl.error as e:
+            raise error(str(e))
+    def _mcu_identify(self):
         logging.info(self._log_info())
         ppins = self._printer.lookup_object('pins')
         pin_resolver = ppins.get_pin_resolver(self._name)
@@ -911,6 +917,8 @@ class MCU:
         return self._clocksync.estimated_print_time(eventtime)
     def clock32_to_clock64(self, clock32):
         return self._clocksync.clock32_to_clock64(clock32)
+    def get_rtt_histogram(self):
+        return self._serial.get_rtt_histogram()
     # Restarts
     def _disconnect(self):
         self._serial.disconnect()
@@ -1020,14 +1028,85 @@ class MCU:
         self._get_status_info['last_stats'] = last_stats
         return False, '%s: %s' % (self._name, stats)
 
+
+######################################################################
+# MCU startup
+######################################################################
+
+# Identify and configure all micro-controllers concurrently
+class MCUStartup:
+    def __init__(self, printer, main_mcu, secondary_mcus):
+        self._printer = printer
+        self._reactor = printer.get_reactor()
+        self._main_mcu = main_mcu
+        self._secondary_mcus = secondary_mcus
+        self._timing = {}
+        printer.register_event_handler("klippy:mcu_identify",
+                                       self._mcu_identify)
+        printer.register_event_handler("klippy:connect", self._connect)
+    def _run_parallel(self, phase, mcus, method):
+        reactor = self._reactor
+        def run_phase(mcu):
+            def callback(eventtime):
+                start_time = reactor.monotonic()
+                try:
+                    method(mcu)
+                except Exception as e:
+                    # Log here, as the traceback is lost once the error
+                    # is raised from the waiting greenlet
+                    logging.exception("MCU '%s' error during %s",
+                                      mcu.get_name(), phase)
+                    return e, reactor.monotonic() - start_time
+                return None, reactor.monotonic() - start_time
+            return callback
+        completions = [(mcu, reactor.register_callback(run_phase(mcu)))
+                       for mcu in mcus]
+        profile = self._printer.get_startup_profile()
+        errors = []
+        for mcu, completion in completions:
+            err, duration = completion.wait()
+            timing = self._timing.setdefault(mcu.get_name(), [])
+            timing.append("%s=%.3f" % (phase, duration))
+            if profile is not None:
+                profile.note("mcu_" + phase, mcu.get_name(), duration)
+            if err is not None:
+                errors.append((mcu, err))
+        if errors:
+            raise errors[0][1]
+    def _log_timing(self):
+        for mcu in [self._main_mcu] + self._secondary_mcus:
+            name = mcu.get_name()
+            logging.info("MCU '%s' startup timing: %s",
+                         name, " ".join(self._timing.get(name, [])))
+    def _mcu_identify(self):
+        all_mcus = [self._main_mcu] + self._secondary_mcus
+        self._timing.clear()
+        self._run_parallel("identify", all_mcus,
+                           MCU._mcu_identify_serial)
+        # Secondary mcu clocks are synchronized to the main mcu clock
+        self._run_parallel("clocksync", [self._main_mcu],
+                           MCU._mcu_identify_clock)
+        self._run_parallel("clocksync", self._secondary_mcus,
+                           MCU._mcu_identify_clock)
+        for mcu in all_mcus:
+            mcu._mcu_identify()
+    def _connect(self):
+        all_mcus = [self._main_mcu] + self._secondary_mcus
+        self._run_parallel("config", all_mcus, MCU._connect)
+        self._log_timing()
+
 def add_printer_objects(config):
     printer = config.get_printer()
     reactor = printer.get_reactor()
     mainsync = clocksync.ClockSync(reactor)
-    printer.add_object('mcu', MCU(config.getsection('mcu'), mainsync))
+    main_mcu = MCU(config.getsection('mcu'), mainsync)
+    printer.add_object('mcu', main_mcu)
+    secondary_mcus = []
     for s in config.get_prefix_sections('mcu '):
-        printer.add_object(s.section, MCU(
-            s, clocksync.SecondarySync(reactor, mainsync)))
+        secondary_mcu = MCU(s, clocksync.SecondarySync(reactor, mainsync))
+        printer.add_object(s.section, secondary_mcu)
+        secondary_mcus.append(secondary_mcu)
+    MCUStartup(printer, main_mcu, secondary_mcus)
 
 def get_printer_mcu(printer, name):
     if name == 'mcu':
@@ -3,7 +3,7 @@
 # Copyright (C) 2016-2024  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import json, zlib, logging
+import json, zlib, logging, copy
 
 DefaultMessages = {
     "identify_response offset=%u data=%.*s": 0,
@@ -159,6 +159,68 @@ def convert_msg_format(msgformat):
         msgformat = msgformat.replace(c, '%s')
     return msgformat
 
+# Generate specialized python code to encode and parse a message format
+def _gen_encode_param(lines, t, tname):
+    if t.is_int:
+        lines.extend([
+            "if v >= 0xc000000 or v < -0x4000000:"
+            " out.append((v>>28) & 0x7f | 0x80)",
+            "if v >= 0x180000 or v < -0x80000:"
+            " out.append((v>>21) & 0x7f | 0x80)",
+            "if v >= 0x3000 or v < -0x1000:"
+            " out.append((v>>14) & 0x7f | 0x80)",
+            "if v >= 0x60 or v < -0x20:"
+            " out.append((v>>7) & 0x7f | 0x80)",
+            "out.append(v & 0x7f)"])
+    elif t.is_dynamic_string:
+        lines.extend(["out.append(len(v))", "out.extend(bytearray(v))"])
+    else:
+        lines.append("%s.encode(out, v)" % (tname,))
+
+def _gen_parse_param(lines, t, tname, pname):
+    if t.is_int:
+        lines.extend([
+            "c = s[pos]", "pos += 1", "v = c & 0x7f",
+            "if (c & 0x60) == 0x60:", "    v |= -0x20",
+            "while c & 0x80:", "    c = s[pos]", "    pos += 1",
+            "    v = (v<<7) | (c & 0x7f)"])
+        if t.signed:
+            lines.append("%s = v" % (pname,))
+        else:
+            lines.append("%s = int(v & 0xffffffff)" % (pname,))
+    elif t.is_dynamic_string:
+        lines.extend([
+            "l = s[pos]", "%s = bytes(bytearray(s[pos+1:pos+l+1]))" % (pname,),
+            "pos += l+1"])
+    else:
+        lines.append("%s, pos = %s.parse(s, pos)" % (pname, tname))
+
+def compile_message_codec(msgid_bytes, param_names):
+    glbls = {}
+    enc = ["def encode(params):", "out = %s" % (repr(list(msgid_bytes)),)]
+    encn = ["def encode_by_name(**params):",
+            "out = %s" % (repr(list(msgid_bytes)),)]
+    prs = ["def parse(s, pos):", "pos += %d" % (len(msgid_bytes),)]
+    fields = []
+    for i, (name, t) in enumerate(param_names):
+        tname = "t%d" % (i,)
+        glbls[tname] = t
+        enc.append("v = params[%d]" % (i,))
+        _gen_encode_param(enc, t, tname)
+        encn.append("v = params[%s]" % (repr(name),))
+        _gen_encode_param(encn, t, tname)
+        pname = "p%d" % (i,)
+        _gen_parse_param(prs, t, tname, pname)
+        fields.append("%s: %s" % (repr(name), pname))
+    enc.append("return out")
+    encn.append("return out")
+    prs.append("return {%s}, pos" % (", ".join(fields),))
+    code = "\n".join([func[0] + "\n" + "\n".join(["    " + l
+                                                  for l in func[1:]])
+                      for func in [enc, encn, prs]])
+    exec(compile(code, "<msgproto codec>", "exec"), glbls)
+    return glbls['encode'], glbls['encode_by_name'], glbls['parse']
+
 class MessageFormat:
     def __init__(self, msgid_bytes, msgformat, enumerations={}):
         self.msgid_bytes = msgid_bytes
@@ -168,23 +230,10 @@ class MessageFormat:
         self.param_names = lookup_params(msgformat, enumerations)
         self.param_types = [t for name, t in self.param_names]
         self.name_to_type = dict(self.param_names)
-    def encode(self, params):
-        out = list(self.msgid_bytes)
-        for i, t in enumerate(self.param_types):
-            t.encode(out, params[i])
-        return out
-    def encode_by_name(self, **params):
-        out = list(self.msgid_bytes)
-        for name, t in self.param_names:
-            t.encode(out, params[name])
-        return out
-    def parse(self, s, pos):
-        pos += len(self.msgid_bytes)
-        out = {}
-        for name, t in self.param_names:
-            v, pos = t.parse(s, pos)
-            out[name] = v
-        return out, pos
+        # Specialized encode(params), encode_by_name(**params), and
+        # parse(s, pos) functions for this message format
+        self.encode, self.encode_by_name, self.parse = compile_message_codec(
+            msgid_bytes, self.param_names)
     def format_params(self, params):
         out = []
         for name, t in self.param_names:
@@ -234,6 +283,7 @@ class MessageParser:
         self.messages_by_name = {}
         self.msgid_by_format = {}
         self.msgid_parser = PT_int32()
+        self.command_cache = {}
         self.config = {}
         self.version = self.build_versions = ""
         self.raw_identify_data = ""
@@ -307,6 +357,9 @@ class MessageParser:
         out.reverse()
         return out
     def lookup_command(self, msgformat):
+        mp = self.command_cache.get(msgformat)
+        if mp is not None:
+            return mp
         parts = msgformat.strip().split()
         msgname = parts[0]
         mp = self.messages_by_name.get(msgname)
@@ -315,6 +368,7 @@ class MessageParser:
         if msgformat != mp.msgformat:
             self._error("Command format mismatch: %s vs %s",
                         msgformat, mp.msgformat)
+        self.command_cache[msgformat] = mp
         return mp
     def lookup_msgid(self, msgformat):
         msgid = self.msgid_by_format.get(msgformat)
@@ -372,6 +426,7 @@ class MessageParser:
                 for i in range(count):
                     enums[enum_root + str(start_enum + i)] = start_value + i
     def _init_messages(self, messages, command_ids=[], output_ids=[]):
+        self.command_cache.clear()
         for msgformat, msgid in messages.items():
             msgtype = 'response'
             if msgid in command_ids:
@@ -412,6 +467,12 @@ class MessageParser:
         except Exception as e:
             logging.exception("process_identify error")
             self._error("Error during identify: %s", str(e))
+    def copy_parser(self, warn_prefix=""):
+        # Share the already processed message formats with a new parser
+        mp = copy.copy(self)
+        mp.warn_prefix = warn_prefix
+        mp.command_cache = {}
+        return mp
     def get_raw_data_dictionary(self):
         return self.raw_identify_data
     def get_version_info(self):
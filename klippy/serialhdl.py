@@ -3,7 +3,7 @@
 # Copyright (C) 2016-2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, threading, os
+import logging, threading, os, re
 import serial
 
 import msgproto, chelper, util
@@ -11,10 +11,63 @@ import msgproto, chelper, util
 class error(Exception):
     pass
 
+# Number of round-trip-time buckets (<1ms, <2ms, <4ms, ..., >=64ms)
+RTT_HISTOGRAM_BUCKETS = 8
+
+######################################################################
+# Data dictionary cache
+######################################################################
+
+# Parsed data dictionaries (shared across printer restarts)
+parsed_dictionaries = {}
+
+# Storage of firmware data dictionaries on disk
+class DictionaryCache:
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+    def _filename(self, cache_key):
+        name = re.sub(r'[^A-Za-z0-9_.-]', '_', cache_key).strip('_')
+        return os.path.join(self.cache_dir, name + ".dict")
+    def load(self, cache_key):
+        try:
+            f = open(self._filename(cache_key), 'rb')
+            data = f.read()
+            f.close()
+        except (IOError, OSError):
+            return None
+        return data
+    def save(self, cache_key, data):
+        fname = self._filename(cache_key)
+        tmpname = fname + ".tmp"
+        try:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            f = open(tmpname, 'wb')
+            f.write(data)
+            f.close()
+            os.rename(tmpname, fname)
+        except (IOError, OSError):
+            logging.exception("Unable to write data dictionary cache %s",
+                              fname)
+
+# The zlib trailer holds a checksum of the uncompressed data dictionary
+def get_dictionary_hash(identify_data):
+    checksum = "".join(["%02x" % (c,) for c in bytearray(identify_data[-4:])])
+    return "%d:%s" % (len(identify_data), checksum)
+
+
+######################################################################
+# Serial port communication
+######################################################################
+
 class SerialReader:
-    def __init__(self, reactor, warn_prefix=""):
+    def __init__(self, reactor, warn_prefix="", dict_cache_dir=None):
         self.reactor = reactor
         self.warn_prefix = warn_prefix
+        # Data dictionary cache
+        self.dict_cache = self.dict_cache_key = None
+        if dict_cache_dir is not None:
+            self.dict_cache = DictionaryCache(dict_cache_dir)
         # Serial port
         self.serial_dev = None
         self.msgparser = msgproto.MessageParser(warn_prefix=warn_prefix)
@@ -59,7 +112,31 @@ class SerialReader:
                                   self.warn_prefix)
     def _error(self, msg, *params):
         raise error(self.warn_prefix + (msg % params))
+    def _get_cached_identify_data(self):
+        # Verify that the mcu still reports the cached data dictionary
+        identify_data = self.dict_cache.load(self.dict_cache_key)
+        if identify_data is None or len(identify_data) < 8:
+            return None
+        tail_offset = len(identify_data) - 4
+        for offset in [0, tail_offset]:
+            msg = "identify offset=%d count=%d" % (offset, 40)
+            try:
+                params = self.send_with_response(msg, 'identify_response')
+            except error as e:
+                return None
+            if (params['offset'] != offset
+                or params['data'] != identify_data[offset:offset+40]):
+                logging.info("%sFirmware data dictionary changed",
+                             self.warn_prefix)
+                return None
+        logging.info("%sUsing cached data dictionary (%s)", self.warn_prefix,
+                     get_dictionary_hash(identify_data))
+        return identify_data
     def _get_identify_data(self, eventtime):
+        if self.dict_cache is not None and self.dict_cache_key is not None:
+            identify_data = self._get_cached_identify_data()
+            if identify_data is not None:
+                return identify_data
         # Query the "data dictionary" from the micro-controller
         identify_data = b""
         while 1:
@@ -74,6 +151,10 @@ class SerialReader:
                 msgdata = params['data']
                 if not msgdata:
                     # Done
+                    if (self.dict_cache is not None
+                        and self.dict_cache_key is not None):
+                        self.dict_cache.save(self.dict_cache_key,
+                                             identify_data)
                     return identify_data
                 identify_data += msgdata
     def _start_session(self, serial_dev, serial_fd_type=b'u', client_id=0):
@@ -91,8 +172,14 @@ class SerialReader:
             logging.info("%sTimeout on connect", self.warn_prefix)
             self.disconnect()
             return False
-        msgparser = msgproto.MessageParser(warn_prefix=self.warn_prefix)
-        msgparser.process_identify(identify_data)
+        dict_hash = get_dictionary_hash(identify_data)
+        msgparser = parsed_dictionaries.get(dict_hash)
+        if msgparser is not None:
+            msgparser = msgparser.copy_parser(self.warn_prefix)
+        else:
+            msgparser = msgproto.MessageParser(warn_prefix=self.warn_prefix)
+            msgparser.process_identify(identify_data)
+            parsed_dictionaries[dict_hash] = msgparser
         self.msgparser = msgparser
         self.register_response(self.handle_unknown, '#unknown')
         # Setup baud adjust
@@ -110,6 +197,7 @@ class SerialReader:
         return True
     def connect_canbus(self, canbus_uuid, canbus_nodeid, canbus_iface="can0"):
         import can # XXX
+        self.dict_cache_key = "canbus-" + canbus_uuid
         txid = canbus_nodeid * 2 + 256
         filters = [{"can_id": txid+1, "can_mask": 0x7ff, "extended": False}]
         # Prep for SET_NODEID command
@@ -158,6 +246,7 @@ class SerialReader:
                          self.warn_prefix)
             self.disconnect()
     def connect_pipe(self, filename):
+        self.dict_cache_key = filename
         logging.info("%sStarting connect", self.warn_prefix)
         start_time = self.reactor.monotonic()
         while 1:
@@ -176,6 +265,7 @@ class SerialReader:
                 break
     def connect_uart(self, serialport, baud, rts=True):
         # Initial connection
+        self.dict_cache_key = serialport
         logging.info("%sStarting serial connect", self.warn_prefix)
         start_time = self.reactor.monotonic()
         while 1:
@@ -223,6 +313,13 @@ class SerialReader:
         self.ffi_lib.serialqueue_get_stats(self.serialqueue,
                                            self.stats_buf, len(self.stats_buf))
         return str(self.ffi_main.string(self.stats_buf).decode())
+    def get_rtt_histogram(self):
+        if self.serialqueue is None:
+            return []
+        hist = self.ffi_main.new('uint32_t[%d]' % (RTT_HISTOGRAM_BUCKETS,))
+        self.ffi_lib.serialqueue_get_rtt_histogram(self.serialqueue, hist,
+                                                   len(hist))
+        return list(hist)
     def get_reactor(self):
         return self.reactor
     def get_msgparser(self):
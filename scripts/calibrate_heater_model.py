@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# Identify the thermal model of a heater for "control: model"
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import optparse
+import numpy as np
+
+# Model (see ControlModel in klippy/extras/heaters.py):
+#   dT/dt = gain*pwm - loss*(T - ambient)
+# The fan and extruder flow terms of the model can not be identified
+# here as neither changes during a PID_CALIBRATE test.
+
+# Parse a heater log as produced by "PID_CALIBRATE ... WRITE_FILE=1".
+# Lines are either "<time> <temp>" or "pwm: <time> <value>".
+def parse_log(logname):
+    temps = []
+    pwm = []
+    f = open(logname, 'r')
+    for line in f:
+        parts = line.split()
+        if not parts or parts[0].startswith('#'):
+            continue
+        if parts[0] == 'pwm:':
+            pwm.append((float(parts[1]), float(parts[2])))
+        elif not parts[0].endswith(':'):
+            temps.append((float(parts[0]), float(parts[1])))
+    f.close()
+    return np.array(temps), np.array(pwm)
+
+# Value of a step-wise input at each of the given times
+def step_values(samples, times):
+    idx = np.searchsorted(samples[:,0], times, side='right') - 1
+    return np.where(idx >= 0, samples[np.maximum(idx, 0), 1], 0.)
+
+def cumulative_integral(times, values):
+    areas = .5 * (values[1:] + values[:-1]) * np.diff(times)
+    return np.concatenate(([0.], np.cumsum(areas)))
+
+def fit_model(temps, pwm_samples, window):
+    times, temp = temps[:,0], temps[:,1]
+    pwm = step_values(pwm_samples, times)
+    # Fit the integrated form of the model over each window to avoid
+    # differentiating noisy temperature measurements
+    lag = max(1, int(round(window / np.median(np.diff(times)))))
+    def span(values):
+        integ = cumulative_integral(times, values)
+        return integ[lag:] - integ[:-lag]
+    temp_change = temp[lag:] - temp[:-lag]
+    a = np.column_stack([span(pwm), -span(temp), span(np.ones(len(times)))])
+    coeffs = np.linalg.lstsq(a, temp_change, rcond=None)[0]
+    residual = temp_change - a.dot(coeffs)
+    gain, loss, offset = coeffs
+    model = {'model_gain': gain, 'model_loss': loss,
+             'model_ambient_temp': offset / loss if loss else 0.}
+    return model, np.sqrt(np.mean(residual**2))
+
+def main():
+    usage = "%prog [options] <heattest.txt>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-w", "--window", type="float", dest="window",
+                    default=5., help="fit window in seconds (default 5)")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    temps, pwm = parse_log(args[0])
+    if len(temps) < 2 or not len(pwm):
+        opts.error("Log does not contain temperature and pwm samples")
+    model, rms = fit_model(temps, pwm, options.window)
+    if model['model_gain'] <= 0. or model['model_loss'] < 0.:
+        print("Unable to identify a valid model: %s" % (model,))
+        return
+    print("Model fit error (rms over %.1fs windows): %.3f"
+          % (options.window, rms))
+    print("control: model")
+    for name in ['model_gain', 'model_loss', 'model_ambient_temp']:
+        print("%s: %.6f" % (name, model[name]))
+
+if __name__ == '__main__':
+    main()
@@ -18,9 +18,43 @@ APPLY_PREFIX = [
     'target', 'temp', 'pwm'
 ]
 
+# Convert a binary stats file (klippy.py --stats-file) to parse_log() format
+def parse_stats_file(logname, mcu):
+    import statsfile
+    sampletimes, columns = statsfile.load_stats(logname)
+    apply_prefix = { p: 1 for p in APPLY_PREFIX }
+    # Map columns to parse_log() names (selected mcu stats take priority)
+    names = []
+    for column, values in sorted(columns.items()):
+        prefix, sep, name = column.rpartition(':')
+        if prefix == mcu:
+            names.append((1, name, values))
+        elif prefix and name in apply_prefix:
+            names.append((0, column, values))
+        else:
+            names.append((0, name, values))
+    names.sort(key=lambda n: n[0])
+    out = []
+    for i, sampletime in enumerate(sampletimes):
+        keyparts = {}
+        for priority, name, values in names:
+            val = values[i]
+            if val == val:
+                keyparts[name] = '%.15g' % (val,)
+        if 'print_time' not in keyparts:
+            continue
+        keyparts['#sampletime'] = float(sampletime)
+        out.append(keyparts)
+    return out
+
 def parse_log(logname, mcu):
     if mcu is None:
         mcu = "mcu"
+    f = open(logname, 'rb')
+    magic = f.read(9)
+    f.close()
+    if magic == b"KLSTATS1\n":
+        return parse_stats_file(logname, mcu)
     mcu_prefix = mcu + ":"
     apply_prefix = { p: 1 for p in APPLY_PREFIX }
     f = open(logname, 'r')
@@ -4,7 +4,8 @@
 # Copyright (C) 2017  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import sys, re, collections, ast, itertools
+import sys, os, re, collections, ast, itertools, json, zlib, optparse
+import mmap, multiprocessing
 
 def format_comment(line_num, line):
     return "# %6d: %s" % (line_num, line)
@@ -519,14 +520,11 @@ class StatsStream:
 
 # Main handler for creating shutdown diagnostics file
 class GatherShutdown:
-    def __init__(self, configs, line_num, recent_lines, logname):
+    def __init__(self, config_filename, line_num, recent_lines, logname):
         self.filename = "%s.shutdown%05d" % (logname, line_num)
         self.comments = []
-        if configs:
-            configs_by_id = {c.config_num: c for c in configs.values()}
-            config = configs_by_id[max(configs_by_id.keys())]
-            config.add_comment(format_comment(line_num, recent_lines[-1][1]))
-            self.comments.append("# config %s" % (config.filename,))
+        if config_filename is not None:
+            self.comments.append("# config %s" % (config_filename,))
         self.stats_stream = StatsStream(line_num, logname)
         self.active_streams = [self.stats_stream]
         self.all_streams = list(self.active_streams)
@@ -572,44 +570,260 @@ class GatherShutdown:
             f.writelines(lines)
 
 
+######################################################################
+# Log index
+######################################################################
+
+INDEX_VERSION = 1
+MAX_RECENT_LINES = 200
+
+eol_s = b"[ \t\r\f\v]*$"
+index_stats_r = re.compile(b"^Stats " + time_s.encode() + b": ", re.M)
+index_config_end_r = re.compile(b"^=======================" + eol_s, re.M)
+index_shutdown_end_r = re.compile(
+    b"^(?:Stats " + time_s.encode() + b": |Git version|Start printer at"
+    + b"|===== Config file =====" + eol_s + b")", re.M)
+
+# Locate lines that may start a config or shutdown region
+class IndexMarkerFinder:
+    line_markers = [b'Git version', b'Start printer at',
+                    b'===== Config file =====', b'Dumping ']
+    def __init__(self, data):
+        self.data = data
+        self.markers = self.line_markers + [b'shutdown: ']
+        self.next_lines = [None] * len(self.markers)
+    def _search(self, marker, pos):
+        data = self.data
+        if marker in self.line_markers:
+            if not pos and data[:len(marker)] == marker:
+                return 0
+            i = data.find(b'\n' + marker, max(0, pos - 1))
+            if i < 0:
+                return -1
+            return i + 1
+        i = data.find(marker, pos)
+        if i < 0:
+            return -1
+        return data.rfind(b'\n', 0, i) + 1
+    def find(self, pos):
+        # Return the start of the first candidate line at or after pos
+        best = -1
+        for i, marker in enumerate(self.markers):
+            next_line = self.next_lines[i]
+            if next_line is None or 0 <= next_line < pos:
+                self.next_lines[i] = next_line = self._search(marker, pos)
+            if next_line >= 0 and (best < 0 or next_line < best):
+                best = next_line
+        return best
+
+class IndexLineCounter:
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+        self.line_num = 1
+    def get_line_num(self, pos):
+        self.line_num += self.data[self.pos:pos].count(b'\n')
+        self.pos = pos
+        return self.line_num
+
+# Find the config and shutdown regions of a log file.  This follows the
+# same state transitions as main() did with GatherConfig and
+# GatherShutdown, but searches the raw file for marker strings so that
+# uninteresting lines are skipped quickly.
+def build_index(logname):
+    regions = []
+    last_git = last_start = None
+    with open(logname, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file
+            return regions
+        counter = IndexLineCounter(data)
+        finder = IndexMarkerFinder(data)
+        def get_line_end(pos):
+            end = data.find(b'\n', pos)
+            if end < 0:
+                return len(data)
+            return end
+        pos = recent_pos = 0
+        while 1:
+            start = finder.find(pos)
+            if start < 0:
+                break
+            end = get_line_end(start)
+            line = data[start:end].rstrip()
+            line_num = counter.get_line_num(start)
+            pos = end + 1
+            if line.startswith(b'Git version'):
+                last_git = format_comment(line_num, line.decode(
+                    'utf-8', 'replace'))
+            elif line.startswith(b'Start printer at'):
+                last_start = format_comment(line_num, line.decode(
+                    'utf-8', 'replace'))
+            elif line == b'===== Config file =====':
+                regions.append({'type': 'config', 'line_num': line_num,
+                                'offset': start,
+                                'comments': [last_git, last_start]})
+                m = index_config_end_r.search(data, pos)
+                if m is None:
+                    break
+                pos = recent_pos = get_line_end(m.start()) + 1
+            elif b'shutdown: ' in line or line.startswith(b'Dumping '):
+                # Shutdown parsing starts with up to 200 recent lines
+                first_line_num = line_num
+                first_pos = start
+                while (first_pos > recent_pos
+                       and line_num - first_line_num < MAX_RECENT_LINES - 1):
+                    first_pos = data.rfind(b'\n', 0, first_pos - 1) + 1
+                    first_line_num -= 1
+                first_stat_time = None
+                for m in index_stats_r.finditer(data, first_pos, end):
+                    first_stat_time = float(m.group('time'))
+                regions.append({'type': 'shutdown', 'line_num': line_num,
+                                'line': line.decode('utf-8', 'replace'),
+                                'first_line_num': first_line_num,
+                                'offset': first_pos,
+                                'comments': [last_git, last_start]})
+                # Find the line that ends the shutdown
+                while 1:
+                    m = index_shutdown_end_r.search(data, pos)
+                    if m is None:
+                        pos = len(data)
+                        break
+                    pos = m.start()
+                    if m.group('time') is None:
+                        break
+                    last_stat_time = float(m.group('time'))
+                    if first_stat_time is None:
+                        first_stat_time = last_stat_time
+                    if last_stat_time > first_stat_time + 5.:
+                        break
+                    pos = get_line_end(pos) + 1
+                # The ending line is still checked for a new region
+                recent_pos = get_line_end(pos) + 1
+        data.close()
+    return regions
+
+def get_file_id(logname):
+    st = os.stat(logname)
+    with open(logname, 'rb') as f:
+        head = f.read(65536)
+    return [st.st_size, int(st.st_mtime), zlib.adler32(head)]
+
+# Load the on-disk index of a log (building it if needed)
+def load_index(logname):
+    index_filename = "%s.index" % (logname,)
+    file_id = get_file_id(logname)
+    try:
+        with open(index_filename, 'rt') as f:
+            index = json.load(f)
+        if (index.get('version') == INDEX_VERSION
+            and index.get('file_id') == file_id):
+            return index['regions']
+    except (IOError, OSError, ValueError):
+        pass
+    regions = build_index(logname)
+    index = {'version': INDEX_VERSION, 'file_id': file_id,
+             'regions': regions}
+    try:
+        with open(index_filename, 'wt') as f:
+            json.dump(index, f)
+    except (IOError, OSError):
+        pass
+    return regions
+
+
 ######################################################################
 # Startup
 ######################################################################
 
+def read_lines(f, line_num):
+    for raw_line in f:
+        yield line_num, raw_line.decode('utf-8', 'replace').rstrip()
+        line_num += 1
+
+def extract_config(logname, configs, region):
+    handler = GatherConfig(configs, region['line_num'], None, logname)
+    for comment in region['comments']:
+        handler.add_comment(comment)
+    with open(logname, 'rb') as f:
+        f.seek(region['offset'])
+        lines = read_lines(f, region['line_num'])
+        next(lines)
+        for line_num, line in lines:
+            if not handler.add_line(line_num, line):
+                return
+    handler.finalize()
+
+def extract_shutdown(args):
+    logname, config_filename, region = args
+    line_num = region['line_num']
+    with open(logname, 'rb') as f:
+        f.seek(region['offset'])
+        lines = read_lines(f, region['first_line_num'])
+        recent_lines = [next(lines)
+                        for i in range(line_num - region['first_line_num']
+                                       + 1)]
+        handler = GatherShutdown(config_filename, line_num,
+                                 recent_lines, logname)
+        for comment in region['comments']:
+            handler.add_comment(comment)
+        for line_num, line in lines:
+            if not handler.add_line(line_num, line):
+                return
+    handler.finalize()
+
 def main():
-    logname = sys.argv[1]
-    last_git = last_start = None
+    usage = "%prog [options] <klippy.log>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-j", "--jobs", type="int", dest="jobs", default=0,
+                    help="number of shutdowns to process in parallel")
+    opts.add_option("-l", "--list", action="store_true",
+                    help="list the config and shutdown regions of the log")
+    opts.add_option("-s", "--shutdown", type="int", dest="shutdown",
+                    default=None, help="only extract the shutdown that"
+                    " starts at the given line number")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    logname = args[0]
+    regions = load_index(logname)
+    if options.list:
+        for region in regions:
+            print("%7d: %s" % (region['line_num'], region.get(
+                'line', "config file")))
+        return
+    # Extract config files and find the config of each shutdown
     configs = {}
-    handler = None
-    recent_lines = collections.deque([], 200)
-    # Parse log file
-    with open(logname, 'rt') as f:
-        for line_num, line in enumerate(f):
-            line = line.rstrip()
-            line_num += 1
-            recent_lines.append((line_num, line))
-            if handler is not None:
-                ret = handler.add_line(line_num, line)
-                if ret:
-                    continue
-                recent_lines.clear()
-                handler = None
-            if line.startswith('Git version'):
-                last_git = format_comment(line_num, line)
-            elif line.startswith('Start printer at'):
-                last_start = format_comment(line_num, line)
-            elif line == '===== Config file =====':
-                handler = GatherConfig(configs, line_num,
-                                       recent_lines, logname)
-                handler.add_comment(last_git)
-                handler.add_comment(last_start)
-            elif 'shutdown: ' in line or line.startswith('Dumping '):
-                handler = GatherShutdown(configs, line_num,
-                                         recent_lines, logname)
-                handler.add_comment(last_git)
-                handler.add_comment(last_start)
-    if handler is not None:
-        handler.finalize()
+    shutdowns = []
+    for region in regions:
+        if region['type'] == 'config':
+            extract_config(logname, configs, region)
+            continue
+        config_filename = None
+        if configs:
+            configs_by_id = {c.config_num: c for c in configs.values()}
+            config = configs_by_id[max(configs_by_id.keys())]
+            config.add_comment(format_comment(region['line_num'],
+                                              region['line']))
+            config_filename = config.filename
+        if options.shutdown in (None, region['line_num']):
+            shutdowns.append((logname, config_filename, region))
+    if options.shutdown is not None:
+        if not shutdowns:
+            opts.error("No shutdown at line %d" % (options.shutdown,))
+        extract_shutdown(shutdowns[0])
+        return
+    # Extract shutdowns
+    if len(shutdowns) > 1 and options.jobs != 1:
+        pool = multiprocessing.Pool(options.jobs or None)
+        pool.map(extract_shutdown, shutdowns, chunksize=1)
+        pool.close()
+        pool.join()
+    else:
+        for shutdown in shutdowns:
+            extract_shutdown(shutdown)
     # Write found config files
     for cfg in configs.values():
         cfg.write_file()
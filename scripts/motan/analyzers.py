@@ -3,9 +3,13 @@
 # Copyright (C) 2021  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import math, collections
+import math, collections, os, tempfile
+import numpy as np
 import readlog
 
+# Number of samples processed at a time by the analyzers
+ANALYSIS_CHUNK = 1 << 16
+
 
 ######################################################################
 # Analysis code
@@ -14,6 +18,26 @@ import readlog
 # Analyzer handlers: {name: class, ...}
 AHandlers = {}
 
+# Evaluate "res[i] = weight * res[i-1] + data[i]" (with res[-1] = prev).
+# Uses a closed form over blocks short enough that weight**-blocklen
+# stays small (and thus numerically stable).
+def decay_filter(data, weight, prev):
+    res = np.empty(len(data))
+    if weight <= 0.:
+        res[:] = data
+        return res
+    block_len = len(data)
+    if weight < 1.:
+        block_len = max(1, int(math.log(16.) / -math.log(weight)))
+    powers = weight ** np.arange(min(block_len, len(data)))
+    for start in range(0, len(data), block_len):
+        block = data[start:start+block_len]
+        p = powers[:len(block)]
+        res[start:start+len(block)] = p * (weight * prev
+                                           + np.cumsum(block / p))
+        prev = res[start+len(block)-1]
+    return res
+
 # Calculate a derivative (position to velocity, or velocity to accel)
 class GenDerivative:
     ParametersMin = ParametersMax = 1
@@ -41,9 +65,16 @@ class GenDerivative:
     def generate_data(self):
         inv_seg_time = 1. / self.amanager.get_segment_time()
         data = self.amanager.get_datasets()[self.source]
-        deriv = [(data[i+1] - data[i]) * inv_seg_time
-                 for i in range(len(data)-1)]
-        return [deriv[0]] + deriv
+        res = self.amanager.alloc_dataset()
+        for start, end in self.amanager.get_chunks():
+            start = max(1, start)
+            diff = data[start:end] - data[start-1:end-1]
+            res[start:end] = diff * inv_seg_time
+        if len(res) > 1:
+            res[0] = res[1]
+        else:
+            res[:] = 0.
+        return res
 AHandlers["derivative"] = GenDerivative
 
 # Calculate an integral (accel to velocity, or velocity to position)
@@ -85,23 +116,31 @@ class GenIntegral:
     def generate_data(self):
         seg_time = self.amanager.get_segment_time()
         src = self.amanager.get_datasets()[self.source]
-        offset = sum(src) / len(src)
+        chunks = self.amanager.get_chunks()
+        data = self.amanager.alloc_dataset()
+        if not len(src):
+            return data
+        offset = math.fsum([math.fsum(src[s:e]) for s, e in chunks]) / len(src)
         total = 0.
+        src_weight = 1.
         ref = None
         if self.ref is not None:
             ref = self.amanager.get_datasets()[self.ref]
             offset -= (ref[-1] - ref[0]) / (len(src) * seg_time)
             total = ref[0]
-            src_weight = 1.
             if self.half_life:
                 src_weight = math.exp(math.log(.5) * seg_time / self.half_life)
-            ref_weight = 1. - src_weight
-        data = [0.] * len(src)
-        for i, v in enumerate(src):
-            total += (v - offset) * seg_time
-            if ref is not None:
-                total = src_weight * total + ref_weight * ref[i]
-            data[i] = total
+        ref_weight = 1. - src_weight
+        for start, end in chunks:
+            incr = (src[start:end] - offset) * seg_time
+            if ref is None or src_weight == 1.:
+                # Sum in order (matching a sample by sample accumulation)
+                data[start:end] = np.cumsum(np.concatenate(([total], incr)))[1:]
+            else:
+                data[start:end] = decay_filter(
+                    src_weight * incr + ref_weight * ref[start:end],
+                    src_weight, total)
+            total = data[end-1]
         return data
 AHandlers["integral"] = GenIntegral
 
@@ -145,16 +184,16 @@ class GenNorm2:
         lname += ' ' + data_name + ' norm2'
         return {'label': lname, 'units': units}
     def generate_data(self):
-        seg_time = self.amanager.get_segment_time()
         data = []
         for dataset in self.datasets:
             data.append(self.amanager.get_datasets()[dataset])
-        res = [0.] * len(data[0])
-        for i in range(len(data[0])):
+        res = self.amanager.alloc_dataset()
+        for start, end in self.amanager.get_chunks():
             norm2 = 0.
             for dataset in data:
-                norm2 += dataset[i] * dataset[i]
-            res[i] = math.sqrt(norm2)
+                d = dataset[start:end]
+                norm2 = norm2 + d * d
+            res[start:end] = np.sqrt(norm2)
         return res
 AHandlers["norm2"] = GenNorm2
 
@@ -181,18 +220,27 @@ class GenSmoothed:
         seg_time = self.amanager.get_segment_time()
         src = self.amanager.get_datasets()[self.source]
         n = len(src)
-        data = [0.] * n
+        data = self.amanager.alloc_dataset()
         hst = 0.5 * self.smooth_time
         seg_half_len = round(hst / seg_time)
-        inv_norm = 1. / sum([min(k + 1, seg_half_len + seg_half_len - k)
-                             for k in range(2 * seg_half_len)])
-        for i in range(n):
+        k = np.arange(2 * seg_half_len)
+        weights = np.minimum(k + 1, seg_half_len + seg_half_len - k)
+        inv_norm = 1. / weights.sum()
+        # Samples with a full window (weights are symmetric)
+        for start, end in self.amanager.get_chunks():
+            start = max(start, seg_half_len)
+            end = min(end, n - seg_half_len + 1)
+            if start >= end:
+                continue
+            window = src[start-seg_half_len:end+seg_half_len-1]
+            data[start:end] = np.convolve(window, weights, 'valid') * inv_norm
+        # Samples near the start and end of the data (truncated window)
+        edges = list(range(min(n, seg_half_len)))
+        edges += range(max(seg_half_len, n - seg_half_len + 1), n)
+        for i in edges:
             j = max(0, i - seg_half_len)
             je = min(n, i + seg_half_len)
-            avg_val = 0.
-            for k, v in enumerate(src[j:je]):
-                avg_val += v * min(k + 1, seg_half_len + seg_half_len - k)
-            data[i] = avg_val * inv_norm
+            data[i] = np.dot(src[j:je], weights[:je-j]) * inv_norm
         return data
 AHandlers["smooth"] = GenSmoothed
 
@@ -229,14 +277,12 @@ class GenKinematicPosition:
         return {'label': 'Position', 'units': 'Position\n(mm)'}
     def generate_data_corexy_plus(self):
         datasets = self.amanager.get_datasets()
-        data1 = datasets[self.source1]
-        data2 = datasets[self.source2]
-        return [d1 + d2 for d1, d2 in zip(data1, data2)]
+        return self.amanager.apply_chunked(
+            np.add, datasets[self.source1], datasets[self.source2])
     def generate_data_corexy_minus(self):
         datasets = self.amanager.get_datasets()
-        data1 = datasets[self.source1]
-        data2 = datasets[self.source2]
-        return [d1 - d2 for d1, d2 in zip(data1, data2)]
+        return self.amanager.apply_chunked(
+            np.subtract, datasets[self.source1], datasets[self.source2])
     def generate_data_passthrough(self):
         return self.amanager.get_datasets()[self.source1]
 AHandlers["kin"] = GenKinematicPosition
@@ -265,8 +311,10 @@ class GenCorexyPosition:
         data1 = datasets[self.source1]
         data2 = datasets[self.source2]
         if self.is_plus:
-            return [.5 * (d1 + d2) for d1, d2 in zip(data1, data2)]
-        return [.5 * (d1 - d2) for d1, d2 in zip(data1, data2)]
+            func = lambda d1, d2: .5 * (d1 + d2)
+        else:
+            func = lambda d1, d2: .5 * (d1 - d2)
+        return self.amanager.apply_chunked(func, data1, data2)
 AHandlers["corexy"] = GenCorexyPosition
 
 # Calculate a position deviation
@@ -290,9 +338,8 @@ class GenDeviation:
         return {'label': label1['label'] + ' deviation', 'units': units}
     def generate_data(self):
         datasets = self.amanager.get_datasets()
-        data1 = datasets[self.source1]
-        data2 = datasets[self.source2]
-        return [d1 - d2 for d1, d2 in zip(data1, data2)]
+        return self.amanager.apply_chunked(
+            np.subtract, datasets[self.source1], datasets[self.source2])
 AHandlers["deviation"] = GenDeviation
 
 
@@ -319,8 +366,13 @@ class AnalyzerManager:
         self.datasets = {}
         self.dataset_times = []
         self.duration = 5.
+        self.num_samples = 0
+        self.scratch_dir = None
     def set_duration(self, duration):
         self.duration = duration
+    def set_scratch_dir(self, scratch_dir):
+        # Store datasets in memory mapped files (for large captures)
+        self.scratch_dir = scratch_dir
     def get_segment_time(self):
         return self.segment_time
     def get_datasets(self):
@@ -329,6 +381,25 @@ class AnalyzerManager:
         return self.dataset_times
     def get_initial_status(self):
         return self.lmanager.get_initial_status()
+    def alloc_dataset(self, count=None):
+        if count is None:
+            count = self.num_samples
+        if self.scratch_dir is None:
+            return np.zeros(count)
+        fd, fname = tempfile.mkstemp(prefix="motan-", suffix=".npy",
+                                       dir=self.scratch_dir)
+        os.close(fd)
+        res = np.lib.format.open_memmap(fname, mode='w+', shape=(count,))
+        os.unlink(fname)
+        return res
+    def get_chunks(self):
+        return [(start, min(start + ANALYSIS_CHUNK, self.num_samples))
+                for start in range(0, self.num_samples, ANALYSIS_CHUNK)]
+    def apply_chunked(self, func, *datasets):
+        res = self.alloc_dataset()
+        for start, end in self.get_chunks():
+            res[start:end] = func(*[d[start:end] for d in datasets])
+        return res
     def setup_dataset(self, name):
         name = name.strip()
         if name in self.raw_datasets:
@@ -359,16 +430,29 @@ class AnalyzerManager:
         return hdl.get_label()
     def generate_datasets(self):
         # Generate raw data
-        list_hdls = [(self.datasets[name], hdl)
-                     for name, hdl in self.raw_datasets.items()]
         initial_start_time = self.lmanager.get_initial_start_time()
         start_time = t = self.lmanager.get_start_time()
         end_time = start_time + self.duration
+        max_count = int(self.duration / self.segment_time) + 2
+        dataset_times = self.alloc_dataset(max_count)
+        list_hdls = [(name, hdl.pull_data, self.alloc_dataset(max_count))
+                     for name, hdl in self.raw_datasets.items()]
+        count = 0
         while t < end_time:
-            t += self.segment_time
-            self.dataset_times.append(t - initial_start_time)
-            for dl, hdl in list_hdls:
-                dl.append(hdl.pull_data(t))
+            times = []
+            while t < end_time and len(times) < ANALYSIS_CHUNK:
+                t += self.segment_time
+                times.append(t)
+            end = count + len(times)
+            dataset_times[count:end] = times
+            for name, pull_data, dl in list_hdls:
+                dl[count:end] = [pull_data(rt) for rt in times]
+            count = end
+        self.num_samples = count
+        self.dataset_times = dataset_times[:count]
+        self.dataset_times -= initial_start_time
+        for name, pull_data, dl in list_hdls:
+            self.datasets[name] = dl[:count]
         # Generate analyzer data
         for name, hdl in self.gen_datasets.items():
             self.datasets[name] = hdl.generate_data()
@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+# Columnar, memory mapped cache of the datasets in a data_logger.py log
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, json, array, shutil
+import numpy as np
+import readlog
+
+CACHE_VERSION = 1
+CACHE_BLOCK_TIME = 1.
+
+
+######################################################################
+# Log message conversion
+######################################################################
+
+# Build a set of columns from the rows of a subscription's messages
+class ConvertColumns:
+    def __init__(self, columns):
+        self.columns = columns
+        self.data = [array.array('d') for c in columns]
+    def get_columns(self):
+        return self.columns
+    def add_rows(self, rows):
+        for col, values in zip(self.data, zip(*rows)):
+            col.extend(values)
+    def add_msg(self, params):
+        self.add_rows(params['data'])
+    def finish(self):
+        return [np.frombuffer(col, dtype=np.float64) for col in self.data]
+
+# Sensor samples (eg, adxl345 "[time, x, y, z]")
+def ConvertSamples(columns):
+    return lambda: ConvertColumns(columns)
+
+# Angle samples along with the position_offset in effect for them
+class ConvertAngle(ConvertColumns):
+    def __init__(self):
+        ConvertColumns.__init__(self, ['time', 'angle', 'position_offset'])
+        self.position_offset = 0.
+    def add_msg(self, params):
+        position_offset = params.get('position_offset')
+        if position_offset is not None:
+            self.position_offset = position_offset
+        po = self.position_offset
+        self.add_rows([(t, a, po) for t, a in params['data']])
+
+# Flatten trapq moves into one column per field
+TRAPQ_COLUMNS = ['time', 'move_t', 'start_v', 'accel', 'start_x', 'start_y',
+                 'start_z', 'axes_r_x', 'axes_r_y', 'axes_r_z']
+
+class ConvertTrapQ(ConvertColumns):
+    def __init__(self):
+        ConvertColumns.__init__(self, TRAPQ_COLUMNS)
+    def add_msg(self, params):
+        self.add_rows([(pt, mt, sv, a, sp[0], sp[1], sp[2], ar[0], ar[1], ar[2])
+                       for pt, mt, sv, a, sp, ar in params['data']])
+
+# Expand queue_step messages into (time, half_position, position) steps
+class ConvertStepQ(ConvertColumns):
+    def __init__(self):
+        ConvertColumns.__init__(self, ['time', 'half_position', 'position'])
+        self.is_first = True
+    def add_msg(self, params):
+        data = params['data']
+        if not data:
+            return
+        step_pos = params['start_position']
+        if self.is_first:
+            self.add_rows([(0., step_pos, step_pos)])
+            self.is_first = False
+        intervals, counts, adds = [np.array(c, dtype=np.int64)
+                                   for c in zip(*data)]
+        first_clock = params['first_clock']
+        cdiff = params['last_clock'] - first_clock
+        tdiff = params['last_step_time'] - params['first_step_time']
+        inv_freq = 0.
+        if cdiff:
+            inv_freq = tdiff / cdiff
+        # Step k (from 0) of a queue_step is at:
+        #   base + (k+1)*interval + add*k*(k+1)/2
+        scounts = np.abs(counts)
+        advance = scounts * intervals + adds * scounts * (scounts - 1) // 2
+        bases = np.cumsum(advance) - advance + first_clock - data[0][0]
+        qidx = np.repeat(np.arange(len(data)), scounts)
+        k = np.arange(len(qidx)) - np.repeat(np.cumsum(scounts) - scounts,
+                                             scounts)
+        clocks = (bases[qidx] + (k + 1) * intervals[qidx]
+                  + adds[qidx] * k * (k + 1) // 2)
+        times = params['first_step_time'] + (clocks - first_clock) * inv_freq
+        step_dist = params['step_distance']
+        dists = np.where(counts[qidx] < 0, -step_dist, step_dist)
+        # Accumulate in order so positions match a step by step summation
+        positions = np.cumsum(np.concatenate(([step_pos], dists)))
+        halfpos = positions[:-1] + .5 * dists
+        for col, values in zip(self.data, [times, halfpos, positions[1:]]):
+            col.extend(values.tolist())
+
+# Subscription types that can be cached: {type: converter class, ...}
+Converters = {
+    'trapq': ConvertTrapQ,
+    'stepq': ConvertStepQ,
+    'adxl345': ConvertSamples(['time', 'x', 'y', 'z']),
+    'lis2dw': ConvertSamples(['time', 'x', 'y', 'z']),
+    'mpu9250': ConvertSamples(['time', 'x', 'y', 'z']),
+    'angle': ConvertAngle,
+    'ldc1612': ConvertSamples(['time', 'frequency', 'z']),
+}
+
+def get_cache_dir(log_prefix):
+    return log_prefix + ".cache"
+
+def get_source_id(log_prefix):
+    st = os.stat(log_prefix + ".json.gz")
+    return [st.st_size, st.st_mtime]
+
+# Read a log and write each dataset as a directory of .npy columns
+def build_cache(log_prefix):
+    source_id = get_source_id(log_prefix)
+    converters = {}
+    log_reader = readlog.JsonLogReader(log_prefix + ".json.gz")
+    while 1:
+        json_msg = log_reader.pull_msg()
+        if json_msg is None:
+            break
+        qid = json_msg.get('q')
+        if qid is None or 'params' not in json_msg:
+            continue
+        conv = converters.get(qid)
+        if conv is None:
+            cls = Converters.get(qid.split(':')[0])
+            if cls is None:
+                continue
+            converters[qid] = conv = cls()
+        conv.add_msg(json_msg['params'])
+    # Write columns to a temporary directory and then move into place
+    cache_dir = get_cache_dir(log_prefix)
+    tmp_dir = cache_dir + ".tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.mkdir(tmp_dir)
+    datasets = {}
+    for i, (qid, conv) in enumerate(sorted(converters.items())):
+        columns = conv.get_columns()
+        data = conv.finish()
+        times = data[0]
+        if np.any(times[1:] < times[:-1]):
+            order = np.argsort(times, kind='stable')
+            data = [col[order] for col in data]
+        dirname = "ds%d" % (i,)
+        os.mkdir(os.path.join(tmp_dir, dirname))
+        for name, col in zip(columns, data):
+            np.save(os.path.join(tmp_dir, dirname, name + ".npy"), col)
+        datasets[qid] = {'dir': dirname, 'columns': columns,
+                         'count': len(times)}
+    manifest = {'version': CACHE_VERSION, 'source': source_id,
+                'datasets': datasets}
+    f = open(os.path.join(tmp_dir, "index.json"), "w")
+    json.dump(manifest, f)
+    f.close()
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.rename(tmp_dir, cache_dir)
+
+
+######################################################################
+# Cached dataset access
+######################################################################
+
+# Memory mapped columns of one dataset (sorted by the 'time' column)
+class CachedDataset:
+    def __init__(self, path, info):
+        self.columns = {}
+        for name in info['columns']:
+            fname = os.path.join(path, info['dir'], name + ".npy")
+            if info['count']:
+                self.columns[name] = np.load(fname, mmap_mode='r')
+            else:
+                self.columns[name] = np.zeros(0)
+        self.times = self.columns['time']
+        self.pos = None
+    # Return the rows of the next block of data (starting with the
+    # last row at or before req_time on the first call)
+    def pull_block(self, req_time, columns, split_column=None):
+        times = self.times
+        pos = self.pos
+        if pos is None:
+            pos = max(0, np.searchsorted(times, req_time, side='right') - 1)
+        if pos >= len(times):
+            return None
+        end = np.searchsorted(times, times[pos] + CACHE_BLOCK_TIME,
+                              side='right')
+        end = max(end, pos + 1)
+        if split_column is not None:
+            # Don't return rows with differing values of split_column
+            col = self.columns[split_column][pos:end]
+            changes = np.flatnonzero(col != col[0])
+            if len(changes):
+                end = pos + changes[0]
+        self.pos = end
+        return list(zip(*[self.columns[c][pos:end].tolist()
+                          for c in columns]))
+
+# Provide data_logger style messages (as used by the readlog log
+# handlers) from a cached dataset
+class CachedDispatch:
+    def __init__(self, dataset, columns):
+        self.dataset = dataset
+        self.columns = columns
+    def pull_msg(self, req_time, name):
+        rows = self.dataset.pull_block(req_time, self.columns)
+        if rows is None:
+            return None
+        return {'data': rows}
+
+class CachedTrapQDispatch(CachedDispatch):
+    def pull_msg(self, req_time, name):
+        rows = self.dataset.pull_block(req_time, self.columns)
+        if rows is None:
+            return None
+        return {'data': [(r[0], r[1], r[2], r[3], r[4:7], r[7:10])
+                         for r in rows]}
+
+class CachedAngleDispatch(CachedDispatch):
+    def pull_msg(self, req_time, name):
+        rows = self.dataset.pull_block(req_time, self.columns + [
+            'position_offset'], split_column='position_offset')
+        if rows is None:
+            return None
+        return {'data': [r[:2] for r in rows], 'position_offset': rows[0][2]}
+
+class CachedTrapQ(readlog.HandleTrapQ):
+    def __init__(self, lmanager, name, name_parts):
+        readlog.HandleTrapQ.__init__(self, lmanager, name, name_parts)
+        dataset = lmanager.get_dataset_cache().lookup_dataset(name_parts)
+        self.jdispatch = CachedTrapQDispatch(dataset, TRAPQ_COLUMNS)
+
+class CachedStepQ(readlog.HandleStepQ):
+    def __init__(self, lmanager, name, name_parts):
+        readlog.HandleStepQ.__init__(self, lmanager, name, name_parts)
+        self.dataset = lmanager.get_dataset_cache().lookup_dataset(name_parts)
+    def _pull_block(self, req_time):
+        step_data = self.step_data
+        del step_data[:-1]
+        self.data_pos = 0
+        rows = self.dataset.pull_block(req_time, ['time', 'half_position',
+                                                  'position'])
+        if rows is None:
+            last_time, last_halfpos, last_pos = step_data[0]
+            step_data.append((req_time + .1, last_pos, last_pos))
+            return
+        step_data.extend(rows)
+
+class CachedADXL345(readlog.HandleADXL345):
+    def __init__(self, lmanager, name, name_parts):
+        readlog.HandleADXL345.__init__(self, lmanager, name, name_parts)
+        dataset = lmanager.get_dataset_cache().lookup_dataset(name_parts)
+        self.jdispatch = CachedDispatch(dataset, ['time', 'x', 'y', 'z'])
+
+class CachedAngle(readlog.HandleAngle):
+    def __init__(self, lmanager, name, name_parts):
+        readlog.HandleAngle.__init__(self, lmanager, name, name_parts)
+        dataset = lmanager.get_dataset_cache().lookup_dataset(name_parts)
+        self.jdispatch = CachedAngleDispatch(dataset, ['time', 'angle'])
+
+class CachedEddyCurrent(readlog.HandleEddyCurrent):
+    def __init__(self, lmanager, name, name_parts):
+        readlog.HandleEddyCurrent.__init__(self, lmanager, name, name_parts)
+        dataset = lmanager.get_dataset_cache().lookup_dataset(name_parts)
+        self.jdispatch = CachedDispatch(dataset, ['time', 'frequency', 'z'])
+
+# Cached replacements for log handlers: {name: class, ...}
+CachedHandlers = {
+    'trapq': CachedTrapQ, 'stepq': CachedStepQ, 'adxl345': CachedADXL345,
+    'angle': CachedAngle, 'ldc1612': CachedEddyCurrent,
+}
+
+# Access to a dataset cache built by build_cache()
+class DatasetCache:
+    def __init__(self, path, manifest):
+        self.path = path
+        self.manifest = manifest
+    def lookup_handler(self, handler_name, subscription_id):
+        if subscription_id not in self.manifest['datasets']:
+            return None
+        return CachedHandlers.get(handler_name)
+    def lookup_dataset(self, name_parts):
+        subscription_id = ":".join(name_parts[:2])
+        info = self.manifest['datasets'][subscription_id]
+        return CachedDataset(self.path, info)
+
+# Open the cache for a log (returns None if not present or out of date)
+def load_cache(log_prefix):
+    cache_dir = get_cache_dir(log_prefix)
+    try:
+        f = open(os.path.join(cache_dir, "index.json"), "r")
+        manifest = json.load(f)
+        f.close()
+    except (IOError, OSError, ValueError):
+        return None
+    if (manifest.get('version') != CACHE_VERSION
+        or manifest.get('source') != get_source_id(log_prefix)):
+        return None
+    return DatasetCache(cache_dir, manifest)
+
+def main():
+    usage = "%prog [options] <logname>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-f", "--force", action="store_true",
+                    help="rebuild the cache even if it is up to date")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    log_prefix = args[0]
+    if not options.force and load_cache(log_prefix) is not None:
+        sys.stdout.write("Dataset cache is up to date\n")
+        return
+    build_cache(log_prefix)
+    dcache = load_cache(log_prefix)
+    for qid, info in sorted(dcache.manifest['datasets'].items()):
+        sys.stdout.write("%-32s: %d rows\n" % (qid, info['count']))
+
+if __name__ == '__main__':
+    main()
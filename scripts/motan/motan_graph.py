@@ -6,7 +6,7 @@
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import sys, optparse, ast
 import matplotlib
-import readlog, analyzers
+import readlog, analyzers, datacache
 try:
     import urlparse
 except:
@@ -109,6 +109,10 @@ def main():
     opts.add_option("-g", "--graph", help="Graph to generate (python literal)")
     opts.add_option("-l", "--list-datasets", action="store_true",
                     help="List available datasets")
+    opts.add_option("-c", "--cache", action="store_true",
+                    help="Use (building if needed) a columnar dataset cache")
+    opts.add_option("--scratch-dir", type="string", default=None,
+                    help="Directory for disk backed storage of datasets")
     options, args = opts.parse_args()
     if options.list_datasets:
         list_datasets()
@@ -119,9 +123,18 @@ def main():
     # Open data files
     lmanager = readlog.LogManager(log_prefix)
     lmanager.setup_index()
+    if options.cache:
+        dcache = datacache.load_cache(log_prefix)
+        if dcache is None:
+            sys.stderr.write("Building dataset cache...\n")
+            datacache.build_cache(log_prefix)
+            dcache = datacache.load_cache(log_prefix)
+        lmanager.set_dataset_cache(dcache)
     lmanager.seek_time(options.skip)
     amanager = analyzers.AnalyzerManager(lmanager, options.segment_time)
     amanager.set_duration(options.duration)
+    if options.scratch_dir is not None:
+        amanager.set_scratch_dir(options.scratch_dir)
 
     # Default graphs to draw
     graph_descs = [
@@ -639,6 +639,7 @@ class LogManager:
         self.start_status = {}
         self.log_subscriptions = {}
         self.status_tracker = None
+        self.dataset_cache = None
     def setup_index(self):
         fmsg = self.index_reader.pull_msg()
         self.initial_status = status = fmsg['status']
@@ -652,6 +653,10 @@ class LogManager:
         return {name: None for name in LogHandlers}
     def get_jdispatch(self):
         return self.jdispatch
+    def set_dataset_cache(self, dataset_cache):
+        self.dataset_cache = dataset_cache
+    def get_dataset_cache(self):
+        return self.dataset_cache
     def seek_time(self, req_time):
         self.start_time = req_start_time = self.initial_start_time + req_time
         start_status = self.start_status
@@ -693,6 +698,14 @@ class LogManager:
             subscription_id = ":".join(name_parts[:cls.SubscriptionIdParts])
             if subscription_id not in self.log_subscriptions:
                 raise error("Dataset '%s' not in capture" % (subscription_id,))
-            self.jdispatch.add_handler(name, subscription_id)
+            cached_cls = None
+            if self.dataset_cache is not None:
+                cached_cls = self.dataset_cache.lookup_handler(name_parts[0],
+                                                               subscription_id)
+            if cached_cls is not None:
+                # Read from the columnar cache instead of the json log
+                cls = cached_cls
+            else:
+                self.jdispatch.add_handler(name, subscription_id)
         self.datasets[name] = hdl = cls(self, name, name_parts)
         return hdl
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# Check the NumPy based analyzers against the reference loop
+# implementations
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, math, optparse, tempfile, shutil, time
+import numpy as np
+import readlog, analyzers
+
+# Reference implementations (one loop iteration per sample)
+def ref_derivative(amanager, src):
+    inv_seg_time = 1. / amanager.get_segment_time()
+    deriv = [(src[i+1] - src[i]) * inv_seg_time for i in range(len(src)-1)]
+    return [deriv[0]] + deriv
+
+def ref_integral(amanager, src, ref=None, half_life=0.015):
+    seg_time = amanager.get_segment_time()
+    offset = sum(src) / len(src)
+    total = 0.
+    if ref is not None:
+        offset -= (ref[-1] - ref[0]) / (len(src) * seg_time)
+        total = ref[0]
+        src_weight = 1.
+        if half_life:
+            src_weight = math.exp(math.log(.5) * seg_time / half_life)
+        ref_weight = 1. - src_weight
+    data = [0.] * len(src)
+    for i, v in enumerate(src):
+        total += (v - offset) * seg_time
+        if ref is not None:
+            total = src_weight * total + ref_weight * ref[i]
+        data[i] = total
+    return data
+
+def ref_norm2(amanager, *datasets):
+    return [math.sqrt(sum([d[i] * d[i] for d in datasets]))
+            for i in range(len(datasets[0]))]
+
+def ref_smooth(amanager, src, smooth_time=0.01):
+    seg_time = amanager.get_segment_time()
+    n = len(src)
+    data = [0.] * n
+    seg_half_len = round(.5 * smooth_time / seg_time)
+    inv_norm = 1. / sum([min(k + 1, seg_half_len + seg_half_len - k)
+                         for k in range(2 * seg_half_len)])
+    for i in range(n):
+        j = max(0, i - seg_half_len)
+        je = min(n, i + seg_half_len)
+        avg_val = 0.
+        for k, v in enumerate(src[j:je]):
+            avg_val += v * min(k + 1, seg_half_len + seg_half_len - k)
+        data[i] = avg_val * inv_norm
+    return data
+
+def ref_corexy(amanager, axis, src1, src2):
+    if axis == 'x':
+        return [.5 * (d1 + d2) for d1, d2 in zip(src1, src2)]
+    return [.5 * (d1 - d2) for d1, d2 in zip(src1, src2)]
+
+def ref_deviation(amanager, src1, src2):
+    return [d1 - d2 for d1, d2 in zip(src1, src2)]
+
+# Datasets to check: (dataset name, reference function, arguments)
+TESTS = [
+    ('derivative(src(a))', ref_derivative, ['src(a)']),
+    ('integral(src(a))', ref_integral, ['src(a)']),
+    ('integral(src(a),src(b))', ref_integral, ['src(a)', 'src(b)']),
+    ('integral(src(a),src(b),0.002)', ref_integral,
+     ['src(a)', 'src(b)', 0.002]),
+    ('integral(src(a),src(b),0)', ref_integral, ['src(a)', 'src(b)', 0.]),
+    ('norm2(src(a),src(b))', ref_norm2, ['src(a)', 'src(b)']),
+    ('norm2(src(a),src(b),src(c))', ref_norm2,
+     ['src(a)', 'src(b)', 'src(c)']),
+    ('smooth(src(a))', ref_smooth, ['src(a)']),
+    ('smooth(src(c),0.05)', ref_smooth, ['src(c)', 0.05]),
+    ('smooth(src(c),0.0002)', ref_smooth, ['src(c)', 0.0002]),
+    ('corexy(x,src(a),src(b))', ref_corexy, ['x', 'src(a)', 'src(b)']),
+    ('corexy(y,src(a),src(b))', ref_corexy, ['y', 'src(a)', 'src(b)']),
+    ('deviation(src(a),src(b))', ref_deviation, ['src(a)', 'src(b)']),
+]
+
+# Synthetic log data source
+class TestDataset:
+    def __init__(self, func):
+        self.func = func
+    def pull_data(self, req_time):
+        return self.func(req_time)
+    def get_label(self):
+        return {'label': 'Test position', 'units': 'Position\n(mm)'}
+
+class TestLogManager:
+    error = readlog.error
+    def __init__(self):
+        noise = np.random.RandomState(42).randn(1 << 16)
+        self.funcs = {
+            'src(a)': lambda t: (10. * math.sin(37. * t)
+                                 + .01 * noise[int(t * 1e4) % len(noise)]),
+            'src(b)': lambda t: 5. * math.cos(11. * t) + t,
+            'src(c)': lambda t: noise[int(t * 3e4) % len(noise)],
+        }
+    def available_dataset_types(self):
+        return {'src': None}
+    def setup_dataset(self, name):
+        return TestDataset(self.funcs[name])
+    def get_initial_start_time(self):
+        return 10.
+    def get_start_time(self):
+        return 12.
+    def get_initial_status(self):
+        return {'configfile': {'settings': {'printer': {
+            'kinematics': 'corexy'}}}}
+
+def check_parity(duration, segment_time, scratch_dir):
+    amanager = analyzers.AnalyzerManager(TestLogManager(), segment_time)
+    amanager.set_duration(duration)
+    if scratch_dir is not None:
+        amanager.set_scratch_dir(scratch_dir)
+    for name, func, args in TESTS:
+        amanager.setup_dataset(name)
+    start = time.time()
+    amanager.generate_datasets()
+    sys.stdout.write("Generated %d samples in %.3fs\n"
+                     % (len(amanager.get_dataset_times()),
+                        time.time() - start))
+    datasets = amanager.get_datasets()
+    failures = 0
+    for name, func, args in TESTS:
+        args = [datasets[a].tolist() if a in datasets else a for a in args]
+        ref = np.array(func(amanager, *args))
+        res = np.asarray(datasets[name])
+        if len(ref) != len(res):
+            sys.stdout.write("%s: length %d vs %d\n"
+                             % (name, len(res), len(ref)))
+            failures += 1
+            continue
+        err = np.max(np.abs(res - ref)) / max(1., np.max(np.abs(ref)))
+        status = "ok"
+        if err > 1e-9:
+            status = "FAILED"
+            failures += 1
+        sys.stdout.write("%-32s max error %.3g %s\n" % (name, err, status))
+    return failures
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-d", "--duration", type="float", dest="duration",
+                    default=7., help="seconds of data to generate")
+    opts.add_option("-s", "--segment-time", type="float", dest="segment_time",
+                    default=0.0001, help="analysis segment time")
+    opts.add_option("-m", "--memmap", action="store_true", dest="memmap",
+                    help="store datasets in memory mapped scratch files")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    scratch_dir = None
+    if options.memmap:
+        scratch_dir = tempfile.mkdtemp(prefix="motan-test-")
+    try:
+        failures = check_parity(options.duration, options.segment_time,
+                                scratch_dir)
+    finally:
+        if scratch_dir is not None:
+            shutil.rmtree(scratch_dir)
+    if failures:
+        sys.stdout.write("%d datasets differ from the reference\n"
+                         % (failures,))
+        sys.exit(1)
+    sys.stdout.write("All datasets match the reference\n")
+
+if __name__ == '__main__':
+    main()
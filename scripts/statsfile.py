@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# Load a binary stats file (klippy.py --stats-file) into NumPy arrays
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import optparse, struct
+import numpy as np
+
+STATS_FILE_MAGIC = b"KLSTATS1\n"
+
+# The file contains layout records ('L' count [len name]...) each
+# followed by any number of fixed size sample records
+# ('R' eventtime value...).  Each run of samples is loaded in one step.
+def _read_runs(filename):
+    f = open(filename, 'rb')
+    data = f.read()
+    f.close()
+    buf = np.frombuffer(data, dtype=np.uint8)
+    if not data.startswith(STATS_FILE_MAGIC):
+        raise ValueError("'%s' is not a stats file" % (filename,))
+    pos = len(STATS_FILE_MAGIC)
+    names = None
+    runs = []
+    while pos < len(data):
+        tag = data[pos:pos+1]
+        if tag == b'L':
+            if pos + 3 > len(data):
+                break
+            count = struct.unpack_from('<H', data, pos + 1)[0]
+            pos += 3
+            new_names = []
+            for i in range(count):
+                if pos + 2 > len(data):
+                    return runs
+                nlen = struct.unpack_from('<H', data, pos)[0]
+                new_names.append(data[pos+2:pos+2+nlen].decode())
+                pos += 2 + nlen
+            if pos > len(data):
+                break
+            names = new_names
+        elif tag == b'R' and names is not None:
+            row_size = 9 + 8 * len(names)
+            # Find the end of this run of samples (next non-sample tag)
+            tags = buf[pos::row_size]
+            others = np.flatnonzero(tags != ord('R'))
+            count = others[0] if len(others) else len(tags)
+            count = min(count, (len(data) - pos) // row_size)
+            if not count:
+                break
+            dtype = np.dtype([('tag', 'u1'), ('time', '<f8'),
+                              ('values', '<f8', (len(names),))])
+            rows = np.frombuffer(buf, dtype=dtype, count=count, offset=pos)
+            runs.append((names, rows['time'], rows['values']))
+            pos += count * row_size
+        else:
+            raise ValueError("Invalid record in '%s' at offset %d"
+                             % (filename, pos))
+    return runs
+
+# Returns (sampletimes, {column_name: values}) with NaN for samples
+# where a column was not reported
+def load_stats(filename):
+    runs = _read_runs(filename)
+    all_names = sorted(set([n for names, t, v in runs for n in names]))
+    total = sum([len(times) for names, times, values in runs])
+    sampletimes = np.empty(total)
+    columns = {name: np.full(total, np.nan) for name in all_names}
+    offset = 0
+    for names, times, values in runs:
+        end = offset + len(times)
+        sampletimes[offset:end] = times
+        for i, name in enumerate(names):
+            columns[name][offset:end] = values[:,i]
+        offset = end
+    return sampletimes, columns
+
+def main():
+    usage = "%prog [options] <stats file>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-c", "--csv", type="string", dest="csv",
+                    default=None, help="write all columns to a csv file")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    sampletimes, columns = load_stats(args[0])
+    if not len(sampletimes):
+        print("No samples found")
+        return
+    print("%d samples from %.1f to %.1f" % (
+        len(sampletimes), sampletimes[0], sampletimes[-1]))
+    for name in sorted(columns):
+        values = columns[name]
+        valid = values[~np.isnan(values)]
+        if len(valid):
+            print("  %s: %d samples, min=%g max=%g" % (
+                name, len(valid), valid.min(), valid.max()))
+    if options.csv is not None:
+        names = sorted(columns)
+        data = np.column_stack([sampletimes] + [columns[n] for n in names])
+        np.savetxt(options.csv, data, delimiter=',', fmt='%.15g',
+                   header=','.join(['#sampletime'] + names), comments='')
+
+if __name__ == '__main__':
+    main()
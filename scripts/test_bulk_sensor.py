@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# Stress test of the BulkDataQueue single producer / single consumer queue
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, threading, time
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+from extras import bulk_sensor
+
+# Minimal stand-in for an mcu (registers the queue's message handler)
+class TestMCU:
+    def __init__(self):
+        self.handler = None
+    def register_response(self, cb, msg_name, oid=None):
+        self.handler = cb
+
+# Check that every message of every queue was received in order
+def check_sequences(name, received):
+    for i, seqs in enumerate(received):
+        if seqs != list(range(len(seqs))):
+            raise Exception("%s: sensor %d lost or reordered messages"
+                            % (name, i))
+
+# Several simulated sensors delivered from one serial thread at a
+# fixed sample rate, while the reactor thread pulls periodically
+def stress_sensors(num_sensors, rate, samples_per_msg, duration,
+                   pull_interval):
+    mcus = [TestMCU() for i in range(num_sensors)]
+    queues = [bulk_sensor.BulkDataQueue(mcu, oid=i)
+              for i, mcu in enumerate(mcus)]
+    serial_lock = threading.Lock()
+    done = threading.Event()
+    stats = {'max_handler_time': 0.}
+    def serial_thread():
+        msg_period = samples_per_msg / float(rate)
+        data = b'\0' * (samples_per_msg * 3)
+        start = time.time()
+        count = 0
+        while time.time() - start < duration:
+            for mcu in mcus:
+                params = {'sequence': count, 'data': data}
+                handler_start = time.time()
+                with serial_lock:
+                    mcu.handler(params)
+                stats['max_handler_time'] = max(stats['max_handler_time'],
+                                                time.time() - handler_start)
+            count += 1
+            delay = start + count * msg_period - time.time()
+            if delay > 0.:
+                time.sleep(delay)
+        done.set()
+    received = [[] for q in queues]
+    thread = threading.Thread(target=serial_thread)
+    thread.start()
+    while not done.is_set():
+        time.sleep(pull_interval)
+        for q, seqs in zip(queues, received):
+            seqs.extend([p['sequence'] for p in q.pull_queue()])
+    thread.join()
+    for q, seqs in zip(queues, received):
+        seqs.extend([p['sequence'] for p in q.pull_queue()])
+    check_sequences("sensors", received)
+    sys.stdout.write("%d sensors: %.0f samples/s each, max handler"
+                     " time %.3fms\n"
+                     % (num_sensors, len(received[0]) * samples_per_msg
+                        / duration, stats['max_handler_time'] * 1000.))
+
+# A producer adding messages as fast as possible against a consumer
+# that pulls continuously
+def stress_flood(count):
+    mcu = TestMCU()
+    q = bulk_sensor.BulkDataQueue(mcu)
+    def producer():
+        handler = mcu.handler
+        for i in range(count):
+            handler({'sequence': i})
+    received = []
+    start = time.time()
+    thread = threading.Thread(target=producer)
+    thread.start()
+    while thread.is_alive():
+        received.extend([p['sequence'] for p in q.pull_queue()])
+    thread.join()
+    received.extend([p['sequence'] for p in q.pull_queue()])
+    if len(received) != count:
+        raise Exception("flood: received %d of %d messages"
+                        % (len(received), count))
+    check_sequences("flood", [received])
+    sys.stdout.write("flood: %d messages in %.3fs\n"
+                     % (count, time.time() - start))
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--sensors", type="int", dest="sensors", default=4,
+                    help="number of simulated sensors")
+    opts.add_option("-r", "--rate", type="float", dest="rate", default=5000.,
+                    help="samples per second of each sensor")
+    opts.add_option("-d", "--duration", type="float", dest="duration",
+                    default=3., help="duration of the sensor test")
+    opts.add_option("-c", "--count", type="int", dest="count",
+                    default=1000000, help="messages in the flood test")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    stress_sensors(options.sensors, options.rate, 16, options.duration,
+                   bulk_sensor.BATCH_INTERVAL)
+    stress_flood(options.count)
+    sys.stdout.write("All messages received in order\n")
+
+if __name__ == '__main__':
+    main()
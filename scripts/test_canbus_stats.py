@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# Check the host side canbus transport statistics using a loopback
+# stand-in for a canbus node
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, socket, struct, threading, time
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import chelper, msgproto
+from extras import canbus_stats
+
+# Layout of a Linux "struct can_frame"
+CAN_FRAME_FMT = "<IB3x8s"
+CAN_FRAME_SIZE = struct.calcsize(CAN_FRAME_FMT)
+CANBUS_FREQUENCY = 1000000
+
+# Minimal canbus node that acknowledges the message blocks it receives.
+# A SOCK_SEQPACKET socket pair keeps the frame boundaries of a canbus
+# socket, so no vcan interface is needed.
+class LoopbackNode:
+    def __init__(self, sock, txid):
+        self.sock = sock
+        self.txid = txid
+        self.data = bytearray()
+        self.frames_read = self.frames_write = 0
+        self.bytes_read = self.blocks = self.invalid = 0
+        self.drop_acks = False
+        self.thread = threading.Thread(target=self._read_thread)
+        self.thread.daemon = True
+        self.thread.start()
+    def _send_ack(self, seq):
+        block = bytearray([msgproto.MESSAGE_MIN, msgproto.MESSAGE_DEST
+                           | ((seq + 1) & msgproto.MESSAGE_SEQ_MASK)])
+        block += bytearray(msgproto.crc16_ccitt(block))
+        block.append(msgproto.MESSAGE_SYNC)
+        for pos in range(0, len(block), 8):
+            chunk = bytes(block[pos:pos+8])
+            self.sock.send(struct.pack(CAN_FRAME_FMT, self.txid + 1,
+                                       len(chunk), chunk))
+            self.frames_write += 1
+    def _parse_blocks(self):
+        data = self.data
+        while data and data[0] == msgproto.MESSAGE_SYNC:
+            # Retransmits start with a sync byte
+            del data[:1]
+        while len(data) >= msgproto.MESSAGE_MIN:
+            msglen = data[msgproto.MESSAGE_POS_LEN]
+            if msglen < msgproto.MESSAGE_MIN or msglen > msgproto.MESSAGE_MAX:
+                self._resync()
+                continue
+            if len(data) < msglen:
+                return
+            sync = data[msglen-msgproto.MESSAGE_TRAILER_SYNC]
+            if sync != msgproto.MESSAGE_SYNC:
+                self._resync()
+                continue
+            seq = data[msgproto.MESSAGE_POS_SEQ]
+            del data[:msglen]
+            self.blocks += 1
+            if not self.drop_acks:
+                self._send_ack(seq & msgproto.MESSAGE_SEQ_MASK)
+    def _resync(self):
+        # Discard data up to the next sync byte
+        self.invalid += 1
+        pos = self.data.find(bytearray([msgproto.MESSAGE_SYNC]))
+        del self.data[:pos + 1 if pos >= 0 else len(self.data)]
+    def _read_thread(self):
+        while 1:
+            try:
+                frame = self.sock.recv(CAN_FRAME_SIZE)
+            except socket.error:
+                return
+            if not frame:
+                return
+            can_id, dlc, data = struct.unpack(CAN_FRAME_FMT, frame)
+            if can_id != self.txid or dlc > 8:
+                self.invalid += 1
+                continue
+            self.frames_read += 1
+            self.bytes_read += dlc
+            self.data += data[:dlc]
+            self._parse_blocks()
+
+# Host side transport (the serialqueue in canbus mode)
+class HostTransport:
+    def __init__(self, sock, txid):
+        self.ffi_main, self.ffi_lib = chelper.get_ffi()
+        self.sock = sock
+        self.serialqueue = self.ffi_main.gc(
+            self.ffi_lib.serialqueue_alloc(sock.fileno(), b'c', txid),
+            self.ffi_lib.serialqueue_free)
+        self.cmd_queue = self.ffi_main.gc(
+            self.ffi_lib.serialqueue_alloc_commandqueue(),
+            self.ffi_lib.serialqueue_free_commandqueue)
+        self.ffi_lib.serialqueue_set_wire_frequency(self.serialqueue,
+                                                    CANBUS_FREQUENCY)
+    def send(self, count, size):
+        for i in range(count):
+            msg = bytes(bytearray([(i + j) & 0x7f for j in range(size)]))
+            self.ffi_lib.serialqueue_send(self.serialqueue, self.cmd_queue,
+                                          msg, len(msg), 0, 0, 0)
+    def get_stats(self):
+        buf = self.ffi_main.new('char[4096]')
+        self.ffi_lib.serialqueue_get_stats(self.serialqueue, buf, len(buf))
+        stats = self.ffi_main.string(buf).decode()
+        parts = [s.split('=', 1) for s in stats.split()]
+        return {k: (float(v) if '.' in v else int(v)) for k, v in parts}
+    def get_rtt_histogram(self):
+        hist = self.ffi_main.new('uint32_t[8]')
+        self.ffi_lib.serialqueue_get_rtt_histogram(self.serialqueue, hist,
+                                                   len(hist))
+        return list(hist)
+    def close(self):
+        self.ffi_lib.serialqueue_exit(self.serialqueue)
+
+# Stand-in for the mcu object used by canbus_stats
+class TestMCU:
+    def __init__(self, transport):
+        self.transport = transport
+    def get_status(self, eventtime):
+        return {'last_stats': self.transport.get_stats()}
+    def get_rtt_histogram(self):
+        return self.transport.get_rtt_histogram()
+
+def check(desc, cond):
+    if not cond:
+        raise Exception("Check failed: %s" % (desc,))
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-c", "--count", type="int", dest="count", default=40,
+                    help="number of commands to send in each phase")
+    opts.add_option("-s", "--size", type="int", dest="size", default=10,
+                    help="size of each command")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    txid = 256 + 2 * 3
+    host_sock, node_sock = socket.socketpair(socket.AF_UNIX,
+                                             socket.SOCK_SEQPACKET)
+    node = LoopbackNode(node_sock, txid)
+    transport = HostTransport(host_sock, txid)
+    cbs = canbus_stats.PrinterCANBusStats.__new__(
+        canbus_stats.PrinterCANBusStats)
+    cbs.mcu = TestMCU(transport)
+    cbs.canbus_frequency = CANBUS_FREQUENCY
+    cbs.status = {'rx_error': None}
+    cbs.last_host_stats = None
+    cbs.host_status = {}
+    try:
+        # Normal traffic
+        cbs._update_host_stats(time.time())
+        transport.send(options.count, options.size)
+        time.sleep(.5)
+        stats = transport.get_stats()
+        check("frames written", stats['can_frames_write'] == node.frames_read)
+        check("frames read", stats['can_frames_read'] == node.frames_write)
+        check("bytes written", stats['bytes_write'] == node.bytes_read)
+        check("no retransmits", stats['bytes_retransmit'] == 0)
+        check("rtt histogram", sum(transport.get_rtt_histogram()) > 0)
+        # Lost acknowledgments result in retransmits
+        node.drop_acks = True
+        transport.send(options.count, options.size)
+        time.sleep(.5)
+        node.drop_acks = False
+        time.sleep(1.)
+        stats = transport.get_stats()
+        check("frames written (retransmit)",
+              stats['can_frames_write'] == node.frames_read)
+        check("retransmits", stats['bytes_retransmit'] > 0)
+        check("bytes written (retransmit)",
+              stats['bytes_write'] + stats['bytes_retransmit']
+              == node.bytes_read)
+        # Summary reported by canbus_stats
+        cbs._update_host_stats(time.time())
+        status = cbs.get_status(0.)
+        check("status frames", status['host_tx_frames'] == node.frames_read)
+        fill = float(node.bytes_read) / (node.frames_read * 8)
+        check("frame fill", abs(status['host_tx_frame_fill'] - fill) < .001)
+        check("bus utilization", status['host_bus_utilization'] > 0.)
+        check("valid stream", not node.invalid)
+    finally:
+        transport.close()
+    sys.stdout.write("%d blocks in %d frames (fill %.3f), %d ack frames,"
+                     " utilization %.4f, rtt histogram %s\n"
+                     % (node.blocks, node.frames_read,
+                        status['host_tx_frame_fill'], node.frames_write,
+                        status['host_bus_utilization'],
+                        status['host_rtt_histogram']))
+    sys.stdout.write("canbus statistics ok\n")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# Check that cached display_data renders follow status changes
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, copy
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+from extras import gcode_macro
+from extras.display import display
+
+# Templates and the status changes to apply between two redraws
+TESTS = [
+    ("{ printer.obj }", {'b': 3}),
+    ("{ printer.obj == {'a': 1, 'b': 2, 'l': [1, 2]} }", {'b': 3}),
+    ("{ printer.obj != {'a': 1, 'b': 2, 'l': [1, 2]} }", {'b': 3}),
+    ("{ printer.obj.a } { printer.obj }", {'b': 3}),
+    ("{ printer.obj|string }", {'b': 3}),
+    ("{ printer.obj|tojson }", {'b': 3}),
+    ("{ printer.obj|length }", {'c': 4}),
+    ("{ printer.obj.keys()|list }", {'c': 4}),
+    ("{ 'c' in printer.obj }", {'c': 4}),
+    ("{ printer.obj.l }", {'l': [1, 3]}),
+    ("{ printer.obj.a }", {'a': 5}),
+    ("{ printer.obj.a }", {'b': 3}),
+    ("{% for k, v in printer.obj.items() %}{ k }={ v } {% endfor %}",
+     {'b': 3}),
+    ("{ printer['obj'] }", {'b': 3}),
+]
+
+class TestReactor:
+    def monotonic(self):
+        return 0.
+
+class TestStatusObject:
+    def __init__(self):
+        self.status = {'a': 1, 'b': 2, 'l': [1, 2]}
+    def get_status(self, eventtime):
+        return self.status
+
+class TestPrinter:
+    config_error = Exception
+    command_error = Exception
+    def __init__(self):
+        self.reactor = TestReactor()
+        self.objects = {'gcode': None, 'obj': TestStatusObject()}
+    def get_reactor(self):
+        return self.reactor
+    def lookup_object(self, name, default=None):
+        return self.objects.get(name, default)
+    def lookup_objects(self, module=None):
+        return list(self.objects.items())
+    def load_object(self, config, name):
+        return self.objects[name]
+
+class TestConfig:
+    def __init__(self, printer, name, options):
+        self.printer = printer
+        self.name = name
+        self.options = options
+    def get_printer(self):
+        return self.printer
+    def get_name(self):
+        return self.name
+    def get(self, option, default=None):
+        return self.options.get(option, default)
+
+class TestDisplay:
+    def __init__(self):
+        self.text = None
+    def draw_text(self, row, col, text, eventtime):
+        self.text = text
+    def draw_progress_bar(self, row, col, width, value):
+        pass
+
+def check_template(text, change):
+    printer = TestPrinter()
+    config = TestConfig(printer, 'display', {})
+    macros = gcode_macro.PrinterGCodeMacro(config)
+    printer.objects['gcode_macro'] = macros
+    data_config = TestConfig(printer, 'display_data test item',
+                             {'position': '0, 0', 'text': text})
+    group = display.DisplayGroup(config, 'test', [data_config])
+    template = group.data_items[0][2]
+    lcd = TestDisplay()
+    def show():
+        group.show(lcd, {}, 0.)
+        expected = template.template.render(
+            printer=gcode_macro.GetStatusWrapper(printer, 0.))
+        if lcd.text != expected:
+            raise Exception("Template %s: displayed %s, expected %s"
+                            % (repr(text), repr(lcd.text), repr(expected)))
+        return lcd.text
+    first = show()
+    # An unchanged status must reuse the previous render
+    show()
+    stats = template.get_render_stats()
+    if stats['cached_count'] != 1:
+        raise Exception("Template %s: unchanged status was re-rendered"
+                        % (repr(text),))
+    # A changed status must show the new values
+    status = copy.deepcopy(printer.objects['obj'].status)
+    status.update(change)
+    printer.objects['obj'].status = status
+    second = show()
+    return first, second, template.get_render_stats()['render_count']
+
+def main():
+    for text, change in TESTS:
+        first, second, renders = check_template(text, change)
+        sys.stdout.write("%-48s %d renders: %s -> %s\n"
+                         % (text, renders, first, second))
+    sys.stdout.write("All display renders match the status\n")
+
+if __name__ == '__main__':
+    main()
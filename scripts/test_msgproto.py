@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# Check the generated msgproto encoders and parsers against the
+# reference per-parameter implementation
+#
+# Copyright (C) 2026  agent <agent@local>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, random, time
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import msgproto
+
+TEST_FORMATS = {
+    "test_ints a=%u b=%i c=%hu d=%hi e=%c": 80,
+    "test_strings oid=%c s=%s data=%*s pdata=%.*s": 81,
+    "test_enum oid=%c pin=%u value=%c": 82,
+    "queue_digital_out oid=%c clock=%u on_ticks=%u": 83,
+}
+
+TEST_ENUMERATIONS = {
+    'pin': {'PA0': 0, 'PA1': 1, 'PB0': [32, 16]},
+}
+
+# Integer test values (around each VLQ encoding length boundary)
+def int_values(pt):
+    bits = {3: 16, 2: 8}.get(pt.max_length, 32)
+    if pt.signed:
+        low, high = -(1 << (bits - 1)), (1 << (bits - 1)) - 1
+    else:
+        low, high = 0, (1 << bits) - 1
+    vals = set([low, high, 0, 1, -1])
+    for b in [0x20, 0x60, 0x1000, 0x3000, 0x80000, 0x180000,
+              0x4000000, 0xc000000]:
+        vals.update([b - 1, b, b + 1, -b - 1, -b, -b + 1])
+    vals.update([random.randint(low, high) for i in range(200)])
+    return sorted(v for v in vals if low <= v <= high)
+
+def string_values():
+    vals = [b"", b"a", bytes(bytearray(range(48)))]
+    vals.extend(bytes(bytearray(random.randint(0, 255)
+                                for i in range(random.randint(0, 48))))
+                for j in range(50))
+    return vals
+
+def param_values(pt):
+    if pt.is_int:
+        return int_values(pt)
+    if pt.is_dynamic_string:
+        return string_values()
+    # Enumeration
+    return sorted(pt.enums.keys())
+
+# Reference implementation (loop over the parameter types)
+def ref_encode(mp, params):
+    out = list(mp.msgid_bytes)
+    for i, t in enumerate(mp.param_types):
+        t.encode(out, params[i])
+    return out
+
+def ref_parse(mp, s, pos):
+    pos += len(mp.msgid_bytes)
+    out = {}
+    for name, t in mp.param_names:
+        v, pos = t.parse(s, pos)
+        out[name] = v
+    return out, pos
+
+def check_format(mp, count):
+    types = mp.param_types
+    all_vals = [param_values(t) for t in types]
+    # Every test value of each parameter, plus random combinations
+    tests = []
+    for i, vals in enumerate(all_vals):
+        for v in vals:
+            params = [random.choice(av) for av in all_vals]
+            params[i] = v
+            tests.append(params)
+    tests.extend([random.choice(av) for av in all_vals] for i in range(count))
+    for params in tests:
+        ref = ref_encode(mp, params)
+        data = mp.encode(params)
+        if data != ref:
+            raise Exception("encode mismatch %s %s: %s vs %s"
+                            % (mp.msgformat, params, data, ref))
+        byname = dict(zip([n for n, t in mp.param_names], params))
+        if mp.encode_by_name(**byname) != ref:
+            raise Exception("encode_by_name mismatch %s %s"
+                            % (mp.msgformat, params))
+        s = [0x11, 0x22] + ref + [0x33]
+        res = mp.parse(s, 2)
+        if res != ref_parse(mp, s, 2):
+            raise Exception("parse mismatch %s %s: %s vs %s"
+                            % (mp.msgformat, params, res,
+                               ref_parse(mp, s, 2)))
+    return len(tests)
+
+def benchmark(mp, count):
+    params = [random.choice(param_values(t)) for t in mp.param_types]
+    data = mp.encode(params)
+    res = []
+    for name, encode in [("generated", mp.encode),
+                         ("reference", lambda p: ref_encode(mp, p))]:
+        start = time.time()
+        for i in range(count):
+            encode(params)
+        enc_rate = count / (time.time() - start)
+        start = time.time()
+        if name == "generated":
+            for i in range(count):
+                mp.parse(data, 0)
+        else:
+            for i in range(count):
+                ref_parse(mp, data, 0)
+        parse_rate = count / (time.time() - start)
+        res.append("%s: %.0f encodes/s %.0f parses/s"
+                   % (name, enc_rate, parse_rate))
+    return "; ".join(res)
+
+def main():
+    usage = "%prog [options] [<dictionary file> ...]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-c", "--count", type="int", dest="count", default=1000,
+                    help="number of random messages to check per format")
+    opts.add_option("-b", "--benchmark", action="store_true",
+                    dest="benchmark", help="benchmark encoding and parsing")
+    options, args = opts.parse_args()
+    random.seed(42)
+
+    # Load the test formats and any requested data dictionaries
+    parsers = []
+    mp = msgproto.MessageParser()
+    mp.fill_enumerations(TEST_ENUMERATIONS)
+    mp._init_messages(TEST_FORMATS, list(TEST_FORMATS.values()))
+    parsers.append(("test formats", mp))
+    for fname in args:
+        f = open(fname, 'rb')
+        mp = msgproto.MessageParser()
+        mp.process_identify(f.read(), decompress=False)
+        f.close()
+        parsers.append((fname, mp))
+
+    # Check parity of every message format
+    total = 0
+    for name, mp in parsers:
+        formats = [m for m in mp.messages_by_name.values()]
+        for msgfmt in formats:
+            total += check_format(msgfmt, options.count)
+        sys.stdout.write("%s: %d formats ok\n" % (name, len(formats)))
+    sys.stdout.write("Checked %d messages\n" % (total,))
+
+    if options.benchmark:
+        mp = parsers[0][1]
+        msgfmt = mp.messages_by_name['queue_digital_out']
+        sys.stdout.write("queue_digital_out %s\n"
+                         % (benchmark(msgfmt, 200000),))
+
+if __name__ == '__main__':
+    main()